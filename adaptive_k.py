@@ -0,0 +1,125 @@
+"""
+Adaptive top_k.
+Retrieves a larger candidate set and keeps only the chunks whose distance stays close to the
+best one, so easy questions send one or two chunks to the LLM (fewer prompt tokens, faster
+generation) while broad questions keep up to max_k.
+"""
+
+import os
+import math
+import threading
+from typing import Any, Dict, List, Optional
+
+
+ADAPTIVE_RULES = ('gap', 'threshold', 'cumulative')
+
+
+class AdaptiveTopK:
+    def __init__(self,
+                 rule: str = "gap",
+                 min_k: int = 2,
+                 max_k: int = 8,
+                 gap: float = 0.08,
+                 max_distance: float = 1.7,
+                 mass: float = 0.7,
+                 temperature: float = 0.1):
+        """
+        Initialize the distance-based cutoff.
+
+        Args:
+            rule: 'gap' (within a relative gap of the best distance), 'threshold' (absolute
+                  distance limit) or 'cumulative' (smallest set holding `mass` of the similarity)
+            min_k: Chunks always kept
+            max_k: Candidates retrieved (and the most chunks kept)
+            gap: Relative gap: keep distances up to best + gap * |best|
+            max_distance: Absolute threshold, in the collection's HNSW space
+            mass: Share of the total candidate weight the cumulative rule keeps
+            temperature: Scale of weights exp(-(distance - best) / temperature)
+        """
+        if rule not in ADAPTIVE_RULES:
+            raise ValueError(f"Unsupported adaptive top_k rule: {rule} (choose from {', '.join(ADAPTIVE_RULES)})")
+        if not 1 <= min_k <= max_k:
+            raise ValueError(f"Adaptive top_k needs 1 <= min_k <= max_k (got {min_k}, {max_k})")
+        if gap < 0:
+            raise ValueError(f"Adaptive top_k gap must be >= 0 (got {gap})")
+        if not 0 < mass <= 1:
+            raise ValueError(f"Adaptive top_k mass must be in (0, 1] (got {mass})")
+        if temperature <= 0:
+            raise ValueError(f"Adaptive top_k temperature must be > 0 (got {temperature})")
+        self.rule = rule
+        self.min_k = min_k
+        self.max_k = max_k
+        self.gap = gap
+        self.max_distance = max_distance
+        self.mass = mass
+        self.temperature = temperature
+        self._lock = threading.Lock()
+        self.stats = {'queries': 0, 'chunks_kept': 0, 'chunks_cut': 0, 'chars_cut': 0}
+        self.kept_histogram = [0] * (max_k + 1)
+
+    @classmethod
+    def from_env(cls) -> Optional["AdaptiveTopK"]:
+        """Build from ADAPTIVE_TOP_K / ADAPTIVE_* environment variables (None when off)."""
+        rule = os.getenv("ADAPTIVE_TOP_K", "off").lower()
+        if rule == "off":
+            return None
+        return cls(
+            rule=rule,
+            min_k=int(os.getenv("ADAPTIVE_MIN_K", "2")),
+            max_k=int(os.getenv("ADAPTIVE_MAX_K", "8")),
+            gap=float(os.getenv("ADAPTIVE_GAP", "0.08")),
+            max_distance=float(os.getenv("ADAPTIVE_MAX_DISTANCE", "1.7")),
+            mass=float(os.getenv("ADAPTIVE_MASS", "0.7")),
+            temperature=float(os.getenv("ADAPTIVE_TEMPERATURE", "0.1"))
+        )
+
+    def cutoff(self, distances: List[float]) -> int:
+        """Number of chunks to keep from candidates sorted by ascending distance."""
+        if not distances or any(d is None for d in distances):
+            return min(len(distances), self.max_k)
+
+        best = distances[0]
+        if self.rule == 'gap':
+            # Measured from |best|: inner-product distances can be negative
+            keep = sum(1 for d in distances if d - best <= self.gap * abs(best) + 1e-9)
+        elif self.rule == 'threshold':
+            keep = sum(1 for d in distances if d <= self.max_distance)
+        else:
+            weights = [math.exp(-(d - best) / self.temperature) for d in distances]
+            target = self.mass * sum(weights)
+            keep, total = 0, 0.0
+            # Bounded by the candidate count: rounding can leave the running total a hair short
+            while keep < len(weights) and total < target:
+                total += weights[keep]
+                keep += 1
+
+        return min(len(distances), self.max_k, max(self.min_k, keep))
+
+    def apply(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Cut retrieved chunks (best first) and account for what was dropped."""
+        keep = self.cutoff([chunk['distance'] for chunk in chunks])
+        dropped = chunks[keep:]
+        with self._lock:
+            self.stats['queries'] += 1
+            self.stats['chunks_kept'] += keep
+            self.stats['chunks_cut'] += len(dropped)
+            self.stats['chars_cut'] += sum(len(chunk['text']) for chunk in dropped)
+            self.kept_histogram[keep] += 1
+        return chunks[:keep]
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            queries = self.stats['queries']
+            return {
+                'rule': self.rule,
+                'min_k': self.min_k,
+                'max_k': self.max_k,
+                'gap': self.gap,
+                'max_distance': self.max_distance,
+                'mass': self.mass,
+                **self.stats,
+                'mean_kept': round(self.stats['chunks_kept'] / queries, 2) if queries else None,
+                # Rough prompt savings (about 4 characters per token)
+                'prompt_tokens_cut': self.stats['chars_cut'] // 4,
+                'kept_histogram': {str(k): n for k, n in enumerate(self.kept_histogram) if n}
+            }
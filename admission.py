@@ -0,0 +1,171 @@
+"""
+Admission control for expensive endpoints.
+Bounds concurrent executions and the wait queue in front of them, fast-fails overload with a
+retry hint, and lets interactive requests go ahead of (and displace) batch requests.
+"""
+
+import os
+import math
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+
+# Lower value is served first
+PRIORITY_LANES = {'interactive': 0, 'batch': 1}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed instead of admitted."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Request rejected ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, priority: int):
+        self.priority = priority
+        self.granted = False
+        self.rejected_reason = None
+        self.event = threading.Event()
+
+
+class AdmissionController:
+    def __init__(self,
+                 max_concurrent: int = 2,
+                 max_queue: int = 8,
+                 max_queue_time: float = 15.0):
+        """
+        Initialize admission controller.
+
+        Args:
+            max_concurrent: Requests allowed to execute at the same time
+            max_queue: Requests allowed to wait for a slot
+            max_queue_time: Seconds a request may wait before it is rejected
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+
+        self._lock = threading.Lock()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._service_time_ewma = None
+        self.stats = {
+            'admitted': 0,
+            'queued': 0,
+            'rejected_queue_full': 0,
+            'rejected_queue_timeout': 0,
+            'rejected_preempted': 0
+        }
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        """Build a controller from CHAT_MAX_* environment variables."""
+        return cls(
+            max_concurrent=int(os.getenv("CHAT_MAX_CONCURRENT", "2")),
+            max_queue=int(os.getenv("CHAT_MAX_QUEUE", "8")),
+            max_queue_time=float(os.getenv("CHAT_MAX_QUEUE_TIME", "15"))
+        )
+
+    def retry_after(self) -> int:
+        """Estimate seconds until a slot frees up for a new request."""
+        service_time = self._service_time_ewma or 2.0
+        backlog = len(self._queue) + 1
+        return max(1, math.ceil(service_time * backlog / self.max_concurrent))
+
+    def _reject(self, reason: str):
+        self.stats[f'rejected_{reason}'] += 1
+        raise AdmissionRejected(reason, self.retry_after())
+
+    def acquire(self, lane: str = 'interactive'):
+        """
+        Wait for an execution slot.
+
+        Raises:
+            AdmissionRejected: Queue full, queue wait exceeded, or displaced by
+                               a higher-priority request
+        """
+        priority = PRIORITY_LANES.get(lane, PRIORITY_LANES['interactive'])
+
+        with self._lock:
+            if self._active < self.max_concurrent and not self._queue:
+                self._active += 1
+                self.stats['admitted'] += 1
+                return
+
+            if len(self._queue) >= self.max_queue:
+                # Displace the lowest-priority waiter if this request outranks it
+                worst = max(self._queue) if self._queue else None
+                if worst is None or worst[0] <= priority:
+                    self._reject('queue_full')
+                self._queue.remove(worst)
+                heapq.heapify(self._queue)
+                worst[2].rejected_reason = 'preempted'
+                worst[2].event.set()
+
+            waiter = _Waiter(priority)
+            heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+            self.stats['queued'] += 1
+
+        waiter.event.wait(self.max_queue_time)
+
+        with self._lock:
+            if waiter.granted:
+                return
+            if waiter.rejected_reason is None:
+                waiter.rejected_reason = 'queue_timeout'
+                self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+                heapq.heapify(self._queue)
+            self._reject(waiter.rejected_reason)
+
+    def release(self, service_time: float = None):
+        """Free a slot and hand it to the highest-priority waiter."""
+        with self._lock:
+            if service_time is not None:
+                if self._service_time_ewma is None:
+                    self._service_time_ewma = service_time
+                else:
+                    self._service_time_ewma = 0.8 * self._service_time_ewma + 0.2 * service_time
+
+            if self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                waiter.granted = True
+                self.stats['admitted'] += 1
+                waiter.event.set()
+            else:
+                self._active -= 1
+
+    @contextmanager
+    def admit(self, lane: str = 'interactive'):
+        """Hold an execution slot for the duration of the block."""
+        self.acquire(lane)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def info(self) -> Dict[str, Any]:
+        """Return slot usage, queue depth per lane and rejection counters."""
+        with self._lock:
+            depth = {lane: 0 for lane in PRIORITY_LANES}
+            names = {value: lane for lane, value in PRIORITY_LANES.items()}
+            for priority, _, _ in self._queue:
+                depth[names[priority]] += 1
+            return {
+                'active': self._active,
+                'max_concurrent': self.max_concurrent,
+                'queue_depth': len(self._queue),
+                'queue_depth_by_lane': depth,
+                'max_queue': self.max_queue,
+                'max_queue_time_s': self.max_queue_time,
+                'service_time_ewma_s': self._service_time_ewma,
+                **self.stats
+            }
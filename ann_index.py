@@ -0,0 +1,254 @@
+"""
+HNSW index parameters and tuning.
+Makes the ChromaDB HNSW space, M, construction ef and search ef configurable, and measures
+recall against exact brute-force search and latency across a parameter grid on the real corpus.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+HNSW_SPACES = ('l2', 'cosine', 'ip')
+
+# Written by the tuning command, read by ingestion and the server
+HNSW_SETTINGS_PATH = os.getenv("HNSW_SETTINGS_PATH", "hnsw_settings.json")
+
+
+class AnnParams:
+    def __init__(self,
+                 space: str = "l2",
+                 M: int = 16,
+                 construction_ef: int = 100,
+                 search_ef: int = 10):
+        """
+        HNSW parameters (defaults are ChromaDB's).
+
+        Args:
+            space: Distance function (l2, cosine, ip)
+            M: Graph links per node; more links raise recall and memory
+            construction_ef: Candidate list size while building the graph
+            search_ef: Candidate list size while searching (query-time effort)
+        """
+        if space not in HNSW_SPACES:
+            raise ValueError(f"Unsupported HNSW space: {space} (choose from {', '.join(HNSW_SPACES)})")
+        self.space = space
+        self.M = int(M)
+        self.construction_ef = int(construction_ef)
+        self.search_ef = int(search_ef)
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> "AnnParams":
+        """Recommended settings from the tuning file, overridden by HNSW_* environment variables."""
+        path = path or HNSW_SETTINGS_PATH
+        settings = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                settings = json.load(f).get('recommended', {})
+
+        defaults = cls()
+        return cls(
+            space=os.getenv("HNSW_SPACE", settings.get('space', defaults.space)),
+            M=int(os.getenv("HNSW_M", settings.get('M', defaults.M))),
+            construction_ef=int(os.getenv("HNSW_CONSTRUCTION_EF",
+                                          settings.get('construction_ef', defaults.construction_ef))),
+            search_ef=int(os.getenv("HNSW_SEARCH_EF", settings.get('search_ef', defaults.search_ef)))
+        )
+
+    @classmethod
+    def from_collection_metadata(cls, metadata: Optional[Dict[str, Any]]) -> "AnnParams":
+        """Parameters a collection was actually built with."""
+        metadata = metadata or {}
+        defaults = cls()
+        return cls(
+            space=metadata.get('hnsw:space', defaults.space),
+            M=metadata.get('hnsw:M', defaults.M),
+            construction_ef=metadata.get('hnsw:construction_ef', defaults.construction_ef),
+            search_ef=metadata.get('hnsw:search_ef', defaults.search_ef)
+        )
+
+    def collection_metadata(self) -> Dict[str, Any]:
+        """ChromaDB collection metadata keys (fixed once the collection is created)."""
+        return {
+            'hnsw:space': self.space,
+            'hnsw:M': self.M,
+            'hnsw:construction_ef': self.construction_ef,
+            'hnsw:search_ef': self.search_ef
+        }
+
+    def build_params(self) -> Dict[str, Any]:
+        """Parameters that require a rebuild (search_ef can be raised per query)."""
+        return {'space': self.space, 'M': self.M, 'construction_ef': self.construction_ef}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**self.build_params(), 'search_ef': self.search_ef}
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int, space: str = "l2") -> np.ndarray:
+    """Ground-truth top-k row indices by brute force."""
+    if space == 'cosine':
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    if space == 'l2':
+        scores = np.einsum('ij,ij->i', vectors, vectors)[None, :] - 2.0 * queries @ vectors.T
+    else:
+        scores = -(queries @ vectors.T)
+    k = min(k, len(vectors))
+    top = np.argpartition(scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(top, np.argsort(np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+
+
+def tune(vectors: np.ndarray,
+         queries: np.ndarray,
+         k: int = 5,
+         spaces: List[str] = ("l2",),
+         M_values: List[int] = (8, 16, 32),
+         construction_efs: List[int] = (64, 100, 200),
+         search_efs: List[int] = (10, 20, 50, 100),
+         target_recall: float = 0.99) -> Dict[str, Any]:
+    """
+    Measure recall@k and latency of HNSW indexes across a parameter grid.
+
+    Indexes are built with hnswlib, the library ChromaDB uses for its vector segment,
+    so recall and latency carry over to collections created with the same parameters.
+
+    Returns:
+        Grid results and the lowest-latency setting that reaches target_recall
+        (or the highest-recall setting if none does)
+    """
+    import hnswlib
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    k = min(k, len(vectors))
+
+    grid = []
+    for space in spaces:
+        truth = exact_neighbours(vectors, queries, k, space)
+        for M, construction_ef in itertools.product(M_values, construction_efs):
+            index = hnswlib.Index(space=space, dim=vectors.shape[1])
+            start = time.perf_counter()
+            index.init_index(max_elements=len(vectors), ef_construction=construction_ef, M=M)
+            index.add_items(vectors, np.arange(len(vectors)))
+            build_seconds = time.perf_counter() - start
+
+            for search_ef in search_efs:
+                index.set_ef(max(search_ef, k))
+                latencies = []
+                hits = 0
+                for query, expected in zip(queries, truth):
+                    start = time.perf_counter()
+                    labels, _ = index.knn_query(query, k=k)
+                    latencies.append(time.perf_counter() - start)
+                    hits += len(set(labels[0].tolist()) & set(expected.tolist()))
+
+                grid.append({
+                    **AnnParams(space, M, construction_ef, search_ef).to_dict(),
+                    'recall_at_k': hits / (len(queries) * k),
+                    'mean_latency_ms': float(np.mean(latencies) * 1000),
+                    'p95_latency_ms': float(np.percentile(latencies, 95) * 1000),
+                    'build_seconds': build_seconds
+                })
+
+    passing = [row for row in grid if row['recall_at_k'] >= target_recall]
+    if passing:
+        best = min(passing, key=lambda row: (row['p95_latency_ms'], row['M'], row['construction_ef']))
+    else:
+        best = max(grid, key=lambda row: (row['recall_at_k'], -row['p95_latency_ms']))
+
+    return {
+        'chunks': len(vectors),
+        'queries': len(queries),
+        'k': k,
+        'target_recall': target_recall,
+        'recommended': {key: best[key] for key in ('space', 'M', 'construction_ef', 'search_ef')},
+        'recommended_stats': {key: best[key] for key in ('recall_at_k', 'mean_latency_ms', 'p95_latency_ms')},
+        'grid': grid
+    }
+
+
+def load_corpus(db_path: str, collection_name: str, embedding_model: str,
+                questions_path: str = "eval_questions.json", extra_queries: int = 200):
+    """
+    Chunk vectors of a collection plus query vectors for tuning.
+
+    Queries are the evaluation questions, topped up with chunk vectors perturbed by noise
+    so small corpora still produce a stable recall estimate.
+    """
+    import chromadb
+    from chromadb.config import Settings
+    from sentence_transformers import SentenceTransformer
+
+    client = chromadb.PersistentClient(
+        path=db_path,
+        settings=Settings(anonymized_telemetry=False, allow_reset=True)
+    )
+    vectors = np.asarray(client.get_collection(name=collection_name).get(include=['embeddings'])['embeddings'],
+                         dtype=np.float32)
+
+    queries = []
+    if os.path.exists(questions_path):
+        with open(questions_path, 'r', encoding='utf-8') as f:
+            questions = [q['question'] for q in json.load(f)]
+        model = SentenceTransformer(embedding_model, device='cpu')
+        queries.append(np.asarray(model.encode(questions), dtype=np.float32))
+
+    rng = np.random.default_rng(0)
+    picks = vectors[rng.integers(0, len(vectors), size=extra_queries)]
+    queries.append(picks + rng.normal(scale=float(vectors.std()) * 0.5, size=picks.shape).astype(np.float32))
+    return vectors, np.concatenate(queries)
+
+
+def print_report(report: Dict[str, Any]):
+    """Print the grid sorted by recall and latency."""
+    print(f"{report['chunks']} chunks, {report['queries']} queries, recall@{report['k']}")
+    print(f"{'space':<8}{'M':>4}{'c_ef':>6}{'s_ef':>6}{'recall':>9}{'mean ms':>10}{'p95 ms':>9}{'build s':>9}")
+    for row in sorted(report['grid'], key=lambda r: (-r['recall_at_k'], r['p95_latency_ms'])):
+        print(f"{row['space']:<8}{row['M']:>4}{row['construction_ef']:>6}{row['search_ef']:>6}"
+              f"{row['recall_at_k']:>9.3f}{row['mean_latency_ms']:>10.3f}{row['p95_latency_ms']:>9.3f}"
+              f"{row['build_seconds']:>9.2f}")
+    print(f"\n✅ Recommended: {report['recommended']} {report['recommended_stats']}")
+
+
+def main():
+    """Tune HNSW parameters on the ingested corpus and write the recommendation."""
+    from tenants import collection_name
+
+    parser = argparse.ArgumentParser(description="Recall/latency grid search for HNSW parameters")
+    parser.add_argument('--db-path', default=os.getenv("CHROMA_DB_PATH", "chroma_db"))
+    parser.add_argument('--tenant', default=None)
+    parser.add_argument('--embedding-model', default=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+    parser.add_argument('-k', type=int, default=int(os.getenv("TOP_K", "5")))
+    parser.add_argument('--spaces', default="l2", help="Comma-separated (l2,cosine,ip)")
+    parser.add_argument('--M', default="8,16,32")
+    parser.add_argument('--construction-ef', default="64,100,200")
+    parser.add_argument('--search-ef', default="10,20,50,100")
+    parser.add_argument('--target-recall', type=float, default=0.99)
+    parser.add_argument('--output', default=HNSW_SETTINGS_PATH)
+    args = parser.parse_args()
+
+    def ints(value: str) -> List[int]:
+        return [int(v) for v in value.split(',') if v]
+
+    vectors, queries = load_corpus(args.db_path, collection_name(args.tenant), args.embedding_model)
+    report = tune(vectors, queries, k=args.k,
+                  spaces=[s for s in args.spaces.split(',') if s],
+                  M_values=ints(args.M),
+                  construction_efs=ints(args.construction_ef),
+                  search_efs=ints(args.search_ef),
+                  target_recall=args.target_recall)
+    print_report(report)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"📊 Settings written to {args.output}; re-run ingest.py to rebuild the collection with them")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,8 +4,10 @@ Provides web interface and API endpoints for querying company policies.
 """
 
 import os
+import copy
 import time
-from flask import Flask, request, jsonify, render_template, send_from_directory
+import threading
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory
 from dotenv import load_dotenv
 
 # Load environment variables first
@@ -15,15 +17,75 @@ load_dotenv()
 os.environ["ANONYMIZED_TELEMETRY"] = "False"
 os.environ["ORT_DEVICE"] = "CPU"
 
-from rag import RAGPipeline
+from rag import GenerationError, RAGPipeline
+from llm_cache import LLMResponseCache
+from coalesce import SingleFlight, normalize_question
+from admission import AdmissionController, AdmissionRejected
+from filters import normalize_filters
+from tenants import UnknownTenantError, validate_tenant
+from sessions import SessionStore
+from prewarm import FAQCache, FAQPrewarmer, QuestionLog
+from doc_watcher import DocumentWatcher
+from blue_green import PointerMonitor
+from extractive import ExtractiveAnswerer
+from adaptive_k import AdaptiveTopK
+from scope_gate import ScopeGate
+from memory import MemoryBudget, memory_report, start_tracing_from_env
+from profiling import PROFILE_MODES, RequestProfiler, is_admin
+from payload import (FastJSONProvider, PayloadStats, ResponseCompressor, parse_fields, parse_include, shape_hits,
+                     shape_response)
+
+# Trace Python allocations from startup when MEMORY_TRACEMALLOC is set (reported by /memory)
+start_tracing_from_env()
 
 app = Flask(__name__)
 
+# Faster JSON serialization and Accept-Encoding based compression, with size/time accounting
+payload_stats = PayloadStats()
+app.json = FastJSONProvider(app, stats=payload_stats)
+response_compressor = ResponseCompressor.from_env(stats=payload_stats)
+default_source_detail = parse_include(os.getenv("CHAT_SOURCE_DETAIL", "full"))
+
 # Global variable to hold RAG pipeline
 rag_pipeline = None
 preload_complete = False
 initialization_error = None
 
+# Per-worker single-flight group for identical in-flight questions
+query_coalescer = SingleFlight()
+coalesce_enabled = os.getenv("COALESCE_QUERIES", "true").lower() == "true"
+
+# Bounded concurrency and wait queue in front of RAG execution
+chat_admission = AdmissionController.from_env()
+
+# Per-worker multi-turn conversation state (route a session to one worker, e.g. sticky sessions)
+session_store = SessionStore.from_env()
+
+# Pre-warmed answers for frequent questions, refreshed when the index version changes
+prewarm_enabled = os.getenv("PREWARM_FAQS", "false").lower() == "true"
+faq_prewarmer = None
+question_log = QuestionLog(os.getenv("QUESTION_LOG_PATH")) if os.getenv("QUESTION_LOG_PATH") else None
+
+# Optional hot re-indexing of edited policy documents
+watch_enabled = os.getenv("WATCH_DOCUMENTS", "false").lower() == "true"
+document_watcher = None
+
+# Follows blue/green index swaps and rollbacks (blue_green.py)
+pointer_monitor = None
+
+# RSS budget: shed caches, then reject new /chat work, before the OOM killer ends the worker
+memory_budget = MemoryBudget.from_env()
+
+# On-demand (admin) and 1-in-N sampled request profiles
+request_profiler = RequestProfiler.from_env()
+
+# Retrieval-only /search: batch size and result window limits, and counters for /metrics
+search_max_queries = int(os.getenv("SEARCH_MAX_QUERIES", "32"))
+search_max_results = int(os.getenv("SEARCH_MAX_RESULTS", "100"))
+default_top_k = int(os.getenv("TOP_K", "5"))
+search_lock = threading.Lock()
+search_stats = {'requests': 0, 'queries': 0, 'seconds': 0.0}
+
 def initialize_rag():
     """Initialize RAG pipeline without loading heavy models."""
     global rag_pipeline, preload_complete, initialization_error
@@ -35,7 +97,15 @@ def initialize_rag():
             embedding_model=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"),
             llm_provider=os.getenv("LLM_PROVIDER", "openrouter"),
             model_name=os.getenv("MODEL_NAME", "google/gemini-flash-1.5-8b"),
-            top_k=int(os.getenv("TOP_K", "5"))
+            top_k=default_top_k,
+            response_cache=LLMResponseCache.from_env(),
+            sidecar_socket=os.getenv("EMBEDDING_SIDECAR_SOCKET") or None,
+            index_bundle=os.getenv("INDEX_BUNDLE_PATH") or None,
+            tenant_bundle_dir=os.getenv("TENANT_BUNDLE_DIR") or None,
+            faq_cache=FAQCache(float(os.getenv("FAQ_MATCH_SIMILARITY", "0"))) if prewarm_enabled else None,
+            extractive=ExtractiveAnswerer.from_env(),
+            adaptive_k=AdaptiveTopK.from_env(),
+            scope_gate=ScopeGate.from_env(os.getenv("CHROMA_DB_PATH", "chroma_db"))
         )
         preload_complete = True
         print("✅ RAG pipeline initialized successfully!")
@@ -46,8 +116,65 @@ def initialize_rag():
         traceback.print_exc()
         preload_complete = False
 
-# Initialize on module load
+def start_prewarm():
+    """Warm the FAQ answers in the background so the first users after a deploy hit a warm cache."""
+    global faq_prewarmer
+    if prewarm_enabled and rag_pipeline is not None:
+        faq_prewarmer = FAQPrewarmer.from_env(rag_pipeline, admission=chat_admission)
+        faq_prewarmer.start()
+
+def on_index_change(version):
+    """Invalidate version-keyed caches after the watcher updated the index."""
+    if faq_prewarmer is not None:
+        faq_prewarmer.invalidate()
+
+def start_watcher():
+    """Apply document edits to the live index without a restart."""
+    global document_watcher
+    if not watch_enabled or rag_pipeline is None:
+        return
+    if 'bundle_version' in (rag_pipeline.collection.metadata or {}) or rag_pipeline.sidecar is not None:
+        # Bundles are immutable and the sidecar searches its own copy of the index
+        print("⚠️  WATCH_DOCUMENTS needs the in-process ChromaDB index (no INDEX_BUNDLE_PATH / sidecar); not watching")
+        return
+    document_watcher = DocumentWatcher.from_env(rag_pipeline, on_change=on_index_change)
+    document_watcher.start()
+
+def on_index_swap(collection):
+    """Re-warm FAQs and point the document watcher at the newly serving collection."""
+    if faq_prewarmer is not None:
+        faq_prewarmer.invalidate()
+    if document_watcher is not None:
+        document_watcher.retarget()
+
+def start_pointer_monitor():
+    """Switch to a promoted (or rolled back) index without a restart."""
+    global pointer_monitor
+    if rag_pipeline is None or 'bundle_version' in (rag_pipeline.collection.metadata or {}):
+        return
+    pointer_monitor = PointerMonitor.from_env(rag_pipeline, on_swap=on_index_swap)
+    if pointer_monitor.interval > 0:
+        pointer_monitor.start()
+
+def register_shedders():
+    """Caches dropped under memory pressure, cheapest to rebuild first."""
+    if memory_budget is None:
+        return
+    rag = rag_pipeline
+    if rag is not None and rag.extractive is not None:
+        memory_budget.add_shedder('extractive_sentence_cache', rag.extractive.clear_cache)
+    if rag is not None:
+        memory_budget.add_shedder('standby_index', rag.release_standby)
+        memory_budget.add_shedder('tenant_indexes', rag.tenants.evict_all)
+    # Last resort: ends the least recently used conversations
+    memory_budget.add_shedder('sessions', session_store.shrink)
+
+# Initialize on module load (opens the ChromaDB index; the embedding model loads on first query)
 initialize_rag()
+start_prewarm()
+start_watcher()
+start_pointer_monitor()
+register_shedders()
 
 def get_rag_pipeline():
     """Get RAG pipeline instance."""
@@ -133,9 +260,26 @@ def chat():
     {
         "question": "How many PTO days do I get?",
         "top_k": 5 (optional),
-        "use_rerank": false (optional)
+        "use_rerank": false (optional),
+        "filters": {"doc_id": "POL-003", "tags": ["finance"]} (optional),
+        "tenant": "acme" (optional, or header X-Tenant),
+        "session_id": "..." (optional, from POST /sessions; continues the conversation),
+        "fields": ["answer", "sources"] (optional, top-level fields to return),
+        "include": "snippet" (optional, source detail: full, snippet or ids),
+        "profile": true (optional, admin only: "sample" or "cprofile")
     }
 
+    filters restrict retrieval by doc_id, title, format or ingestion-time tags.
+    include=snippet drops each source's full_text; include=ids returns only
+    source_num, doc_id and chunk_id per source.
+
+    Header X-Request-Priority: batch puts internal batch callers behind
+    interactive users. Overload is answered with 429 and Retry-After.
+
+    profile (with header X-Admin-Token) runs the request under a profiler and
+    adds per-stage timings and the top stacks as "profile"; the full profile is
+    stored for GET /profiles/<profile_id>.
+
     Response JSON:
     {
         "answer": "...",
@@ -171,8 +315,47 @@ def chat():
             return jsonify({'error': 'Question cannot be empty'}), 400
 
         top_k = data.get('top_k', None)
+        # Also part of the coalescing key, which needs a hashable value
+        if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1):
+            return jsonify({'error': 'top_k must be a positive integer'}), 400
         use_rerank = data.get('use_rerank', False)
 
+        try:
+            filters = normalize_filters(data.get('filters'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        try:
+            tenant = validate_tenant(data.get('tenant') or request.headers.get('X-Tenant'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        try:
+            fields = parse_fields(data.get('fields'))
+            include = parse_include(data.get('include'), default=default_source_detail)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        profile_mode = data.get('profile')
+        if profile_mode:
+            if not is_admin(request.headers.get('X-Admin-Token')):
+                return jsonify({'error': 'Profiling requires a valid X-Admin-Token header'}), 403
+            profile_mode = 'sample' if profile_mode is True else str(profile_mode)
+            if profile_mode not in PROFILE_MODES:
+                return jsonify({'error': f"profile must be true or one of: {', '.join(PROFILE_MODES)}"}), 400
+
+        session = None
+        if data.get('session_id'):
+            session = session_store.get(str(data['session_id']))
+            if session is None:
+                return jsonify({
+                    'error': 'Unknown or expired session. Start a new one with POST /sessions.',
+                    'session_id': data['session_id']
+                }), 404
+
+        if question_log is not None:
+            question_log.record(question, tenant)
+
         # Track latency
         start_time = time.time()
 
@@ -180,19 +363,97 @@ def chat():
         print(f"🔍 Processing question: {question[:50]}...")
         rag = get_rag_pipeline()
 
-        # Execute query
-        result = rag.query(
-            question=question,
-            top_k=top_k,
-            use_rerank=use_rerank
-        )
+        lane = request.headers.get('X-Request-Priority', 'interactive').lower()
+
+        if memory_budget is not None:
+            memory_budget.admit()
+
+        # Requested profile, or the 1-in-N production sample
+        if profile_mode:
+            profiling = (profile_mode, False)
+        else:
+            profiling = ('sample', True) if request_profiler.should_sample() else None
+        profiles = []
+
+        def execute(**kwargs):
+            if profiling is None:
+                return rag.query(**kwargs)
+            with request_profiler.profile(*profiling) as profile:
+                result = rag.query(**kwargs)
+            if profile is not None:
+                profiles.append(profile)
+            return result
+
+        # Execute query (identical concurrent questions share one execution)
+        def run_query():
+            with chat_admission.admit(lane):
+                return execute(
+                    question=question,
+                    top_k=top_k,
+                    use_rerank=use_rerank,
+                    filters=filters,
+                    tenant=tenant
+                )
+
+        def run_session_query():
+            # Turns of one session run one at a time so history and context stay consistent
+            with chat_admission.admit(lane), session.lock:
+                result = execute(
+                    question=question,
+                    top_k=top_k,
+                    use_rerank=use_rerank,
+                    filters=filters,
+                    tenant=tenant,
+                    session=session
+                )
+            session_store.touch(session)
+            return result
+
+        if session is not None:
+            result = run_session_query()
+        elif coalesce_enabled and profiling is None:
+            scope = tuple((field, tuple(values)) for field, values in sorted((filters or {}).items()))
+            key = (tenant, normalize_question(question), top_k, bool(use_rerank), scope)
+            shared_result, coalesced = query_coalescer.do(key, run_query)
+            # Coalesced callers get their own sources/metadata to shape and compress
+            result = copy.deepcopy(shared_result)
+            result['question'] = question
+            result['coalesced'] = coalesced
+        else:
+            result = run_query()
         print(f"✅ Query executed successfully")
 
         # Calculate latency
         latency_ms = int((time.time() - start_time) * 1000)
         result['latency_ms'] = latency_ms
 
-        return jsonify(result), 200
+        body = shape_response(result, fields=fields, include=include)
+        if profiles and not profiles[0].sampled:
+            body['profile'] = profiles[0].report()
+        return jsonify(body), 200
+
+    except UnknownTenantError as e:
+        return jsonify({'error': f"Unknown tenant: {e.args[0]}. Run 'python ingest.py --tenant {e.args[0]}' first."}), 404
+
+    except AdmissionRejected as e:
+        print(f"⚠️  /chat overloaded: {e.reason}")
+        response = jsonify({
+            'error': 'Server is busy. Please retry shortly.',
+            'reason': e.reason,
+            'retry_after': e.retry_after
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    except GenerationError as e:
+        print(f"⚠️  /chat generation failed: {e}")
+        response = jsonify({
+            'error': 'The answer could not be generated. Please retry shortly.',
+            'reason': 'llm_timeout' if e.timed_out else 'llm_unavailable',
+            'retry_after': 5
+        })
+        response.headers['Retry-After'] = '5'
+        return response, 504 if e.timed_out else 503
 
     except Exception as e:
         import traceback
@@ -206,14 +467,243 @@ def chat():
         }), 500
 
 
+@app.route('/search', methods=['POST', 'OPTIONS'])
+def search():
+    """
+    Retrieval-only endpoint: ranked policy chunks without a generated answer.
+
+    Request JSON:
+    {
+        "query": "parental leave" (or "queries": ["parental leave", "401k match"]),
+        "top_k": 5 (optional, results per page),
+        "offset": 0 (optional, pass a result's next_offset for the next page),
+        "use_rerank": false (optional),
+        "filters": {"tags": ["benefits"]} (optional, as for /chat),
+        "tenant": "acme" (optional, or header X-Tenant),
+        "include": "snippet" (optional: full, snippet or ids)
+    }
+
+    Response JSON:
+    {
+        "results": [{"query": "...", "hits": [{"rank": 1, "chunk_id": "...", "doc_id": "...",
+                     "score": 0.71, "snippet": "...", "metadata": {...}}, ...],
+                     "offset": 0, "next_offset": 5}],
+        "latency_ms": 12.3
+    }
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    try:
+        if not preload_complete:
+            return jsonify({
+                'error': 'System is still warming up. Please try again in a few seconds.',
+                'ready': False
+            }), 503
+
+        data = request.get_json(silent=True) or {}
+        queries = data['queries'] if 'queries' in data else [data.get('query')]
+        if (not isinstance(queries, list) or not queries
+                or not all(isinstance(q, str) and q.strip() for q in queries)):
+            return jsonify({
+                'error': 'Provide a non-empty "query" string or a "queries" list of them',
+                'example': {'queries': ['parental leave', '401k match']}
+            }), 400
+        if len(queries) > search_max_queries:
+            return jsonify({'error': f"At most {search_max_queries} queries per request"}), 400
+
+        top_k = data.get('top_k', None)
+        offset = data.get('offset', 0)
+        # bool is an int subclass: reject true/false explicitly
+        if ((top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1))
+                or isinstance(offset, bool) or not isinstance(offset, int) or offset < 0):
+            return jsonify({'error': 'top_k must be a positive integer and offset a non-negative integer'}), 400
+        # Checked against the configured default so malformed requests never build the pipeline
+        if offset + (top_k or default_top_k) > search_max_results:
+            return jsonify({'error': f"offset + top_k may not exceed {search_max_results}"}), 400
+
+        try:
+            filters = normalize_filters(data.get('filters'))
+            tenant = validate_tenant(data.get('tenant') or request.headers.get('X-Tenant'))
+            include = parse_include(data.get('include'), default='snippet')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if memory_budget is not None:
+            memory_budget.admit()
+
+        start_time = time.perf_counter()
+        results = get_rag_pipeline().search(
+            [q.strip() for q in queries],
+            top_k=top_k,
+            offset=offset,
+            use_rerank=bool(data.get('use_rerank', False)),
+            filters=filters,
+            tenant=tenant,
+            rerank_window=search_max_results
+        )
+        elapsed = time.perf_counter() - start_time
+        with search_lock:
+            search_stats['requests'] += 1
+            search_stats['queries'] += len(queries)
+            search_stats['seconds'] += elapsed
+
+        return jsonify({
+            'results': [{**result, 'hits': shape_hits(result['hits'], include)} for result in results],
+            'latency_ms': round(elapsed * 1000, 1)
+        }), 200
+
+    except UnknownTenantError as e:
+        return jsonify({'error': f"Unknown tenant: {e.args[0]}. Run 'python ingest.py --tenant {e.args[0]}' first."}), 404
+
+    except AdmissionRejected as e:
+        print(f"⚠️  /search rejected: {e.reason}")
+        response = jsonify({
+            'error': 'Server is busy. Please retry shortly.',
+            'reason': e.reason,
+            'retry_after': e.retry_after
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    except Exception as e:
+        import traceback
+        print(f"❌ ERROR in /search endpoint:")
+        print(traceback.format_exc())
+        return jsonify({
+            'error': 'Internal server error',
+            'message': str(e),
+            'type': type(e).__name__
+        }), 500
+
+
+def _search_stats():
+    with search_lock:
+        requests = search_stats['requests']
+        return {
+            'requests': requests,
+            'queries': search_stats['queries'],
+            'mean_latency_ms': round(search_stats['seconds'] / requests * 1000, 1) if requests else None
+        }
+
+
+def _sidecar_stats(rag):
+    """Micro-batching stats from the embedding sidecar, if one is used."""
+    if rag is None or rag.sidecar is None:
+        return None
+    try:
+        return rag.sidecar.stats()
+    except Exception as e:
+        return {'error': str(e)}
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Report per-worker serving metrics."""
+    rag = rag_pipeline
+    response_cache = rag.response_cache if rag is not None else None
+
+    return jsonify({
+        'pid': os.getpid(),
+        'admission': chat_admission.info(),
+        'coalescing': query_coalescer.info(),
+        'llm_requests': rag.llm_requester.info() if rag is not None else None,
+        'llm_routes': rag.llm_router.info() if rag is not None and rag.llm_router is not None else None,
+        'llm_cache': response_cache.info() if response_cache is not None else None,
+        'embedding_sidecar': _sidecar_stats(rag),
+        'tenants': rag.tenants.info() if rag is not None else None,
+        'sessions': session_store.info(),
+        'faq_prewarm': faq_prewarmer.info() if faq_prewarmer is not None else None,
+        'extractive': rag.extractive.info() if rag is not None and rag.extractive is not None else None,
+        'adaptive_top_k': rag.adaptive_k.info() if rag is not None and rag.adaptive_k is not None else None,
+        'scope_gate': rag.scope_gate.info() if rag is not None and rag.scope_gate is not None else None,
+        'payloads': payload_stats.info(),
+        'document_watcher': document_watcher.info() if document_watcher is not None else None,
+        'index_pointer': pointer_monitor.info() if pointer_monitor is not None else None,
+        'memory_budget': memory_budget.info() if memory_budget is not None else None,
+        'profiling': request_profiler.info(),
+        'search': _search_stats(),
+        'timestamp': time.time()
+    }), 200
+
+
+@app.route('/memory', methods=['GET'])
+def memory():
+    """
+    Report this worker's memory: RSS, per-component estimates and the budget state.
+
+    Query parameter top=N adds the N largest Python allocation sites (admin only, since they
+    name source files and lines; needs MEMORY_TRACEMALLOC=<frames> at startup).
+    """
+    try:
+        top = int(request.args.get('top', 0))
+    except ValueError:
+        return jsonify({'error': 'top must be an integer'}), 400
+    if top > 0 and not is_admin(request.headers.get('X-Admin-Token')):
+        return jsonify({'error': 'Allocation sites require a valid X-Admin-Token header'}), 403
+    return jsonify(memory_report(rag_pipeline, session_store, memory_budget, top=min(max(top, 0), 100))), 200
+
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    """List stored request profiles (admin only)."""
+    if not is_admin(request.headers.get('X-Admin-Token')):
+        return jsonify({'error': 'Requires a valid X-Admin-Token header'}), 403
+    return jsonify({'profiles': request_profiler.list_profiles(), **request_profiler.info()}), 200
+
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def profile_detail(profile_id):
+    """
+    A stored profile (admin only): its report, or with format=folded the folded stacks for
+    flamegraph.pl / speedscope.
+    """
+    if not is_admin(request.headers.get('X-Admin-Token')):
+        return jsonify({'error': 'Requires a valid X-Admin-Token header'}), 403
+    kind = request.args.get('format', 'report')
+    content = request_profiler.load(profile_id, kind)
+    if content is None:
+        return jsonify({'error': f"Unknown profile: {profile_id}"}), 404
+    if kind == 'folded':
+        return Response(content, mimetype='text/plain')
+    return Response(content, mimetype='application/json')
+
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """Start a multi-turn conversation; pass the returned session_id to /chat."""
+    session = session_store.create()
+    return jsonify({
+        'session_id': session.session_id,
+        'ttl_s': session_store.ttl_seconds,
+        'max_turns': session.max_turns
+    }), 201
+
+
+@app.route('/sessions/<session_id>', methods=['GET', 'DELETE'])
+def session_detail(session_id):
+    """Show a session's history and context, or end it."""
+    if request.method == 'DELETE':
+        if not session_store.delete(session_id):
+            return jsonify({'error': 'Unknown or expired session'}), 404
+        return '', 204
+
+    session = session_store.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown or expired session'}), 404
+    return jsonify(session.info()), 200
+
+
 @app.route('/documents', methods=['GET'])
 def list_documents():
-    """List all indexed documents."""
+    """List all indexed documents (of the tenant given by ?tenant=)."""
     try:
         rag = get_rag_pipeline()
+        tenant = validate_tenant(request.args.get('tenant') or request.headers.get('X-Tenant'))
 
         # Get all unique documents
-        results = rag.collection.get()
+        with rag.use_collection(tenant) as collection:
+            results = collection.get()
 
         # Extract unique documents
         docs = {}
@@ -233,10 +723,22 @@ def list_documents():
             'total_chunks': len(results['ids'])
         }), 200
 
+    except UnknownTenantError as e:
+        return jsonify({'error': f"Unknown tenant: {e.args[0]}"}), 404
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.after_request
+def compress_response(response):
+    """Compress responses for clients that accept gzip (or brotli)."""
+    return response_compressor(response, request.headers.get('Accept-Encoding', ''))
+
+
 @app.errorhandler(404)
 def not_found(e):
     """Handle 404 errors."""
@@ -0,0 +1,392 @@
+"""
+Blue/green index rebuilds.
+Full rebuilds (new chunking or a new embedding model) go into a shadow collection tagged with
+the model and chunking parameters, are validated against the serving collection on the
+evaluation questions, and are promoted by atomically replacing a pointer file that running
+servers poll. The previous collection stays on disk, and loaded in servers, for fast rollback.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from tenants import DEFAULT_TENANT, collection_name, validate_tenant
+from scope_gate import centroids_path
+
+
+# Serving collection per tenant, next to the ChromaDB files
+POINTER_FILE = "index_pointer.json"
+
+# Build collections are "<tenant collection>.b<UTC timestamp>" ('.' never occurs in tenant ids)
+_BUILD_MARKER = ".b"
+
+
+def build_collection_name(tenant: Optional[str] = None, built_at: Optional[float] = None) -> str:
+    """Name of a new shadow collection for a tenant (fits Chroma's 63-char limit)."""
+    stamp = datetime.fromtimestamp(built_at or time.time(), tz=timezone.utc).strftime('%y%m%d%H%M%S')
+    return f"{collection_name(tenant)[:49]}{_BUILD_MARKER}{stamp}"
+
+
+def is_build_of(name: str, tenant: Optional[str] = None) -> bool:
+    """Whether a collection is a blue/green build of a tenant's index."""
+    return name.startswith(collection_name(tenant)[:49] + _BUILD_MARKER)
+
+
+class IndexPointer:
+    def __init__(self, db_path: str):
+        """
+        Pointer file naming the serving collection of every tenant.
+
+        Args:
+            db_path: ChromaDB directory holding the pointer file
+        """
+        self.path = os.path.join(db_path, POINTER_FILE)
+        self._state = {'tenants': {}}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Any]:
+        """Current pointer state, re-read only when the file changed."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime != self._mtime:
+                if mtime is None:
+                    self._state = {'tenants': {}}
+                else:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._state = json.load(f)
+                self._mtime = mtime
+            return self._state
+
+    def _write(self, state: Dict[str, Any]):
+        # Readers see either the old or the new file, never a partial one
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def entry(self, tenant: Optional[str] = None) -> Dict[str, Any]:
+        return dict(self._load()['tenants'].get(validate_tenant(tenant), {}))
+
+    def active(self, tenant: Optional[str] = None) -> str:
+        """Collection serving a tenant (the tenant's original collection until a swap)."""
+        return self.entry(tenant).get('active') or collection_name(tenant)
+
+    def previous(self, tenant: Optional[str] = None) -> Optional[str]:
+        return self.entry(tenant).get('previous')
+
+    def activate(self, name: str, tenant: Optional[str] = None) -> Dict[str, Any]:
+        """Point a tenant at a collection; the current one becomes the rollback target."""
+        tenant = validate_tenant(tenant)
+        state = json.loads(json.dumps(self._load()))
+        current = self.active(tenant)
+        if name == current:
+            return state['tenants'].get(tenant, {})
+        state['tenants'][tenant] = {'active': name, 'previous': current, 'swapped_at': time.time()}
+        self._write(state)
+        return state['tenants'][tenant]
+
+    def rollback(self, tenant: Optional[str] = None) -> str:
+        """
+        Swap a tenant back to its previous collection.
+
+        Raises:
+            ValueError: Nothing to roll back to
+        """
+        previous = self.previous(tenant)
+        if not previous:
+            raise ValueError(f"No previous index recorded for tenant '{validate_tenant(tenant)}'")
+        self.activate(previous, tenant)
+        return previous
+
+    def info(self) -> Dict[str, Any]:
+        return self._load()['tenants']
+
+
+def _retrieval_runs(client: Any, names: List[str], questions: List[Dict[str, Any]], k: int):
+    """Top-k chunks per question from each collection, embedded with the collection's own model."""
+    from sentence_transformers import SentenceTransformer
+
+    models = {}
+    runs = {}
+    for name in names:
+        collection = client.get_collection(name=name)
+        model_name = (collection.metadata or {}).get('embedding_model', os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+        if model_name not in models:
+            models[model_name] = SentenceTransformer(model_name, device='cpu')
+        embeddings = models[model_name].encode([q['question'] for q in questions]).tolist()
+
+        rows = []
+        for embedding in embeddings:
+            start = time.perf_counter()
+            result = collection.query(query_embeddings=[embedding], n_results=min(k, max(collection.count(), 1)))
+            rows.append({
+                'texts': result['documents'][0],
+                'doc_ids': [m['doc_id'] for m in result['metadatas'][0]],
+                'latency_ms': (time.perf_counter() - start) * 1000
+            })
+        runs[name] = {'model': model_name, 'count': collection.count(), 'rows': rows}
+    return runs
+
+
+def _term_recall(question: Dict[str, Any], texts: List[str]) -> Optional[float]:
+    """Share of a question's expected terms found in the retrieved text."""
+    terms = question.get('expected_contains') or []
+    if not terms:
+        return None
+    context = " ".join(texts).lower()
+    return sum(term.lower() in context for term in terms) / len(terms)
+
+
+def validate(client: Any,
+             candidate: str,
+             baseline: Optional[str],
+             questions: List[Dict[str, Any]],
+             k: int = 5,
+             tolerance: float = 0.05) -> Dict[str, Any]:
+    """
+    Compare retrieval of a candidate collection with the serving one on evaluation questions.
+
+    The candidate passes if it answers every question with results and its expected-term recall
+    is no more than `tolerance` below the baseline's.
+
+    Returns:
+        Per-collection recall and latency, document agreement and the verdict
+    """
+    names = [candidate] + ([baseline] if baseline and baseline != candidate else [])
+    runs = _retrieval_runs(client, names, questions, k)
+
+    def summary(name: str) -> Dict[str, Any]:
+        run = runs[name]
+        recalls = [r for q, row in zip(questions, run['rows']) if (r := _term_recall(q, row['texts'])) is not None]
+        latencies = sorted(row['latency_ms'] for row in run['rows'])
+        return {
+            'collection': name,
+            'embedding_model': run['model'],
+            'chunks': run['count'],
+            'term_recall': round(sum(recalls) / len(recalls), 4) if recalls else None,
+            'empty_results': sum(1 for row in run['rows'] if not row['texts']),
+            'p50_latency_ms': round(latencies[len(latencies) // 2], 3) if latencies else None
+        }
+
+    report = {'questions': len(questions), 'k': k, 'tolerance': tolerance, 'candidate': summary(candidate)}
+    reasons = []
+    if report['candidate']['empty_results']:
+        reasons.append(f"{report['candidate']['empty_results']} questions returned no chunks")
+
+    if len(names) > 1:
+        report['baseline'] = summary(baseline)
+        agreement = []
+        for new, old in zip(runs[candidate]['rows'], runs[baseline]['rows']):
+            union = set(new['doc_ids']) | set(old['doc_ids'])
+            agreement.append(len(set(new['doc_ids']) & set(old['doc_ids'])) / len(union) if union else 1.0)
+        report['doc_agreement'] = round(sum(agreement) / len(agreement), 4) if agreement else None
+
+        new_recall, old_recall = report['candidate']['term_recall'], report['baseline']['term_recall']
+        if new_recall is not None and old_recall is not None and new_recall < old_recall - tolerance:
+            reasons.append(f"term recall {new_recall:.3f} is below serving index {old_recall:.3f} - {tolerance}")
+
+    report['passed'] = not reasons
+    report['reasons'] = reasons
+    return report
+
+
+class PointerMonitor:
+    def __init__(self, rag, interval: float = 5.0, on_swap: Optional[Callable[[str], Any]] = None):
+        """
+        Polls the index pointer and switches the serving pipeline after a swap or rollback.
+
+        Args:
+            rag: RAGPipeline to switch (see RAGPipeline.reload_index)
+            interval: Seconds between pointer checks
+            on_swap: Called with the new collection name after a switch
+        """
+        self.rag = rag
+        self.interval = interval
+        self.on_swap = on_swap
+        self.swaps = 0
+        self.last_swap = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, rag, on_swap: Optional[Callable[[str], Any]] = None) -> "PointerMonitor":
+        return cls(rag, interval=float(os.getenv("INDEX_POINTER_INTERVAL", "5")), on_swap=on_swap)
+
+    def check(self) -> bool:
+        """Switch now if the pointer changed; returns True after a switch."""
+        if not self.rag.reload_index():
+            return False
+        self.swaps += 1
+        self.last_swap = {'collection': self.rag.collection.name, 'at': time.time()}
+        if self.on_swap is not None:
+            self.on_swap(self.rag.collection.name)
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                # Keep serving the current index; the swap is retried on the next check
+                print(f"⚠️  Index switch failed: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="index-pointer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'active': self.rag.collection.name,
+            'previous': self.rag.index_pointer.previous(DEFAULT_TENANT),
+            'embedding_model': self.rag.model_for(self.rag.collection),
+            'swaps': self.swaps,
+            'last_swap': self.last_swap
+        }
+
+
+def _client(db_path: str):
+    import chromadb
+    from chromadb.config import Settings
+
+    return chromadb.PersistentClient(
+        path=db_path,
+        settings=Settings(anonymized_telemetry=False, allow_reset=True)
+    )
+
+
+def _load_questions(path: str) -> List[Dict[str, Any]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _print_report(report: Dict[str, Any]):
+    for role in ('baseline', 'candidate'):
+        if role in report:
+            row = report[role]
+            print(f"  {role:<9} {row['collection']:<40} model={row['embedding_model']} chunks={row['chunks']} "
+                  f"term_recall={row['term_recall']} empty={row['empty_results']} p50={row['p50_latency_ms']}ms")
+    if 'doc_agreement' in report:
+        print(f"  document agreement: {report['doc_agreement']}")
+    print("✅ Validation passed" if report['passed'] else f"❌ Validation failed: {'; '.join(report['reasons'])}")
+
+
+def main():
+    """Rebuild, validate, promote or roll back a tenant's index."""
+    parser = argparse.ArgumentParser(description="Blue/green index rebuilds")
+    parser.add_argument('--db-path', default=os.getenv("CHROMA_DB_PATH", "chroma_db"))
+    parser.add_argument('--tenant', default=DEFAULT_TENANT)
+    parser.add_argument('--questions', default="eval_questions.json")
+    parser.add_argument('-k', type=int, default=int(os.getenv("TOP_K", "5")))
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help="Allowed drop in expected-term recall versus the serving index")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild', help="Build a shadow collection and validate it")
+    rebuild.add_argument('--docs', default="documents")
+    rebuild.add_argument('--embedding-model', default=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+    rebuild.add_argument('--chunk-size', type=int, default=500)
+    rebuild.add_argument('--chunk-overlap', type=int, default=50)
+    rebuild.add_argument('--promote', action='store_true', help="Swap to the build if validation passes")
+
+    validate_cmd = commands.add_parser('validate', help="Compare a collection with the serving one")
+    validate_cmd.add_argument('collection')
+
+    promote = commands.add_parser('promote', help="Validate and swap to a collection")
+    promote.add_argument('collection')
+    promote.add_argument('--force', action='store_true', help="Swap even if validation fails")
+
+    commands.add_parser('rollback', help="Swap back to the previous collection")
+    commands.add_parser('status', help="Show serving and build collections")
+
+    cleanup = commands.add_parser('cleanup', help="Delete builds that are neither serving nor the rollback target")
+    cleanup.add_argument('--yes', action='store_true', help="Actually delete")
+
+    args = parser.parse_args()
+    tenant = validate_tenant(args.tenant)
+    pointer = IndexPointer(args.db_path)
+
+    if args.command == 'rollback':
+        restored = pointer.rollback(tenant)
+        print(f"⏪ Tenant '{tenant}' now served by {restored}; running servers switch within INDEX_POINTER_INTERVAL")
+        return 0
+
+    if args.command == 'status':
+        client = _client(args.db_path)
+        active, previous = pointer.active(tenant), pointer.previous(tenant)
+        for collection in client.list_collections():
+            if collection.name == collection_name(tenant) or is_build_of(collection.name, tenant):
+                metadata = collection.metadata or {}
+                role = 'serving' if collection.name == active else 'rollback' if collection.name == previous else ''
+                print(f"{collection.name:<50} {role:<9} model={metadata.get('embedding_model', '?')} "
+                      f"chunk_size={metadata.get('chunk_size', '?')} overlap={metadata.get('chunk_overlap', '?')} "
+                      f"chunks={collection.count()}")
+        return 0
+
+    if args.command == 'cleanup':
+        client = _client(args.db_path)
+        keep = {pointer.active(tenant), pointer.previous(tenant)}
+        stale = [c.name for c in client.list_collections() if is_build_of(c.name, tenant) and c.name not in keep]
+        for name in stale:
+            if args.yes:
+                client.delete_collection(name=name)
+                if os.path.exists(centroids_path(args.db_path, name)):
+                    os.remove(centroids_path(args.db_path, name))
+            print(f"{'🗑️  Deleted' if args.yes else 'Would delete'} {name}")
+        return 0
+
+    questions = _load_questions(args.questions)
+
+    if args.command == 'rebuild':
+        from ingest import DocumentIngestion
+
+        name = build_collection_name(tenant)
+        print(f"🏗️  Building {name} (model={args.embedding_model}, chunk_size={args.chunk_size}, "
+              f"overlap={args.chunk_overlap})")
+        ingestion = DocumentIngestion(
+            docs_path=args.docs,
+            db_path=args.db_path,
+            embedding_model=args.embedding_model,
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+            tenant=tenant,
+            collection=name
+        )
+        ingestion.ingest_documents()
+        client = ingestion.client
+    else:
+        name = args.collection
+        client = _client(args.db_path)
+
+    # First build of a tenant: nothing serving yet to compare with
+    baseline = pointer.active(tenant)
+    if baseline not in {c.name for c in client.list_collections()}:
+        baseline = None
+    report = validate(client, name, baseline, questions, k=args.k, tolerance=args.tolerance)
+    _print_report(report)
+
+    if args.command == 'promote' or (args.command == 'rebuild' and args.promote):
+        if not report['passed'] and not getattr(args, 'force', False):
+            print(f"Not promoting {name}")
+            return 1
+        entry = pointer.activate(name, tenant)
+        print(f"🔀 Tenant '{tenant}' now served by {name} (rollback target: {entry.get('previous')})")
+    return 0 if report['passed'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
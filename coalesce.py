@@ -0,0 +1,88 @@
+"""
+Single-flight request coalescing.
+Concurrent callers with the same key share one in-flight execution and all receive its result.
+"""
+
+import re
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question for coalescing (case, whitespace, trailing punctuation)."""
+    normalized = re.sub(r'\s+', ' ', question.strip().lower())
+    return normalized.rstrip('?!. ')
+
+
+class _Call:
+    """One in-flight execution shared by a leader and its followers."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        """Initialize an empty per-process single-flight group."""
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.stats = {'executions': 0, 'coalesced': 0, 'errors': 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Run fn once per key among concurrent callers.
+
+        Args:
+            key: Identity of the work (callers with equal keys are coalesced)
+            fn: Zero-argument callable doing the work
+
+        Returns:
+            (result, shared) where shared is True for callers that joined an
+            execution started by another caller. Exceptions raised by fn are
+            re-raised in every caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.stats['executions'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result, call.followers > 0
+
+    def info(self) -> Dict[str, Any]:
+        """Return coalescing counters and the number of in-flight keys."""
+        with self._lock:
+            total = self.stats['executions'] + self.stats['coalesced']
+            return {
+                **self.stats,
+                'in_flight': len(self._calls),
+                'requests': total,
+                'coalesced_ratio': self.stats['coalesced'] / total if total else 0.0
+            }
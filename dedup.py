@@ -0,0 +1,202 @@
+"""
+Near-duplicate chunk detection.
+MinHash signatures over word shingles estimate the Jaccard similarity of two chunks; LSH banding
+only compares chunks that share a band bucket, so detection across the corpus stays far below
+all-pairs cost. Duplicates of boilerplate (contact blocks, approval sections) are collapsed or
+tagged at ingestion.
+"""
+
+import os
+import re
+import zlib
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+DEDUP_MODES = ('off', 'tag', 'collapse')
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD = re.compile(r"\w+")
+
+
+def lsh_params(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Bands and rows per band for a similarity threshold.
+
+    Picks the highest S-curve midpoint (1/bands)^(1/rows) not above the threshold: pairs at the
+    threshold are then very likely to share a bucket, and candidates below it are rejected by
+    comparing signatures.
+    """
+    best = (1, num_perm)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows == 0 and (1.0 / (num_perm // rows)) ** (1.0 / rows) <= threshold:
+            best = (num_perm // rows, rows)
+    return best
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        """
+        MinHash signatures of word shingles.
+
+        Args:
+            num_perm: Hash permutations (signature length); more lowers the estimate's variance
+            shingle_size: Words per shingle
+            seed: Permutation seed (signatures are only comparable with the same seed)
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return [" ".join(words)]
+        return [" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in set(self.shingles(text))], dtype=np.uint64)
+        # Universal hashing (a*x + b) mod p per permutation; uint64 wrap-around is part of the hash
+        with np.errstate(over='ignore'):
+            permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME
+        return (permuted & _MAX_HASH).min(axis=0)
+
+    @staticmethod
+    def similarity(a: np.ndarray, b: np.ndarray) -> float:
+        """Estimated Jaccard similarity of two signatures."""
+        return float(np.mean(a == b))
+
+
+class NearDuplicateDetector:
+    def __init__(self,
+                 mode: str = "tag",
+                 threshold: float = 0.8,
+                 num_perm: int = 128,
+                 shingle_size: int = 5):
+        """
+        Streaming near-duplicate detector: each chunk is compared with the chunks seen before it.
+
+        Args:
+            mode: 'collapse' (store the first copy only), 'tag' (store all, mark copies) or 'off'
+            threshold: Estimated Jaccard similarity above which chunks are near-duplicates
+            num_perm: MinHash signature length
+            shingle_size: Words per shingle
+        """
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unsupported dedup mode: {mode} (choose from {', '.join(DEDUP_MODES)})")
+        self.mode = mode
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self.bands, self.rows = lsh_params(num_perm, threshold)
+
+        self._signatures = {}
+        self._buckets = [defaultdict(list) for _ in range(self.bands)]
+        self.duplicates = defaultdict(list)
+        self.stats = {'chunks': 0, 'near_duplicates': 0, 'candidate_pairs': 0, 'minhash_seconds': 0.0}
+
+    @classmethod
+    def from_env(cls, mode: Optional[str] = None) -> "NearDuplicateDetector":
+        """Build a detector from INGEST_DEDUP / DEDUP_* environment variables."""
+        return cls(
+            mode=mode or os.getenv("INGEST_DEDUP", "tag"),
+            threshold=float(os.getenv("DEDUP_THRESHOLD", "0.8")),
+            num_perm=int(os.getenv("DEDUP_NUM_PERM", "128"))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def check(self, chunk_id: str, text: str) -> Optional[str]:
+        """
+        Look up a chunk among the chunks seen so far.
+
+        Returns:
+            Id of the first-seen chunk it duplicates, or None (the chunk is then indexed)
+        """
+        start = time.perf_counter()
+        signature = self.hasher.signature(text)
+        self.stats['chunks'] += 1
+
+        candidates = set()
+        for band, key in self._band_keys(signature):
+            candidates.update(self._buckets[band].get(key, ()))
+        self.stats['candidate_pairs'] += len(candidates)
+
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = self.hasher.similarity(signature, self._signatures[candidate])
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+
+        if best is not None:
+            self.duplicates[best].append(chunk_id)
+            self.stats['near_duplicates'] += 1
+        else:
+            # Only first copies are indexed, so every copy points at the same canonical chunk
+            self._signatures[chunk_id] = signature
+            for band, key in self._band_keys(signature):
+                self._buckets[band][key].append(chunk_id)
+        self.stats['minhash_seconds'] += time.perf_counter() - start
+        return best
+
+    def forget(self, chunk_ids: set):
+        """Drop chunks that were not stored after all (e.g. their document failed to ingest)."""
+        for chunk_id in chunk_ids:
+            signature = self._signatures.pop(chunk_id, None)
+            if signature is not None:
+                for band, key in self._band_keys(signature):
+                    self._buckets[band][key].remove(chunk_id)
+            copies = self.duplicates.pop(chunk_id, [])
+            self.stats['near_duplicates'] -= len(copies)
+        for canonical in list(self.duplicates):
+            kept = [copy for copy in self.duplicates[canonical] if copy not in chunk_ids]
+            self.stats['near_duplicates'] -= len(self.duplicates[canonical]) - len(kept)
+            self.duplicates[canonical] = kept
+
+    def report(self, embed_seconds_per_chunk: float, dimension: int, text_bytes_per_chunk: float) -> Dict[str, Any]:
+        """
+        Detection summary and the embedding time and index size duplicates cost (or saved).
+
+        Args:
+            embed_seconds_per_chunk: Measured mean embedding time per chunk
+            dimension: Embedding dimension
+            text_bytes_per_chunk: Mean stored text size per chunk
+        """
+        from tenants import estimate_chroma_bytes
+
+        copies = self.stats['near_duplicates']
+        savings = {
+            'embeddings': copies,
+            'embed_seconds': round(copies * embed_seconds_per_chunk, 3),
+            'index_bytes': int(estimate_chroma_bytes(copies, dimension) + copies * text_bytes_per_chunk)
+        }
+        chunks = self.stats['chunks']
+        return {
+            'mode': self.mode,
+            'threshold': self.threshold,
+            'num_perm': self.hasher.num_perm,
+            'bands': self.bands,
+            'rows': self.rows,
+            'chunks': chunks,
+            'near_duplicates': copies,
+            'duplicate_groups': sum(1 for group in self.duplicates.values() if group),
+            # Comparisons actually made versus all pairs
+            'candidate_pairs': self.stats['candidate_pairs'],
+            'all_pairs': chunks * (chunks - 1) // 2,
+            'minhash_seconds': round(self.stats['minhash_seconds'], 3),
+            # Realized when collapsing; what collapsing would save when tagging
+            'saved' if self.mode == 'collapse' else 'collapsible': savings,
+            'examples': [{'chunk_id': canonical, 'copies': group[:3]}
+                         for canonical, group in list(self.duplicates.items()) if group][:5]
+        }
@@ -0,0 +1,192 @@
+"""
+Live document watching.
+Polls the documents directory, debounces bursts of edits, re-parses and re-embeds only the
+affected files in a background thread, applies the changes to the running server's collection
+and stamps a new index version so version-keyed caches refresh.
+"""
+
+import os
+import time
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Kept in sync with ingest.SUPPORTED_EXTENSIONS (not imported: ingest pulls in the embedding stack)
+WATCHED_EXTENSIONS = ('.md', '.txt', '.pdf', '.html', '.htm')
+
+# Changing tags re-syncs every document (metadata only, nothing is re-embedded)
+TAGS_FILE = "tags.json"
+
+
+class DocumentWatcher:
+    def __init__(self,
+                 docs_path: str,
+                 indexer_factory: Callable[[], Any],
+                 interval: float = 2.0,
+                 debounce: float = 1.0,
+                 on_change: Optional[Callable[[str], Any]] = None):
+        """
+        Initialize document watcher.
+
+        Args:
+            docs_path: Directory to watch
+            indexer_factory: Builds the DocumentIngestion that applies changes (called on first change)
+            interval: Seconds between directory scans
+            debounce: Quiet period after the last change before syncing (editors save in bursts)
+            on_change: Called with the new index version after a sync
+        """
+        self.docs_path = Path(docs_path)
+        self.indexer_factory = indexer_factory
+        self.interval = interval
+        self.debounce = debounce
+        self.on_change = on_change
+
+        self._indexer = None
+        self._applied = self.scan()
+        self._latest = self._applied
+        self._last_change = None
+        # Set by retarget() on the swapping thread, applied by poll() between syncs
+        self._retarget = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'syncs': 0, 'errors': 0}
+        self.last_sync = None
+
+    @classmethod
+    def from_env(cls, rag, on_change: Optional[Callable[[str], Any]] = None) -> "DocumentWatcher":
+        """Watch DOCS_PATH and apply changes to the server's serving collection and its model."""
+        docs_path = os.getenv("DOCS_PATH", "documents")
+
+        def indexer_factory():
+            from ingest import DocumentIngestion
+
+            return DocumentIngestion(
+                docs_path=docs_path,
+                db_path=rag.db_path,
+                embedding_model=rag.embedding_model_name,
+                model=rag._load_embedding_model(),
+                client=rag._chroma_client(),
+                collection=rag.collection.name,
+                # No page-extraction process pool inside the web server
+                workers=1
+            )
+
+        return cls(docs_path, indexer_factory,
+                   interval=float(os.getenv("WATCH_INTERVAL", "2")),
+                   debounce=float(os.getenv("WATCH_DEBOUNCE", "1")),
+                   on_change=on_change)
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        """Modification time and size of every watched file."""
+        snapshot = {}
+        if not self.docs_path.is_dir():
+            return snapshot
+        for entry in os.scandir(self.docs_path):
+            name = entry.name
+            if entry.is_file() and (name == TAGS_FILE or os.path.splitext(name)[1].lower() in WATCHED_EXTENSIONS):
+                stat = entry.stat()
+                snapshot[name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def pending(self) -> Dict[str, list]:
+        """Files changed or removed since the last sync."""
+        changed = [name for name, state in self._latest.items() if self._applied.get(name) != state]
+        removed = [name for name in self._applied if name not in self._latest]
+        return {'changed': sorted(changed), 'removed': sorted(removed)}
+
+    def poll(self) -> bool:
+        """
+        Scan once and sync if changes have been quiet for the debounce period.
+
+        Returns:
+            True if a sync ran
+        """
+        snapshot = self.scan()
+        now = time.monotonic()
+        if self._retarget.is_set():
+            self._retarget.clear()
+            self._indexer = None
+            self._applied = {}
+            self._last_change = now
+        if snapshot != self._latest:
+            self._latest = snapshot
+            self._last_change = now
+
+        if self._latest == self._applied or now - (self._last_change or 0) < self.debounce:
+            return False
+        self.sync()
+        return True
+
+    def sync(self):
+        """Apply pending changes to the index and bump its version."""
+        snapshot = self._latest
+        pending = self.pending()
+        if TAGS_FILE in pending['changed'] + pending['removed']:
+            changed = [name for name in snapshot if name != TAGS_FILE]
+        else:
+            changed = pending['changed']
+        removed = [name for name in pending['removed'] if name != TAGS_FILE]
+
+        start = time.perf_counter()
+        if self._indexer is None:
+            self._indexer = self.indexer_factory()
+        counts = self._indexer.sync_files([self.docs_path / name for name in changed],
+                                          [self.docs_path / name for name in removed])
+        version = self._indexer.stamp_index_version()
+        self._indexer.write_scope_centroids()
+        self._applied = snapshot
+
+        self.stats['syncs'] += 1
+        self.last_sync = {
+            'changed': changed,
+            'removed': removed,
+            **counts,
+            'index_version': version,
+            'seconds': round(time.perf_counter() - start, 2),
+            'finished_at': time.time()
+        }
+        print(f"📚 Re-indexed {len(changed)} changed / {len(removed)} removed documents in "
+              f"{self.last_sync['seconds']}s ({counts['embedded']} chunks embedded); index {version}")
+
+        if self.on_change is not None:
+            self.on_change(version)
+
+    def retarget(self):
+        """
+        Write to the server's new collection after an index swap.
+
+        Every document is re-synced into it (only chunks the rebuild missed are embedded).
+        Only flags the switch: the next poll applies it, so a sync already running against
+        the old collection cannot overwrite the reset when it finishes.
+        """
+        self._retarget.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                # Keep the old snapshot applied so the change is retried on the next scan
+                self.stats['errors'] += 1
+                print(f"⚠️  Document re-index failed: {e}")
+
+    def start(self):
+        """Watch in a background thread; queries keep running against the live index."""
+        self._thread = threading.Thread(target=self._run, name="document-watcher", daemon=True)
+        self._thread.start()
+        print(f"👀 Watching {self.docs_path} for document changes")
+
+    def stop(self):
+        self._stop.set()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'docs_path': str(self.docs_path),
+            'interval_s': self.interval,
+            'debounce_s': self.debounce,
+            'documents': len([name for name in self._applied if name != TAGS_FILE]),
+            'pending': self.pending(),
+            'retarget_pending': self._retarget.is_set(),
+            'last_sync': self.last_sync,
+            **self.stats
+        }
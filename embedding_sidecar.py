@@ -0,0 +1,456 @@
+"""
+Shared embedding and vector-search sidecar.
+One local process owns the SentenceTransformer model and the ChromaDB collection and serves
+embed + search requests over a Unix domain socket. Concurrent requests are collected into
+micro-batches so the model encodes many queries in one forward pass.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from concurrent.futures import Future
+from typing import List, Dict, Any, Optional, Callable
+
+# Disable ChromaDB telemetry to prevent production errors
+os.environ["ANONYMIZED_TELEMETRY"] = "False"
+os.environ["CHROMA_TELEMETRY"] = "False"
+
+# Force ONNX to use CPU only to prevent GPU warnings
+os.environ["ORT_DEVICE"] = "CPU"
+
+
+_HEADER = struct.Struct("!I")
+
+
+def send_message(sock: socket.socket, payload: Dict[str, Any]):
+    """Send one length-prefixed JSON message."""
+    body = json.dumps(payload).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> Optional[bytes]:
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            return None
+        data.extend(part)
+    return bytes(data)
+
+
+def recv_message(sock: socket.socket) -> Optional[Dict[str, Any]]:
+    """Receive one length-prefixed JSON message (None when the peer closed)."""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    body = _recv_exact(sock, _HEADER.unpack(header)[0])
+    if body is None:
+        return None
+    return json.loads(body)
+
+
+class MicroBatcher:
+    def __init__(self,
+                 handler: Callable[[List[Any]], List[Any]],
+                 window_ms: float = 5.0,
+                 max_batch: int = 32):
+        """
+        Collect concurrent items into batches for one handler call.
+
+        Args:
+            handler: Function mapping a list of items to a list of results (an Exception as
+                     an item's result fails only that item)
+            window_ms: Time to wait for more items after the first one arrives
+            max_batch: Largest batch handed to the handler
+        """
+        self.handler = handler
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.stats = {'items': 0, 'batches': 0, 'max_batch_seen': 0, 'split_batches': 0}
+        self._thread = threading.Thread(target=self._run, daemon=True, name="micro-batcher")
+        self._thread.start()
+
+    def _enqueue(self, item: Any) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit(self, item: Any) -> Any:
+        """Queue an item and block until its result is available."""
+        return self._enqueue(item).result()
+
+    def submit_many(self, items: List[Any]) -> List[Any]:
+        """Queue several items at once so they can share a batch."""
+        futures = [self._enqueue(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            with self._lock:
+                self.stats['items'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['max_batch_seen'] = max(self.stats['max_batch_seen'], len(batch))
+
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: List[Any]):
+        """Run the handler on a batch and resolve its futures."""
+        try:
+            results = self.handler([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One bad item must not fail the unrelated items batched with it: retry each alone
+            with self._lock:
+                self.stats['split_batches'] += 1
+            for entry in batch:
+                self._dispatch([entry])
+            return
+
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        # A short result list would otherwise leave the remaining callers waiting forever
+        for _, future in batch[len(results):]:
+            future.set_exception(RuntimeError(
+                f"Batch handler returned {len(results)} results for {len(batch)} items"))
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['mean_batch_size'] = stats['items'] / stats['batches'] if stats['batches'] else 0.0
+        stats['window_ms'] = self.window * 1000.0
+        stats['max_batch'] = self.max_batch
+        return stats
+
+
+class EmbeddingSidecar:
+    def __init__(self,
+                 socket_path: str,
+                 db_path: str = "chroma_db",
+                 embedding_model: str = "all-MiniLM-L6-v2",
+                 collection_name: str = "company_policies",
+                 window_ms: float = 5.0,
+                 max_batch: int = 32):
+        """
+        Initialize sidecar server.
+
+        Args:
+            socket_path: Unix domain socket to listen on
+            db_path: Path to ChromaDB
+            embedding_model: Sentence-transformers model name
+            collection_name: Collection served for search requests
+            window_ms: Micro-batching window
+            max_batch: Maximum queries encoded per forward pass
+        """
+        import chromadb
+        from chromadb.config import Settings
+        from sentence_transformers import SentenceTransformer
+
+        self.socket_path = socket_path
+        print(f"⏳ Loading embedding model: {embedding_model}")
+        self.model = SentenceTransformer(embedding_model, device='cpu')
+        self.model.eval()
+
+        client = chromadb.PersistentClient(
+            path=db_path,
+            settings=Settings(anonymized_telemetry=False, allow_reset=True)
+        )
+        self.collection = client.get_collection(name=collection_name)
+        print(f"✅ Serving collection '{collection_name}' with {self.collection.count()} chunks")
+
+        self.batcher = MicroBatcher(self._process_batch, window_ms=window_ms, max_batch=max_batch)
+        self._server = None
+
+    def _process_batch(self, items: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Encode all texts in one pass, then run one batched vector search per filter.
+
+        Searches that bring their own embedding skip encoding. A failing search (e.g. an
+        invalid filter) fails only the items that share its filter.
+        """
+        embeddings = [item.get('embedding') for item in items]
+        to_encode = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if to_encode:
+            encoded = self.model.encode([items[i]['text'] for i in to_encode]).tolist()
+            for i, embedding in zip(to_encode, encoded):
+                embeddings[i] = embedding
+        results = [None] * len(items)
+
+        # One batched query per distinct filter (Chroma applies a single `where` per call)
+        groups = {}
+        for i, item in enumerate(items):
+            if item['op'] == 'search':
+                groups.setdefault(json.dumps(item.get('where'), sort_keys=True), []).append(i)
+
+        for search_positions in groups.values():
+            n_results = max(items[i]['n_results'] for i in search_positions)
+            where = items[search_positions[0]].get('where')
+            search_kwargs = {'where': where} if where else {}
+            try:
+                found = self.collection.query(
+                    query_embeddings=[embeddings[i] for i in search_positions],
+                    n_results=n_results,
+                    **search_kwargs
+                )
+            except Exception as e:
+                for i in search_positions:
+                    results[i] = e
+                continue
+            for row, i in enumerate(search_positions):
+                k = items[i]['n_results']
+                results[i] = {
+                    'ids': found['ids'][row][:k],
+                    'documents': found['documents'][row][:k],
+                    'metadatas': found['metadatas'][row][:k],
+                    'distances': found['distances'][row][:k]
+                }
+
+        for i, item in enumerate(items):
+            if item['op'] == 'embed':
+                results[i] = embeddings[i]
+
+        return results
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Answer one client request."""
+        op = request.get('op')
+        if op == 'search':
+            return {'result': self.batcher.submit({
+                'op': 'search',
+                'text': request.get('query'),
+                'embedding': request.get('embedding'),
+                'n_results': int(request.get('n_results', 5)),
+                'where': request.get('where')
+            })}
+        if op == 'embed':
+            return {'result': self.batcher.submit_many(
+                [{'op': 'embed', 'text': text} for text in request['texts']]
+            )}
+        if op == 'stats':
+            return {'result': self.batcher.info()}
+        return {'error': f"Unknown op: {op}"}
+
+    def serve_forever(self):
+        sidecar = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    request = recv_message(self.request)
+                    if request is None:
+                        return
+                    try:
+                        response = sidecar.handle(request)
+                    except Exception as e:
+                        response = {'error': f"{type(e).__name__}: {e}"}
+                    send_message(self.request, response)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        print(f"🚀 Embedding sidecar listening on {self.socket_path}")
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class SidecarError(RuntimeError):
+    """Raised when the sidecar reports an error or cannot be reached."""
+
+
+class SidecarClient:
+    def __init__(self, socket_path: str, timeout: float = 10.0):
+        """
+        Thin client for the embedding sidecar (one connection per thread).
+
+        Args:
+            socket_path: Unix domain socket of the sidecar
+            timeout: Socket timeout in seconds
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> socket.socket:
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        return sock
+
+    def _call(self, request: Dict[str, Any]) -> Any:
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_message(sock, request)
+                response = recv_message(sock)
+                if response is None:
+                    raise ConnectionError("Sidecar closed the connection")
+                break
+            except OSError as e:
+                # Reconnect once (e.g. after a sidecar restart)
+                sock, self._local.sock = getattr(self._local, 'sock', None), None
+                if sock is not None:
+                    sock.close()
+                if attempt == 1:
+                    raise SidecarError(f"Embedding sidecar unavailable at {self.socket_path}: {e}")
+
+        if 'error' in response:
+            raise SidecarError(response['error'])
+        return response['result']
+
+    def search(self, query: str, n_results: int = 5,
+               where: Optional[Dict[str, Any]] = None,
+               embedding: Optional[List[float]] = None) -> Dict[str, List[Any]]:
+        """
+        Search the collection (one Chroma-style result row).
+
+        Args:
+            query: Text to embed and search for
+            n_results: Number of results
+            where: Chroma metadata filter
+            embedding: Precomputed embedding of query (the sidecar model's), skips encoding
+        """
+        request = {'op': 'search', 'query': query, 'n_results': n_results, 'where': where}
+        if embedding is not None:
+            request['embedding'] = [float(x) for x in embedding]
+        return self._call(request)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return self._call({'op': 'embed', 'texts': texts})
+
+    def stats(self) -> Dict[str, Any]:
+        return self._call({'op': 'stats'})
+
+
+def benchmark(socket_path: str, db_path: str, embedding_model: str,
+              questions: List[str], concurrency: int = 8, rounds: int = 5) -> Dict[str, Any]:
+    """
+    Compare one-query-at-a-time encoding with micro-batched sidecar search.
+
+    Returns:
+        Queries per second for both modes and the observed batch sizes
+    """
+    import chromadb
+    from chromadb.config import Settings
+    from sentence_transformers import SentenceTransformer
+
+    workload = questions * rounds
+
+    # Baseline: what each worker does today (encode([query]) per request)
+    model = SentenceTransformer(embedding_model, device='cpu')
+    collection = chromadb.PersistentClient(
+        path=db_path, settings=Settings(anonymized_telemetry=False, allow_reset=True)
+    ).get_collection(name="company_policies")
+    start = time.perf_counter()
+    for question in workload:
+        embedding = model.encode([question])[0].tolist()
+        collection.query(query_embeddings=[embedding], n_results=5)
+    baseline_seconds = time.perf_counter() - start
+
+    # Sidecar: concurrent thin clients sharing micro-batches
+    client = SidecarClient(socket_path)
+    work = queue.Queue()
+    for question in workload:
+        work.put(question)
+
+    def drain():
+        while True:
+            try:
+                question = work.get_nowait()
+            except queue.Empty:
+                return
+            client.search(question, 5)
+
+    before = client.stats()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=drain) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sidecar_seconds = time.perf_counter() - start
+    after = client.stats()
+
+    batches = after['batches'] - before['batches']
+    return {
+        'queries': len(workload),
+        'concurrency': concurrency,
+        'baseline_qps': len(workload) / baseline_seconds,
+        'sidecar_qps': len(workload) / sidecar_seconds,
+        'speedup': baseline_seconds / sidecar_seconds,
+        'mean_batch_size': (after['items'] - before['items']) / batches if batches else 0.0
+    }
+
+
+def main():
+    """Run the sidecar or its throughput benchmark."""
+    parser = argparse.ArgumentParser(description="Embedding/search sidecar")
+    parser.add_argument('command', choices=['serve', 'benchmark'])
+    parser.add_argument('--socket', default=os.getenv("EMBEDDING_SIDECAR_SOCKET", "/tmp/rag-embed.sock"))
+    parser.add_argument('--db-path', default=os.getenv("CHROMA_DB_PATH", "chroma_db"))
+    parser.add_argument('--embedding-model', default=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+    parser.add_argument('--window-ms', type=float, default=float(os.getenv("SIDECAR_WINDOW_MS", "5")))
+    parser.add_argument('--max-batch', type=int, default=int(os.getenv("SIDECAR_MAX_BATCH", "32")))
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        from blue_green import IndexPointer
+
+        # Serves the collection active at startup; restart the sidecar after a blue/green swap
+        EmbeddingSidecar(
+            socket_path=args.socket,
+            db_path=args.db_path,
+            embedding_model=args.embedding_model,
+            collection_name=IndexPointer(args.db_path).active(),
+            window_ms=args.window_ms,
+            max_batch=args.max_batch
+        ).serve_forever()
+        return
+
+    with open('eval_questions.json', 'r', encoding='utf-8') as f:
+        questions = [q['question'] for q in json.load(f)]
+
+    result = benchmark(args.socket, args.db_path, args.embedding_model,
+                       questions, concurrency=args.concurrency)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
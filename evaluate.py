@@ -6,13 +6,42 @@ Measures groundedness, citation accuracy, and latency.
 import os
 import json
 import time
+import argparse
 import statistics
 from typing import List, Dict, Any, Tuple
-from rag import RAGPipeline
+from rag import GenerationError, RAGPipeline
+from llm_cache import LLMResponseCache
+from extractive import ExtractiveAnswerer
+from adaptive_k import AdaptiveTopK
+from scope_gate import SCOPE_GATE_PATH, ScopeGate, calibrate
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Questions the assistant must refuse, scored against the policy questions to calibrate the scope gate
+OFF_DOMAIN_QUESTIONS = [
+    "What is the weather today?",
+    "Who won the World Cup in 2018?",
+    "How do I bake sourdough bread?",
+    "What is the capital of Australia?",
+    "Can you recommend a good movie to watch tonight?",
+    "How do I fix a flat bicycle tire?",
+    "What is the price of Bitcoin?",
+    "Write me a poem about the ocean.",
+    "How tall is Mount Everest?",
+    "What are the symptoms of the flu?",
+    "Explain quantum entanglement.",
+    "Who is the president of France?",
+    "What's a good recipe for lasagna?",
+    "How many moons does Jupiter have?",
+    "Translate 'good morning' into Spanish.",
+    "What time does the football game start?",
+    "How do I learn to play guitar?",
+    "What is the best programming language?",
+    "Tell me a joke.",
+    "How do I change the oil in my car?",
+]
+
 
 class RAGEvaluator:
     def __init__(self, rag_pipeline: RAGPipeline):
@@ -124,7 +153,8 @@ class RAGEvaluator:
             'exact_match': exact_match,
             'partial_match': partial_match,
             'num_sources': len(sources),
-            'latency_ms': result.get('latency_ms', 0)
+            'latency_ms': result.get('latency_ms', 0),
+            'answer_path': result.get('answer_path', 'llm')
         }
         
         return eval_result
@@ -154,7 +184,11 @@ class RAGEvaluator:
             
             # Query RAG system
             start_time = time.time()
-            result = self.rag.query(question)
+            try:
+                result = self.rag.query(question)
+            except GenerationError as e:
+                # Scored as an unanswered question (replay misses still abort the run)
+                result = {'answer': str(e), 'sources': [], 'question': question, 'num_sources': 0}
             latency_ms = int((time.time() - start_time) * 1000)
             result['latency_ms'] = latency_ms
             
@@ -165,7 +199,7 @@ class RAGEvaluator:
             
             print(f"  ✓ Grounded: {eval_result['grounded']}")
             print(f"  ✓ Citations Accurate: {eval_result['citations_accurate']}")
-            print(f"  ✓ Latency: {latency_ms}ms")
+            print(f"  ✓ Latency: {latency_ms}ms ({eval_result['answer_path']})")
         
         # Calculate aggregate metrics
         grounded_count = sum(1 for r in results if r['grounded'])
@@ -191,6 +225,7 @@ class RAGEvaluator:
                 'count': partial_match_count,
                 'percentage': (partial_match_count / len(questions)) * 100
             },
+            'mean_sources': statistics.mean(r['num_sources'] for r in results),
             'latency': {
                 'p50': statistics.median(latencies),
                 'p95': statistics.quantiles(latencies, n=20)[18] if len(latencies) > 1 else latencies[0],
@@ -198,11 +233,70 @@ class RAGEvaluator:
                 'min': min(latencies),
                 'max': max(latencies)
             },
+            'by_answer_path': self.summarize_by_path(results),
             'detailed_results': results
         }
         
         return summary
     
+    def summarize_by_path(self, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Quality and latency per answer path (extractive fast path vs LLM)."""
+        by_path = {}
+        for path in sorted({r['answer_path'] for r in results}):
+            rows = [r for r in results if r['answer_path'] == path]
+            latencies = [r['latency_ms'] for r in rows]
+            by_path[path] = {
+                'count': len(rows),
+                'share': len(rows) / len(results) * 100,
+                'groundedness': sum(1 for r in rows if r['grounded']) / len(rows) * 100,
+                'citation_accuracy': sum(1 for r in rows if r['citations_accurate']) / len(rows) * 100,
+                'partial_match': sum(1 for r in rows if r['partial_match']) / len(rows) * 100,
+                'latency_p50': statistics.median(latencies),
+                'latency_mean': statistics.mean(latencies)
+            }
+        return by_path
+    
+    def calibrate_scope_gate(self, questions: List[Dict[str, Any]], off_domain: List[str] = OFF_DOMAIN_QUESTIONS,
+                             output_file: str = SCOPE_GATE_PATH) -> Dict[str, Any]:
+        """
+        Calibrate the out-of-scope gate's thresholds (no LLM calls) and save them for the server.
+
+        Args:
+            questions: In-domain evaluation questions (none may be refused)
+            off_domain: Questions that should be refused
+            output_file: Settings file read by ScopeGate.from_env
+        """
+        gate = self.rag.scope_gate or ScopeGate(self.rag.db_path)
+        collection = self.rag.collection_for(None)
+        model_name = self.rag.model_for(collection)
+
+        def score(question: str) -> Dict[str, Any]:
+            embedding = self.rag.embed_query(question, model_name)
+            chunks = self.rag.retrieve(question, 1, query_embedding=embedding)
+            return gate.scores(getattr(collection, 'name', None), embedding, chunks, embedding.model)
+
+        in_scores = [score(q['question']) for q in questions]
+        if all(s['centroid_similarity'] is None for s in in_scores):
+            raise ValueError(f"No scope centroids for {getattr(collection, 'name', None)}; re-run ingest.py first")
+        off_scores = [score(q) for q in off_domain]
+
+        settings = {
+            **calibrate(in_scores, off_scores),
+            'collection': getattr(collection, 'name', None),
+            'embedding_model': model_name,
+            'calibrated_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(settings, f, indent=2)
+
+        print("\n🎯 SCOPE GATE CALIBRATION:")
+        print(f"  Max nearest distance:    {settings['recommended']['max_distance']}")
+        print(f"  Min centroid similarity: {settings['recommended']['min_similarity']}")
+        print(f"  In-domain refused:  {settings['in_domain']['refused']}/{settings['in_domain']['questions']}")
+        print(f"  Off-domain refused: {settings['off_domain']['refused']}/{settings['off_domain']['questions']}")
+        print(f"✅ Settings saved to {output_file}")
+        return settings
+    
     def print_summary(self, summary: Dict[str, Any]):
         """Print evaluation summary in readable format."""
         print("\n" + "="*60)
@@ -220,12 +314,20 @@ class RAGEvaluator:
             print(f"  Partial Match:     {summary['partial_match']['count']}/{summary['total_questions']} ({summary['partial_match']['percentage']:.1f}%)")
         
         print("\n⚡ SYSTEM METRICS:")
+        if 'mean_sources' in summary:
+            print(f"  Sources/Answer: {summary['mean_sources']:.1f}")
         print(f"  Latency P50:  {summary['latency']['p50']:.0f}ms")
         print(f"  Latency P95:  {summary['latency']['p95']:.0f}ms")
         print(f"  Latency Mean: {summary['latency']['mean']:.0f}ms")
         print(f"  Latency Min:  {summary['latency']['min']:.0f}ms")
         print(f"  Latency Max:  {summary['latency']['max']:.0f}ms")
         
+        if len(summary.get('by_answer_path', {})) > 1:
+            print("\n🛤️  BY ANSWER PATH:")
+            for path, row in summary['by_answer_path'].items():
+                print(f"  {path:<10} {row['count']:>3} ({row['share']:.0f}%)  grounded {row['groundedness']:.0f}%  "
+                      f"citations {row['citation_accuracy']:.0f}%  P50 {row['latency_p50']:.0f}ms")
+        
         print("\n" + "="*60)
     
     def save_results(self, summary: Dict[str, Any], output_file: str = "evaluation_results.json"):
@@ -237,6 +339,11 @@ class RAGEvaluator:
 
 def main():
     """Run evaluation."""
+    parser = argparse.ArgumentParser(description="Evaluate the RAG pipeline")
+    parser.add_argument('--calibrate-scope', action='store_true',
+                        help=f"Only calibrate the out-of-scope gate and write {SCOPE_GATE_PATH}")
+    args = parser.parse_args()
+
     # Initialize RAG pipeline
     print("Initializing RAG pipeline...")
     rag = RAGPipeline(
@@ -244,7 +351,11 @@ def main():
         embedding_model="all-MiniLM-L6-v2",
         llm_provider=os.getenv("LLM_PROVIDER", "openrouter"),
         model_name=os.getenv("MODEL_NAME", "meta-llama/llama-3.1-8b-instruct:free"),
-        top_k=5
+        top_k=5,
+        response_cache=LLMResponseCache.from_env(),
+        extractive=ExtractiveAnswerer.from_env(),
+        adaptive_k=AdaptiveTopK.from_env(),
+        scope_gate=ScopeGate.from_env("chroma_db")
     )
     
     # Initialize evaluator
@@ -268,6 +379,10 @@ def main():
             {"question": "How often are performance reviews conducted?"},
         ]
     
+    if args.calibrate_scope:
+        evaluator.calibrate_scope_gate(questions)
+        return
+
     # Run evaluation
     summary = evaluator.run_evaluation(questions)
     
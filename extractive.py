@@ -0,0 +1,189 @@
+"""
+Extractive fast-path answers.
+When retrieval is confident (close top chunk) and one or two sentences of the retrieved chunks
+closely match the question, those sentences are returned with their citation instead of
+generating an answer, which takes milliseconds instead of an LLM round-trip.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# Chunking joins words with single spaces, so list items and numbered sections are split on their
+# markers: sentence punctuation, "- " bullets and section numbers such as "3.1"
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])|\s+[-*•]\s+|\s+(?=\d+(?:\.\d+)+\s)")
+
+
+def split_sentences(text: str, min_words: int = 4, list_items: int = 4) -> List[str]:
+    """
+    Answer-sized sentences of a chunk.
+
+    A list introduction ("Daily Limits (when traveling):") is joined with its first short items.
+    Fragments shorter than min_words are dropped unless they state a number ("Dinner: $50"),
+    so headings don't outscore the sentences under them.
+    """
+    parts = [part.strip(" -*•\t") for line in text.splitlines() for part in _SENTENCE_BREAK.split(line.strip())]
+    parts = [part for part in parts if part]
+
+    sentences = []
+    i = 0
+    while i < len(parts):
+        sentence = parts[i]
+        i += 1
+        if sentence.endswith(':'):
+            items = []
+            while i < len(parts) and len(items) < list_items and len(parts[i].split()) <= 8:
+                items.append(parts[i])
+                i += 1
+            sentence = f"{sentence} {'; '.join(items)}" if items else sentence
+        if len(sentence.split()) >= min_words or any(ch.isdigit() for ch in sentence):
+            sentences.append(sentence)
+    return sentences
+
+
+class ExtractiveAnswerer:
+    def __init__(self,
+                 max_distance: float = 1.4,
+                 min_similarity: float = 0.42,
+                 max_sentences: int = 2,
+                 search_chunks: int = 3,
+                 cache_chunks: int = 2048):
+        """
+        Initialize extractive answering.
+
+        Args:
+            max_distance: Largest distance of the top retrieved chunk for the fast path (in the
+                          collection's HNSW space; the default suits l2 with all-MiniLM-L6-v2)
+            min_similarity: Smallest cosine similarity between question and answer sentence
+            max_sentences: Sentences returned (extra ones must be nearly as similar as the best)
+            search_chunks: Top retrieved chunks searched for answer sentences
+            cache_chunks: Chunks whose sentence embeddings are kept in memory
+        """
+        self.max_distance = max_distance
+        self.min_similarity = min_similarity
+        self.max_sentences = max_sentences
+        self.search_chunks = search_chunks
+        self.cache_chunks = cache_chunks
+        self._sentences = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'extractive': 0, 'llm_fallbacks': 0, 'low_retrieval_confidence': 0,
+                      'low_sentence_similarity': 0}
+
+    @classmethod
+    def from_env(cls) -> Optional["ExtractiveAnswerer"]:
+        """Build from EXTRACTIVE_* environment variables (None when disabled)."""
+        if os.getenv("EXTRACTIVE_ANSWERS", "false").lower() != "true":
+            return None
+        return cls(
+            max_distance=float(os.getenv("EXTRACTIVE_MAX_DISTANCE", "1.4")),
+            min_similarity=float(os.getenv("EXTRACTIVE_MIN_SIMILARITY", "0.42")),
+            max_sentences=int(os.getenv("EXTRACTIVE_MAX_SENTENCES", "2"))
+        )
+
+    def _chunk_sentences(self, chunk: Dict[str, Any], model: str,
+                         embed: Callable[[List[str]], np.ndarray]) -> Tuple[List[str], np.ndarray]:
+        """Sentences of a chunk and their normalized embeddings (cached by chunk id and model)."""
+        key = (model, chunk['chunk_id'])
+        with self._lock:
+            if key in self._sentences:
+                self._sentences.move_to_end(key)
+                return self._sentences[key]
+
+        sentences = split_sentences(chunk['text'])
+        vectors = np.asarray(embed(sentences), dtype=np.float32) if sentences else np.zeros((0, 1), np.float32)
+        if len(sentences):
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            self._sentences[key] = (sentences, vectors)
+            while len(self._sentences) > self.cache_chunks:
+                self._sentences.popitem(last=False)
+        return sentences, vectors
+
+    def answer(self,
+               query_embedding: List[float],
+               chunks: List[Dict[str, Any]],
+               model: str,
+               embed: Callable[[List[str]], np.ndarray]) -> Optional[Dict[str, Any]]:
+        """
+        Extract an answer from retrieved chunks, or None to fall back to the LLM.
+
+        Args:
+            query_embedding: Embedding of the question
+            chunks: Retrieved chunks, best first (their order gives the source numbers)
+            model: Embedding model of query_embedding (keys the sentence cache)
+            embed: Embeds a list of sentences with that model
+
+        Returns:
+            Answer text with [Source N] citations and the scores that admitted it
+        """
+        distance = chunks[0].get('distance') if chunks else None
+        if distance is None or distance > self.max_distance:
+            self._count('low_retrieval_confidence')
+            return None
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        candidates = []
+        for source_num, chunk in enumerate(chunks[:self.search_chunks], 1):
+            sentences, vectors = self._chunk_sentences(chunk, model, embed)
+            if sentences:
+                for sentence, similarity in zip(sentences, vectors @ query):
+                    candidates.append((float(similarity), source_num, sentence))
+        candidates.sort(key=lambda candidate: -candidate[0])
+
+        if not candidates or candidates[0][0] < self.min_similarity:
+            self._count('low_sentence_similarity')
+            return None
+
+        best = candidates[0][0]
+        picked = []
+        for candidate in candidates:
+            # Supporting sentences must be nearly as relevant as the best one (and not repeat it)
+            if len(picked) == self.max_sentences or candidate[0] < max(self.min_similarity, best - 0.05):
+                break
+            if all(candidate[2] != sentence for _, _, sentence in picked):
+                picked.append(candidate)
+        answer = " ".join(f"{sentence.rstrip('.')}. [Source {source_num}]" for _, source_num, sentence in picked)
+        self._count('extractive')
+        return {
+            'answer': answer,
+            'extractive': {
+                'top_distance': round(float(distance), 4),
+                'sentence_similarity': round(best, 4),
+                'sentences': len(picked)
+            }
+        }
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+            if key != 'extractive':
+                self.stats['llm_fallbacks'] += 1
+
+    def memory_bytes(self) -> int:
+        """Approximate size of the sentence cache."""
+        with self._lock:
+            return sum(vectors.nbytes + sum(len(s) for s in sentences)
+                       for sentences, vectors in self._sentences.values())
+
+    def clear_cache(self):
+        """Drop cached sentence embeddings (they are recomputed on demand)."""
+        with self._lock:
+            self._sentences.clear()
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'max_distance': self.max_distance,
+                'min_similarity': self.min_similarity,
+                'max_sentences': self.max_sentences,
+                'cached_chunks': len(self._sentences),
+                **self.stats
+            }
@@ -0,0 +1,141 @@
+"""
+Local fake OpenAI-compatible LLM provider for testing.
+Serves /v1/chat/completions with a configurable base latency and an injected latency tail.
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class FakeLLMServer:
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 base_latency: float = 0.02,
+                 tail_latency: float = 1.0,
+                 tail_probability: float = 0.1,
+                 error_probability: float = 0.0,
+                 answer: str = "This is a fake answer [Source 1].",
+                 seed: Optional[int] = None):
+        """
+        Initialize fake provider.
+
+        Args:
+            host: Interface to bind
+            port: Port to bind (0 picks a free port)
+            base_latency: Seconds added to every request
+            tail_latency: Extra seconds added to tail requests
+            tail_probability: Fraction of requests that hit the latency tail
+            error_probability: Fraction of requests answered with HTTP 500
+            answer: Completion text returned for every request
+            seed: Random seed for reproducible latency patterns
+        """
+        self.base_latency = base_latency
+        self.tail_latency = tail_latency
+        self.tail_probability = tail_probability
+        self.error_probability = error_probability
+        self.answer = answer
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _sample(self):
+        """Pick latency and failure for the next request."""
+        with self._lock:
+            self.requests += 1
+            latency = self.base_latency
+            if self._random.random() < self.tail_probability:
+                latency += self.tail_latency
+            failed = self._random.random() < self.error_probability
+        return latency, failed
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+
+                latency, failed = fake._sample()
+                time.sleep(latency)
+
+                if failed:
+                    body = json.dumps({'error': {'message': 'injected failure'}}).encode()
+                    self.send_response(500)
+                else:
+                    body = json.dumps({
+                        'id': f"fake-{fake.requests}",
+                        'object': 'chat.completion',
+                        'created': int(time.time()),
+                        'model': request.get('model', 'fake'),
+                        'choices': [{
+                            'index': 0,
+                            'message': {'role': 'assistant', 'content': fake.answer},
+                            'finish_reason': 'stop'
+                        }],
+                        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+                    }).encode()
+                    self.send_response(200)
+
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "FakeLLMServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    """Run fake provider in the foreground."""
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible LLM provider")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--base-latency', type=float, default=0.02)
+    parser.add_argument('--tail-latency', type=float, default=1.0)
+    parser.add_argument('--tail-probability', type=float, default=0.1)
+    parser.add_argument('--error-probability', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeLLMServer(port=args.port,
+                           base_latency=args.base_latency,
+                           tail_latency=args.tail_latency,
+                           tail_probability=args.tail_probability,
+                           error_probability=args.error_probability)
+    print(f"🧪 Fake LLM provider listening on {server.base_url}")
+    print(f"   Use LLM_PROVIDER=local LLM_BASE_URL={server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
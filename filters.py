@@ -0,0 +1,71 @@
+"""
+Metadata filters for scoped retrieval.
+Validates user-supplied filters on doc_id, title, format and ingestion-time tags and
+translates them into a ChromaDB `where` clause that is pushed down into the vector search.
+"""
+
+from typing import Any, Dict, List, Optional
+
+
+FILTER_FIELDS = ('doc_id', 'title', 'format', 'tags')
+
+# Tags are stored as one boolean metadata key per tag (Chroma metadata values must be scalars)
+TAG_PREFIX = "tag_"
+
+
+def tag_key(tag: str) -> str:
+    """Metadata key marking a chunk with a tag."""
+    return TAG_PREFIX + tag.strip().lower().replace(' ', '_')
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, List[str]]]:
+    """
+    Validate filters and normalize every value to a sorted list of strings.
+
+    Args:
+        filters: e.g. {"doc_id": "POL-003", "tags": ["finance"]}
+
+    Returns:
+        Normalized filters, or None when no filter is set
+
+    Raises:
+        ValueError: Unknown field or non-string values
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+
+    normalized = {}
+    for field, value in filters.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unsupported filter field: {field} (allowed: {', '.join(FILTER_FIELDS)})")
+        values = value if isinstance(value, list) else [value]
+        if not values or not all(isinstance(v, str) and v.strip() for v in values):
+            raise ValueError(f"Filter '{field}' must be a non-empty string or list of strings")
+        normalized[field] = sorted({v.strip() for v in values})
+
+    return normalized or None
+
+
+def to_chroma_where(filters: Optional[Dict[str, List[str]]]) -> Optional[Dict[str, Any]]:
+    """
+    Build a Chroma `where` clause from normalized filters.
+
+    doc_id/title/format match any of the given values; tags require every given tag.
+    """
+    if not filters:
+        return None
+
+    conditions = []
+    for field, values in filters.items():
+        if field == 'tags':
+            conditions.extend({tag_key(tag): {"$eq": True}} for tag in values)
+        elif len(values) == 1:
+            conditions.append({field: {"$eq": values[0]}})
+        else:
+            conditions.append({field: {"$in": values}})
+
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
@@ -0,0 +1,114 @@
+"""
+Import-time profiling for the serving modules.
+Runs a cold import in a fresh interpreter with `python -X importtime` and breaks the cost
+down per top-level package, so heavy dependencies pulled in at startup are easy to spot.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+from collections import defaultdict
+from typing import Dict, Any, List, Optional
+
+
+# Cold-import budget for app.py enforced by the test suite and `--budget`
+APP_IMPORT_BUDGET_SECONDS = float(os.getenv("APP_IMPORT_BUDGET_SECONDS", "5"))
+
+
+def measure_import(module: str = "app", env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    Cold-import a module in a subprocess and collect per-module import times.
+
+    Args:
+        module: Module to import (e.g. app, rag)
+        env: Extra environment variables for the subprocess
+
+    Returns:
+        Dict with wall-clock seconds, self time per top-level package, cumulative
+        time per top-level package (including the dependencies it imported first)
+        and the raw per-module (self_us, cumulative_us) table
+    """
+    child_env = dict(os.environ)
+    child_env.update(env or {})
+
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=child_env,
+        capture_output=True,
+        text=True
+    )
+    wall_seconds = time.perf_counter() - start
+
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr[-2000:]}")
+
+    modules = {}
+    by_package = defaultdict(float)
+    cumulative = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            self_us, cumulative_us = int(self_us), int(cumulative_us)
+        except ValueError:
+            continue
+        name = name.strip()
+        modules[name] = (self_us, cumulative_us)
+        by_package[name.split(".")[0]] += self_us / 1e6
+        if "." not in name:
+            cumulative[name] = cumulative_us / 1e6
+
+    return {
+        'module': module,
+        'wall_seconds': wall_seconds,
+        'import_seconds': sum(self_us for self_us, _ in modules.values()) / 1e6,
+        'packages': dict(sorted(by_package.items(), key=lambda item: item[1], reverse=True)),
+        'cumulative': dict(sorted(cumulative.items(), key=lambda item: item[1], reverse=True)),
+        'modules': modules
+    }
+
+
+def print_report(profile: Dict[str, Any], top: int = 20):
+    """Print import cost per top-level package."""
+    print("=" * 60)
+    print(f"Cold import of '{profile['module']}'")
+    print("=" * 60)
+    print(f"Wall clock (interpreter + import + module init): {profile['wall_seconds']:.2f}s")
+    print(f"Import time (sum of module self times):          {profile['import_seconds']:.2f}s")
+    total = profile['import_seconds'] or 1.0
+
+    print(f"\n{'Package (self time)':<30}{'Seconds':>10}{'Share':>10}")
+    packages: List = list(profile['packages'].items())[:top]
+    for package, seconds in packages:
+        print(f"{package:<30}{seconds:>10.3f}{seconds / total:>10.1%}")
+
+    print(f"\n{'Package (with dependencies)':<30}{'Seconds':>10}{'Share':>10}")
+    packages = list(profile['cumulative'].items())[:top]
+    for package, seconds in packages:
+        print(f"{package:<30}{seconds:>10.3f}{seconds / total:>10.1%}")
+
+
+def main():
+    """Profile cold import time of a module."""
+    parser = argparse.ArgumentParser(description="Break down cold import time per package")
+    parser.add_argument('module', nargs='?', default='app')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=None,
+                        help="Exit with status 1 if the cold import takes longer (seconds)")
+    args = parser.parse_args()
+
+    profile = measure_import(args.module)
+    print_report(profile, top=args.top)
+
+    if args.budget is not None and profile['wall_seconds'] > args.budget:
+        print(f"\n❌ Cold import took {profile['wall_seconds']:.2f}s, budget is {args.budget:.2f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+"""
+Prebuilt, versioned index bundles.
+Ingestion can write one immutable, checksummed file holding vectors, chunk texts, metadata,
+the document catalog, the embedding model name and the chunking parameters. The server opens
+it read-only via mmap in milliseconds instead of rebuilding or loading a ChromaDB directory.
+
+Bundles can additionally carry a compact float16 or int8 (scalar-quantized) copy of the
+vectors. The first-pass scan then reads only the compact copy and the top candidates are
+re-scored exactly against the float32 vectors, which stay on disk until touched.
+"""
+
+import os
+import json
+import mmap
+import struct
+import time
+import hashlib
+import argparse
+import tempfile
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from ann_index import HNSW_SPACES
+
+
+MAGIC = b"RAGBNDL1"
+FORMAT_VERSION = 1
+_HEADER_LEN = struct.Struct("<Q")
+_ALIGN = 64
+
+VECTOR_DTYPES = ('float32', 'float16', 'int8')
+
+# Compact first pass keeps n_results * RESCORE_FACTOR candidates for exact rescoring
+RESCORE_FACTOR = int(os.getenv("INDEX_RESCORE_FACTOR", "4"))
+_SCAN_BLOCK = 8192
+
+
+class BundleError(Exception):
+    """Raised when a bundle is corrupt or does not match the serving configuration."""
+
+
+def _pad(length: int) -> int:
+    return (-length) % _ALIGN
+
+
+def quantize(vectors: np.ndarray, vector_dtype: str) -> Dict[str, np.ndarray]:
+    """
+    Build the compact copy of float32 vectors.
+
+    int8 uses per-dimension scalar quantization: x ~= offset + scale * (code + 128).
+
+    Returns:
+        Sections to store: compact_vectors, plus quant_scale/quant_offset for int8
+    """
+    if vector_dtype == 'float16':
+        return {'compact_vectors': vectors.astype(np.float16)}
+    if vector_dtype == 'int8':
+        low = vectors.min(axis=0)
+        scale = (vectors.max(axis=0) - low) / 255.0
+        scale[scale == 0] = 1.0
+        codes = np.clip(np.rint((vectors - low) / scale) - 128, -128, 127).astype(np.int8)
+        return {
+            'compact_vectors': codes,
+            'quant_scale': scale.astype(np.float32),
+            'quant_offset': low.astype(np.float32)
+        }
+    raise BundleError(f"Unsupported vector dtype: {vector_dtype} (choose from {', '.join(VECTOR_DTYPES)})")
+
+
+def write_bundle(path: str,
+                 ids: List[str],
+                 embeddings: Any,
+                 texts: List[str],
+                 metadatas: List[Dict[str, Any]],
+                 embedding_model: str,
+                 chunk_size: int,
+                 chunk_overlap: int,
+                 catalog: Optional[List[Dict[str, Any]]] = None,
+                 vector_dtype: str = 'float32',
+                 space: str = 'l2') -> Dict[str, Any]:
+    """
+    Write an immutable index bundle atomically.
+
+    Args:
+        path: Destination file
+        ids: Chunk ids
+        embeddings: Chunk vectors (n x dim, any float array-like)
+        texts: Chunk texts
+        metadatas: Chunk metadata dicts
+        embedding_model: Model that produced the vectors
+        chunk_size: Chunk size used at ingestion (words)
+        chunk_overlap: Chunk overlap used at ingestion (words)
+        catalog: Per-document summary (ingestion stats)
+        vector_dtype: float32, or float16/int8 to add a compact copy for the first-pass scan
+        space: Distance function of the collection the vectors come from (l2, cosine, ip),
+               so bundle distances stay on the same scale as ChromaDB's
+
+    Returns:
+        Bundle header (includes the content checksum used as version)
+    """
+    if space not in HNSW_SPACES:
+        raise BundleError(f"Unsupported distance space: {space} (choose from {', '.join(HNSW_SPACES)})")
+    vectors = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+    if vectors.ndim != 2 or len(vectors) != len(ids):
+        raise BundleError(f"Expected {len(ids)} vectors, got array of shape {vectors.shape}")
+
+    encoded = [text.encode('utf-8') for text in texts]
+    text_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in encoded], out=text_offsets[1:])
+
+    sections = [
+        ('vectors', vectors.tobytes()),
+        ('text_offsets', text_offsets.tobytes()),
+        ('texts', b"".join(encoded)),
+        ('ids', json.dumps(ids).encode('utf-8')),
+        ('metadatas', json.dumps(metadatas).encode('utf-8')),
+        ('catalog', json.dumps(catalog or []).encode('utf-8')),
+    ]
+    if vector_dtype != 'float32':
+        sections += [(name, np.ascontiguousarray(array).tobytes())
+                     for name, array in quantize(vectors, vector_dtype).items()]
+
+    layout = {}
+    checksum = hashlib.sha256()
+    offset = 0
+    for name, data in sections:
+        layout[name] = {'offset': offset, 'length': len(data)}
+        checksum.update(data + b"\0" * _pad(len(data)))
+        offset += len(data) + _pad(len(data))
+
+    header = {
+        'format_version': FORMAT_VERSION,
+        'embedding_model': embedding_model,
+        'dimension': int(vectors.shape[1]),
+        'count': len(ids),
+        'chunk_size': chunk_size,
+        'chunk_overlap': chunk_overlap,
+        'vector_dtype': vector_dtype,
+        'space': space,
+        'sections': layout,
+        'payload_bytes': offset,
+        'sha256': checksum.hexdigest(),
+    }
+    header['version'] = header['sha256'][:12]
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    prefix_length = len(MAGIC) + _HEADER_LEN.size + len(header_bytes)
+    header_bytes += b" " * _pad(prefix_length)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LEN.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for _, data in sections:
+                f.write(data)
+                f.write(b"\0" * _pad(len(data)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return header
+
+
+class IndexBundle:
+    def __init__(self, path: str, verify_checksum: bool = False, rescore_factor: int = RESCORE_FACTOR):
+        """
+        Open a bundle read-only via mmap.
+
+        Args:
+            path: Bundle file
+            verify_checksum: Hash the whole payload before use (reads every page)
+            rescore_factor: Candidates per result re-scored exactly when the bundle
+                            has a compact (float16/int8) vector copy
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise BundleError(f"{path} is not an index bundle")
+        header_length = _HEADER_LEN.unpack_from(self._mmap, len(MAGIC))[0]
+        header_start = len(MAGIC) + _HEADER_LEN.size
+        self.header = json.loads(bytes(self._mmap[header_start:header_start + header_length]))
+        if self.header.get('format_version') != FORMAT_VERSION:
+            raise BundleError(f"Unsupported bundle format: {self.header.get('format_version')}")
+        self._payload_start = header_start + header_length
+
+        if verify_checksum:
+            self.verify()
+
+        count, dim = self.header['count'], self.header['dimension']
+        vectors = self._section('vectors')
+        self.vectors = np.frombuffer(self._mmap, dtype=np.float32, count=count * dim,
+                                     offset=vectors['offset']).reshape(count, dim)
+        offsets = self._section('text_offsets')
+        self._text_offsets = np.frombuffer(self._mmap, dtype=np.int64, count=count + 1,
+                                           offset=offsets['offset'])
+        self._texts_start = self._section('texts')['offset']
+
+        self.vector_dtype = self.header.get('vector_dtype', 'float32')
+        # Bundles written before the space was recorded all came from l2 collections
+        self.space = self.header.get('space', 'l2')
+        self.rescore_factor = rescore_factor
+        self.compact = None
+        if self.vector_dtype != 'float32':
+            self.compact = np.frombuffer(self._mmap, dtype=np.dtype(self.vector_dtype), count=count * dim,
+                                         offset=self._section('compact_vectors')['offset']).reshape(count, dim)
+        if self.vector_dtype == 'int8':
+            self._quant_scale = np.frombuffer(self._read('quant_scale'), dtype=np.float32)
+            self._quant_offset = np.frombuffer(self._read('quant_offset'), dtype=np.float32)
+
+        self.ids = json.loads(self._read('ids'))
+        self.metadatas = json.loads(self._read('metadatas'))
+        self.catalog = json.loads(self._read('catalog'))
+        self._squared_norms = None
+        self._compact_norms = None
+        self._postings = self._build_postings()
+
+    @property
+    def version(self) -> str:
+        return self.header['version']
+
+    @property
+    def embedding_model(self) -> str:
+        return self.header['embedding_model']
+
+    def _section(self, name: str) -> Dict[str, int]:
+        section = self.header['sections'][name]
+        return {'offset': self._payload_start + section['offset'], 'length': section['length']}
+
+    def _read(self, name: str) -> bytes:
+        section = self._section(name)
+        return bytes(self._mmap[section['offset']:section['offset'] + section['length']])
+
+    def _build_postings(self) -> Dict[tuple, np.ndarray]:
+        """Map (metadata key, value) to chunk rows, e.g. ('doc_id', 'POL-003') -> its chunks."""
+        postings = defaultdict(list)
+        for row, metadata in enumerate(self.metadatas):
+            for key, value in metadata.items():
+                if isinstance(value, (str, bool)):
+                    postings[(key, value)].append(row)
+        return {key: np.asarray(rows, dtype=np.int64) for key, rows in postings.items()}
+
+    def match(self, where: Dict[str, Any]) -> np.ndarray:
+        """
+        Resolve a `where` clause (as built by filters.to_chroma_where) to candidate rows.
+
+        Supports {"field": {"$eq": v}}, {"field": {"$in": [...]}}, {"field": v},
+        {"$and": [...]} and {"$or": [...]}.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        if '$and' in where or '$or' in where:
+            operator = '$and' if '$and' in where else '$or'
+            parts = [self.match(clause) for clause in where[operator]]
+            combine = np.intersect1d if operator == '$and' else np.union1d
+            rows = parts[0]
+            for part in parts[1:]:
+                rows = combine(rows, part)
+            return rows
+
+        if len(where) != 1:
+            return self.match({'$and': [{key: value} for key, value in where.items()]})
+
+        (field, condition), = where.items()
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        if '$eq' in condition:
+            values = [condition['$eq']]
+        elif '$in' in condition:
+            values = condition['$in']
+        else:
+            raise BundleError(f"Unsupported filter operator in {where}")
+
+        found = [self._postings[(field, value)] for value in values if (field, value) in self._postings]
+        if not found:
+            return empty
+        return np.unique(np.concatenate(found))
+
+    def verify(self):
+        """Check the payload against the checksum recorded at build time."""
+        checksum = hashlib.sha256()
+        end = self._payload_start + self.header['payload_bytes']
+        step = 1 << 20
+        for start in range(self._payload_start, end, step):
+            checksum.update(self._mmap[start:min(start + step, end)])
+        if checksum.hexdigest() != self.header['sha256']:
+            raise BundleError(f"Checksum mismatch for {self.path}; bundle is corrupt")
+
+    def check_model(self, embedding_model: str):
+        """Refuse to serve vectors produced by a different embedding model."""
+        if self.embedding_model != embedding_model:
+            raise BundleError(
+                f"Index bundle {self.path} was built with '{self.embedding_model}' but "
+                f"EMBEDDING_MODEL is '{embedding_model}'. Rebuild the bundle with ingest.py."
+            )
+
+    def text(self, index: int) -> str:
+        start = self._texts_start + int(self._text_offsets[index])
+        end = self._texts_start + int(self._text_offsets[index + 1])
+        return self._mmap[start:end].decode('utf-8')
+
+    def count(self) -> int:
+        return self.header['count']
+
+    def _dequantize(self, rows: Any) -> np.ndarray:
+        """Float32 approximation of compact vectors (rows: slice or index array)."""
+        block = self.compact[rows].astype(np.float32)
+        if self.vector_dtype == 'int8':
+            block += 128.0
+            block *= self._quant_scale
+            block += self._quant_offset
+        return block
+
+    def _distances(self, dots: np.ndarray, squared_norms: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Distances in the bundle's space from dot products, as ChromaDB defines them."""
+        query_norm = float(query @ query)
+        if self.space == 'ip':
+            return 1.0 - dots
+        if self.space == 'cosine':
+            return 1.0 - dots / np.sqrt(np.maximum(squared_norms * query_norm, 1e-30))
+        return squared_norms - 2.0 * dots + query_norm
+
+    def _compact_distances(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        """Approximate distances, dequantizing the compact copy block by block."""
+        if self._compact_norms is None:
+            norms = np.empty(self.count(), dtype=np.float32)
+            for start in range(0, self.count(), _SCAN_BLOCK):
+                block = self._dequantize(slice(start, start + _SCAN_BLOCK))
+                norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+            self._compact_norms = norms
+
+        # q . x for int8 codes: (q * scale) . (code + 128) + q . offset, without dequantizing
+        weights, shift = query, 0.0
+        if self.vector_dtype == 'int8':
+            weights = query * self._quant_scale
+            shift = float(query @ self._quant_offset) + 128.0 * float(weights.sum())
+
+        total = self.count() if rows is None else len(rows)
+        distances = np.empty(total, dtype=np.float32)
+        for start in range(0, total, _SCAN_BLOCK):
+            block_rows = slice(start, start + _SCAN_BLOCK) if rows is None else rows[start:start + _SCAN_BLOCK]
+            dots = self.compact[block_rows].astype(np.float32) @ weights + shift
+            distances[start:start + len(dots)] = self._distances(dots, self._compact_norms[block_rows], query)
+        return distances
+
+    def search(self, query_embedding: List[float], n_results: int,
+               candidates: Optional[np.ndarray] = None) -> Dict[str, List[Any]]:
+        """
+        Nearest-neighbour search in the space recorded at build time (squared L2, cosine or
+        inner-product distance, matching ChromaDB's definitions).
+
+        Exact over float32 vectors; with a compact copy, an approximate first pass is
+        followed by exact rescoring of the best n_results * rescore_factor rows.
+
+        Args:
+            query_embedding: Query vector
+            n_results: Number of chunks to return
+            candidates: Optional row indices restricting the search
+
+        Returns:
+            One Chroma-style result row (ids, documents, metadatas, distances)
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        rows = np.arange(self.count()) if candidates is None else np.asarray(candidates)
+        if len(rows) == 0:
+            return {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+
+        if self.compact is not None:
+            approximate = self._compact_distances(query, None if candidates is None else rows)
+            shortlist = min(len(rows), max(n_results, n_results * self.rescore_factor))
+            if shortlist < len(rows):
+                rows = rows[np.argpartition(approximate, shortlist - 1)[:shortlist]]
+            # Exact rescoring reads only the shortlisted float32 rows
+            block = self.vectors[rows]
+            distances = self._distances(block @ query, np.einsum('ij,ij->i', block, block), query)
+        else:
+            if self._squared_norms is None:
+                self._squared_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+            if candidates is None:
+                distances = self._distances(self.vectors @ query, self._squared_norms, query)
+            else:
+                distances = self._distances(self.vectors[rows] @ query, self._squared_norms[rows], query)
+
+        k = min(n_results, len(rows))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+
+        hits = rows[top]
+        return {
+            'ids': [self.ids[i] for i in hits],
+            'documents': [self.text(i) for i in hits],
+            'metadatas': [self.metadatas[i] for i in hits],
+            # Rounding can push l2/cosine distances just below zero; ip distances may be negative
+            'distances': [float(distances[j]) if self.space == 'ip' else float(max(distances[j], 0.0))
+                          for j in top]
+        }
+
+    def close(self):
+        self.vectors = None
+        self.compact = None
+        self._text_offsets = None
+        self._mmap.close()
+        self._file.close()
+
+
+class BundleCollection:
+    def __init__(self, bundle: IndexBundle, name: str = "company_policies"):
+        """Read-only adapter exposing the subset of the Chroma collection API the app uses."""
+        self.bundle = bundle
+        self.name = name
+        self.metadata = {
+            'bundle_version': bundle.version,
+            'embedding_model': bundle.embedding_model,
+            'chunk_size': bundle.header['chunk_size'],
+            'chunk_overlap': bundle.header['chunk_overlap'],
+            # Distance scale the thresholds (adaptive top_k, extractive, scope gate) compare against
+            'hnsw:space': bundle.space,
+            # Brute-force search, there is no HNSW effort to tune
+            'exact_search': True,
+        }
+
+    def count(self) -> int:
+        return self.bundle.count()
+
+    def get(self, ids: Optional[List[str]] = None, limit: Optional[int] = None,
+            where: Optional[Dict[str, Any]] = None, **kwargs) -> Dict[str, List[Any]]:
+        rows = range(self.bundle.count()) if not where else self.bundle.match(where).tolist()
+        if ids is not None:
+            wanted = set(ids)
+            rows = [i for i in rows if self.bundle.ids[i] in wanted]
+        rows = list(rows)[:limit] if limit is not None else list(rows)
+        return {
+            'ids': [self.bundle.ids[i] for i in rows],
+            'documents': [self.bundle.text(i) for i in rows],
+            'metadatas': [self.bundle.metadatas[i] for i in rows],
+        }
+
+    def query(self, query_embeddings: List[List[float]], n_results: int = 10,
+              where: Optional[Dict[str, Any]] = None, **kwargs) -> Dict[str, List[Any]]:
+        # Filtered queries only score the chunks listed for the matching doc_ids/tags
+        candidates = self.bundle.match(where) if where else None
+        rows = [self.bundle.search(embedding, n_results, candidates=candidates) for embedding in query_embeddings]
+        return {key: [row[key] for row in rows] for key in ('ids', 'documents', 'metadatas', 'distances')}
+
+
+def benchmark(path: str, queries: int = 200, n_results: int = 5,
+              noise: float = 0.5, seed: int = 0) -> Dict[str, Any]:
+    """
+    Measure recall@k, scanned vector memory and search latency of compact bundles.
+
+    Writes float16 and int8 variants of a float32 bundle next to it (temporary files) and
+    searches all of them with perturbed copies of stored vectors; exact float32 results
+    are the ground truth.
+
+    Returns:
+        Per dtype: recall_at_k, vector_mb (first-pass scan), file_mb, mean_latency_ms
+    """
+    reference = IndexBundle(path)
+    rng = np.random.default_rng(seed)
+    vectors = np.array(reference.vectors)
+    picks = rng.integers(0, reference.count(), size=queries)
+    spread = float(vectors.std()) * noise
+    workload = vectors[picks] + rng.normal(0.0, spread, size=(queries, vectors.shape[1])).astype(np.float32)
+
+    truth = [set(reference.search(q, n_results)['ids']) for q in workload]
+    results = {}
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp:
+        for vector_dtype in VECTOR_DTYPES:
+            variant_path = path
+            if vector_dtype != 'float32':
+                variant_path = os.path.join(tmp, f"{vector_dtype}.bundle")
+                write_bundle(variant_path, reference.ids, vectors,
+                             [reference.text(i) for i in range(reference.count())],
+                             reference.metadatas, reference.embedding_model,
+                             reference.header['chunk_size'], reference.header['chunk_overlap'],
+                             catalog=reference.catalog, vector_dtype=vector_dtype,
+                             space=reference.space)
+            bundle = IndexBundle(variant_path)
+            bundle.search(workload[0], n_results)  # warm norms and page cache
+
+            start = time.perf_counter()
+            found = [set(bundle.search(q, n_results)['ids']) for q in workload]
+            elapsed = time.perf_counter() - start
+
+            scanned_bytes = (bundle.compact if bundle.compact is not None else bundle.vectors).nbytes
+            results[vector_dtype] = {
+                'recall_at_k': float(np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])),
+                'vector_mb': scanned_bytes / (1024 * 1024),
+                'file_mb': os.path.getsize(variant_path) / (1024 * 1024),
+                'mean_latency_ms': elapsed / queries * 1000
+            }
+            bundle.close()
+
+    reference.close()
+    return {'chunks': len(vectors), 'dimension': vectors.shape[1], 'k': n_results,
+            'rescore_factor': RESCORE_FACTOR, 'results': results}
+
+
+def write_synthetic_bundle(path: str, count: int, dimension: int = 384, seed: int = 0) -> Dict[str, Any]:
+    """Write a float32 bundle of clustered, unit-length random vectors for benchmarking at scale."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, count // 50), dimension)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), size=count)]
+    vectors += rng.normal(scale=0.5, size=vectors.shape).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return write_bundle(path, [f"synthetic_{i}" for i in range(count)], vectors,
+                        [""] * count, [{} for _ in range(count)], "synthetic", 0, 0)
+
+
+def main():
+    """Benchmark compact vector storage against full-precision search."""
+    parser = argparse.ArgumentParser(description="Recall/memory/latency of float16 and int8 bundles")
+    parser.add_argument('bundle', nargs='?', default=os.getenv("INDEX_BUNDLE_PATH", "index.bundle"))
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help="Benchmark a random corpus of this many vectors instead of the bundle")
+    parser.add_argument('--dim', type=int, default=384)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "synthetic.bundle")
+            write_synthetic_bundle(path, args.synthetic, args.dim)
+            report = benchmark(path, queries=args.queries, n_results=args.k)
+    else:
+        report = benchmark(args.bundle, queries=args.queries, n_results=args.k)
+
+    print(f"{report['chunks']} vectors x {report['dimension']} dims, recall@{report['k']}, "
+          f"rescore factor {report['rescore_factor']}")
+    print(f"{'dtype':<10}{'recall':>10}{'vectors MB':>14}{'file MB':>12}{'ms/query':>12}")
+    for vector_dtype, row in report['results'].items():
+        print(f"{vector_dtype:<10}{row['recall_at_k']:>10.3f}{row['vector_mb']:>14.1f}"
+              f"{row['file_mb']:>12.1f}{row['mean_latency_ms']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,10 @@ Run this script to load documents into ChromaDB.
 
 import os
 import sys
+import time
 import hashlib
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
 # Disable ChromaDB telemetry to prevent production errors
 os.environ["ANONYMIZED_TELEMETRY"] = "False"
@@ -16,12 +17,27 @@ os.environ["CHROMA_TELEMETRY"] = "False"
 # Force ONNX to use CPU only to prevent GPU warnings
 os.environ["ORT_DEVICE"] = "CPU"
 
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-import markdown
-from bs4 import BeautifulSoup
-from pypdf import PdfReader
+import numpy as np
+
+from filters import tag_key
+from tenants import DEFAULT_TENANT, validate_tenant
+from ann_index import AnnParams
+from blue_green import IndexPointer
+from dedup import DEDUP_MODES, NearDuplicateDetector
+from scope_gate import centroids_path, write_centroids
+from pdf_pages import DEFAULT_WORKERS, PARALLEL_MIN_PAGES, PdfPages, create_executor, iter_pdf_pages
+
+# chromadb, sentence-transformers (torch), markdown and bs4 are imported where they are used:
+# spawned page-extraction workers re-import this module as __mp_main__ when it is run as a script
+
+
+SUPPORTED_EXTENSIONS = ('.md', '.txt', '.pdf', '.html', '.htm')
+
+# Chunks embedded and stored together (bounds memory while streaming large documents)
+EMBED_BATCH_SIZE = 256
+
+# Chunk metadata written by near-duplicate detection, not rebuilt by chunk_metadata()
+DEDUP_METADATA_KEYS = ('duplicate_of', 'duplicates')
 
 
 class DocumentIngestion:
@@ -30,7 +46,16 @@ class DocumentIngestion:
                  db_path: str = "chroma_db",
                  embedding_model: str = "all-MiniLM-L6-v2",
                  chunk_size: int = 500,
-                 chunk_overlap: int = 50):
+                 chunk_overlap: int = 50,
+                 bundle_path: Optional[str] = None,
+                 tenant: str = DEFAULT_TENANT,
+                 vector_dtype: str = "float32",
+                 ann_params: Optional[AnnParams] = None,
+                 workers: Optional[int] = None,
+                 model: Optional[Any] = None,
+                 client: Optional[Any] = None,
+                 collection: Optional[str] = None,
+                 dedup: Optional[str] = None):
         """
         Initialize document ingestion system.
 
@@ -40,31 +65,104 @@ class DocumentIngestion:
             embedding_model: Name of sentence-transformers model
             chunk_size: Target size for document chunks (in words)
             chunk_overlap: Overlap between chunks (in words)
+            bundle_path: Also write an immutable, mmap-able index bundle here
+            tenant: Tenant (subsidiary) whose collection receives the documents
+            vector_dtype: Compact vector copy written to the bundle (float32, float16, int8)
+            ann_params: HNSW parameters for a new collection (defaults to AnnParams.load())
+            workers: Processes extracting PDF pages in parallel (INGEST_WORKERS, default CPU count up to 4)
+            model: Loaded SentenceTransformer to reuse (e.g. the server's) instead of loading one
+            client: Open ChromaDB client to reuse (a running server's, so its index sees the writes)
+            collection: Collection to write (default: the tenant's serving collection, see blue_green.py)
+            dedup: Near-duplicate chunks: 'tag', 'collapse' or 'off' (INGEST_DEDUP, default tag)
         """
         self.docs_path = Path(docs_path)
         self.db_path = db_path
+        self.embedding_model_name = embedding_model
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.bundle_path = bundle_path
+        self.tenant = validate_tenant(tenant)
+        self.collection_name = collection or IndexPointer(db_path).active(self.tenant)
+        self.vector_dtype = vector_dtype
+        self.ann_params = ann_params or AnnParams.load()
+        self.workers = workers or int(os.getenv("INGEST_WORKERS", "0")) or DEFAULT_WORKERS
+        self._executor = None
+        self.dedup_mode = dedup or os.getenv("INGEST_DEDUP", "tag")
+        if self.dedup_mode not in DEDUP_MODES:
+            raise ValueError(f"Unsupported dedup mode: {self.dedup_mode} (choose from {', '.join(DEDUP_MODES)})")
 
         # Initialize embedding model
-        print(f"Loading embedding model: {embedding_model}")
-        self.embedding_model = SentenceTransformer(embedding_model)
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            print(f"Loading embedding model: {embedding_model}")
+            model = SentenceTransformer(embedding_model)
+        self.embedding_model = model
 
         # Initialize ChromaDB with telemetry disabled
-        self.client = chromadb.PersistentClient(
-            path=db_path,
-            settings=Settings(
-                anonymized_telemetry=False,
-                allow_reset=True
+        if client is None:
+            import chromadb
+            from chromadb.config import Settings
+
+            client = chromadb.PersistentClient(
+                path=db_path,
+                settings=Settings(
+                    anonymized_telemetry=False,
+                    allow_reset=True
+                )
             )
-        )
+        self.client = client
 
         # Get or create collection
-        self.collection = self.client.get_or_create_collection(
-            name="company_policies",
-            metadata={"description": "Company policy documents"}
-        )
-        print("Created new collection: company_policies")
+        # HNSW graph parameters are fixed when a collection is created (passing metadata to
+        # get_or_create_collection would overwrite the recorded parameters, not rebuild the graph)
+        try:
+            self.collection = self.client.get_collection(name=self.collection_name)
+            print(f"Using existing collection: {self.collection_name}")
+            built = AnnParams.from_collection_metadata(self.collection.metadata)
+            if built.build_params() != self.ann_params.build_params():
+                print(f"⚠️  Existing collection uses HNSW {built.build_params()}, not {self.ann_params.build_params()}; "
+                      f"delete {db_path} and re-run ingestion to apply")
+        except ValueError:
+            self.collection = self.client.create_collection(
+                name=self.collection_name,
+                metadata={
+                    "description": "Company policy documents",
+                    "tenant": self.tenant,
+                    **self.build_settings(),
+                    **self.ann_params.collection_metadata()
+                }
+            )
+            print(f"Created new collection: {self.collection_name} (HNSW {self.ann_params.to_dict()})")
+        self.check_build_settings(self.collection.metadata or {})
+
+    def build_settings(self) -> Dict[str, Any]:
+        """Embedding model and chunking recorded on a new collection."""
+        return {
+            'embedding_model': self.embedding_model_name,
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'built_at': time.time()
+        }
+
+    def check_build_settings(self, metadata: Dict[str, Any]):
+        """
+        Refuse to mix embedding models in one collection; warn about different chunking.
+
+        Raises:
+            ValueError: The collection was built with another embedding model
+        """
+        built_model = metadata.get('embedding_model')
+        if built_model and built_model != self.embedding_model_name:
+            raise ValueError(
+                f"Collection {self.collection_name} was built with '{built_model}', not "
+                f"'{self.embedding_model_name}'. Migrate with 'python blue_green.py rebuild "
+                f"--embedding-model {self.embedding_model_name}'."
+            )
+        for key in ('chunk_size', 'chunk_overlap'):
+            if key in metadata and metadata[key] != getattr(self, key):
+                print(f"⚠️  Collection {self.collection_name} was chunked with {key}={metadata[key]}, "
+                      f"not {getattr(self, key)}; use 'python blue_green.py rebuild' to re-chunk everything")
 
     def parse_markdown(self, file_path: Path) -> Dict[str, Any]:
         """Parse markdown file and extract content."""
@@ -72,6 +170,9 @@ class DocumentIngestion:
             content = f.read()
 
         # Convert markdown to HTML then extract text
+        import markdown
+        from bs4 import BeautifulSoup
+
         html = markdown.markdown(content)
         soup = BeautifulSoup(html, 'html.parser')
         text = soup.get_text()
@@ -83,7 +184,7 @@ class DocumentIngestion:
 
         for line in lines[:20]:  # Check first 20 lines
             if 'Document ID:' in line:
-                doc_id = line.split('Document ID:')[1].strip().replace('**', '')
+                doc_id = line.split('Document ID:')[1].replace('**', '').strip()
                 break
 
         if not doc_id:
@@ -110,6 +211,56 @@ class DocumentIngestion:
             'format': 'text'
         }
 
+    def parse_html(self, file_path: Path) -> Dict[str, Any]:
+        """Parse HTML file."""
+        with open(file_path, 'r', encoding='utf-8') as f:
+            html_content = f.read()
+
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html_content, 'html.parser')
+        title = soup.find('title')
+        title = title.get_text().strip() if title and title.get_text().strip() else file_path.stem.replace('_', ' ').title()
+        for element in soup(['script', 'style', 'head']):
+            element.decompose()
+
+        return {
+            'title': title,
+            'doc_id': file_path.stem.upper(),
+            'content': soup.get_text(separator='\n'),
+            'file_path': str(file_path),
+            'format': 'html'
+        }
+
+    def open_pdf(self, file_path: Path) -> Tuple[Dict[str, Any], Iterator[Tuple[int, str]]]:
+        """
+        Open a PDF for streaming.
+
+        Returns:
+            Document metadata and a lazy iterator of (page number, page text); pages are
+            extracted in parallel a few pages ahead of the consumer
+        """
+        pages = PdfPages(str(file_path))
+        try:
+            page_count = len(pages)
+            title = pages.title()
+        finally:
+            pages.close()
+
+        if self._executor is None and page_count >= PARALLEL_MIN_PAGES and self.workers > 1:
+            self._executor = create_executor(self.workers)
+
+        doc_data = {
+            'title': title or file_path.stem.replace('_', ' ').title(),
+            'doc_id': file_path.stem.upper(),
+            'file_path': str(file_path),
+            'format': 'pdf',
+            'pages': page_count
+        }
+        sections = iter_pdf_pages(str(file_path), self._executor,
+                                  prefetch=2 * self.workers, page_count=page_count)
+        return doc_data, sections
+
     def parse_document(self, file_path: Path) -> Dict[str, Any]:
         """Parse document based on file extension."""
         ext = file_path.suffix.lower()
@@ -118,133 +269,435 @@ class DocumentIngestion:
             return self.parse_markdown(file_path)
         elif ext == '.txt':
             return self.parse_txt(file_path)
+        elif ext in ['.html', '.htm']:
+            return self.parse_html(file_path)
+        elif ext == '.pdf':
+            doc_data, sections = self.open_pdf(file_path)
+            doc_data['content'] = '\n'.join(text for _, text in sections)
+            return doc_data
         else:
             raise ValueError(f"Unsupported file format: {ext}")
 
+    def open_document(self, file_path: Path) -> Tuple[Dict[str, Any], Iterable[Tuple[Optional[int], str]]]:
+        """
+        Document metadata and its text as (page number, text) sections.
+
+        PDFs are streamed page by page; other formats are a single section without a page number.
+        """
+        if file_path.suffix.lower() == '.pdf':
+            return self.open_pdf(file_path)
+        doc_data = self.parse_document(file_path)
+        return doc_data, [(None, doc_data.pop('content'))]
+
     def chunk_text(self, text: str, metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
         """
         Chunk text into smaller pieces with overlap.
         Uses word-based chunking.
         """
-        chunks = []
-        words = text.split()
+        return list(self.chunk_sections([(None, text)], metadata))
 
-        # Simple word-based chunking
-        start = 0
+    def chunk_sections(self,
+                       sections: Iterable[Tuple[Optional[int], str]],
+                       metadata: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Chunk a stream of (page number, text) sections with overlap, one section at a time.
+
+        Only the words of the current chunk and section are held in memory. Chunks may span
+        pages; page_start/page_end record the pages a chunk's words came from. The chunks are
+        the same as chunk_text produces for the concatenated text.
+        """
+        words = []
+        pages = []
         chunk_id = 0
+        step = self.chunk_size - self.chunk_overlap
 
-        while start < len(words):
-            end = start + self.chunk_size
-            chunk_words = words[start:end]
+        def make_chunk(chunk_words: List[str], chunk_pages: List[Optional[int]]) -> Dict[str, Any]:
             chunk_text = ' '.join(chunk_words)
 
             # Create unique chunk ID
             chunk_hash = hashlib.md5(chunk_text.encode()).hexdigest()[:8]
 
-            chunks.append({
+            chunk = {
                 'text': chunk_text,
                 'chunk_id': f"{metadata['doc_id']}_chunk_{chunk_id}_{chunk_hash}",
                 'chunk_index': chunk_id,
                 'doc_id': metadata['doc_id'],
                 'title': metadata['title'],
-                'file_path': metadata['file_path']
-            })
+                'file_path': metadata['file_path'],
+                'format': metadata.get('format', 'text'),
+                'tags': metadata.get('tags', [])
+            }
+            numbered = [page for page in chunk_pages if page is not None]
+            if numbered:
+                chunk['page_start'] = min(numbered)
+                chunk['page_end'] = max(numbered)
+            return chunk
+
+        for page, text in sections:
+            section_words = text.split()
+            words.extend(section_words)
+            pages.extend([page] * len(section_words))
+
+            # Emit every full chunk; keep the overlap for the next one
+            while len(words) >= self.chunk_size:
+                yield make_chunk(words[:self.chunk_size], pages[:self.chunk_size])
+                chunk_id += 1
+                del words[:step]
+                del pages[:step]
 
+        start = 0
+        while start < len(words):
+            yield make_chunk(words[start:start + self.chunk_size], pages[start:start + self.chunk_size])
             chunk_id += 1
-            start = end - self.chunk_overlap
-
-        return chunks
+            start += step
 
-    def embed_chunks(self, chunks: List[Dict[str, Any]]) -> List[List[float]]:
-        """Generate embeddings for text chunks."""
+    def embed_chunks(self, chunks: List[Dict[str, Any]]) -> np.ndarray:
+        """Generate embeddings for text chunks (float32 array, one row per chunk)."""
         texts = [chunk['text'] for chunk in chunks]
-        embeddings = self.embedding_model.encode(texts, show_progress_bar=True)
-        return embeddings.tolist()
+        embeddings = self.embedding_model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def load_tags(self) -> Dict[str, List[str]]:
+        """
+        Load ingestion-time tags from tags.json in the documents directory.
+
+        Format: {"expense_reimbursement.md": ["finance", "travel"], ...}
+        """
+        import json
+
+        tags_file = self.docs_path / 'tags.json'
+        if not tags_file.exists():
+            return {}
+        with open(tags_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def chunk_metadata(self, chunk: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the metadata stored with a chunk (filterable by doc_id, title, format, tags)."""
+        metadata = {
+            'doc_id': chunk['doc_id'],
+            'title': chunk['title'],
+            'file_path': chunk['file_path'],
+            'chunk_index': chunk['chunk_index'],
+            'format': chunk['format'],
+            'tags': ",".join(chunk['tags'])
+        }
+        # Near-duplicate of an earlier chunk (kept, but collapsed at retrieval)
+        if 'duplicate_of' in chunk:
+            metadata['duplicate_of'] = chunk['duplicate_of']
+        # Page citations (PDFs)
+        if 'page_start' in chunk:
+            metadata['page_start'] = chunk['page_start']
+            metadata['page_end'] = chunk['page_end']
+        # One boolean key per tag so tag filters can be pushed into the vector search
+        for tag in chunk['tags']:
+            metadata[tag_key(tag)] = True
+        return metadata
+
+    @staticmethod
+    def _dedup_keys(metadata: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: metadata[key] for key in DEDUP_METADATA_KEYS if key in metadata}
+
+    @staticmethod
+    def _without_dedup(metadata: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in metadata.items() if key not in DEDUP_METADATA_KEYS}
+
+    def sync_files(self, changed: List[Path], removed: List[Path]) -> Dict[str, int]:
+        """
+        Apply edited, added and deleted documents to the collection incrementally.
+
+        Chunk ids embed a hash of their text, so only chunks whose text changed are embedded;
+        chunks whose text is unchanged but whose metadata changed (title, tags) are re-stored
+        with their existing vectors and near-duplicate keys. New chunks are added before stale ones are deleted, so a
+        document never disappears from search while it is being updated.
+
+        Args:
+            changed: Documents added or modified since the last sync
+            removed: Documents deleted since the last sync
+
+        Returns:
+            Counts of embedded, re-tagged, deleted and unchanged chunks
+        """
+        tags_by_file = self.load_tags()
+        counts = {'embedded': 0, 'retagged': 0, 'deleted': 0, 'unchanged': 0}
+
+        try:
+            for doc_file in removed:
+                stale = self.collection.get(where={'file_path': str(doc_file)}, include=[])['ids']
+                if stale:
+                    self.collection.delete(ids=stale)
+                counts['deleted'] += len(stale)
+                print(f"🗑️  {doc_file.name}: removed {len(stale)} chunks")
+
+            for doc_file in changed:
+                existing = self.collection.get(where={'file_path': str(doc_file)}, include=['metadatas'])
+                existing = dict(zip(existing['ids'], existing['metadatas']))
+
+                doc_data, sections = self.open_document(doc_file)
+                doc_data['tags'] = tags_by_file.get(doc_file.name, [])
+
+                seen = set()
+                batch = []
+                retag = []
+                for chunk in self.chunk_sections(sections, doc_data):
+                    seen.add(chunk['chunk_id'])
+                    if chunk['chunk_id'] not in existing:
+                        batch.append(chunk)
+                        if len(batch) >= EMBED_BATCH_SIZE:
+                            self.store_chunks(batch)
+                            counts['embedded'] += len(batch)
+                            batch = []
+                    elif (self._without_dedup(existing[chunk['chunk_id']])
+                          != self._without_dedup(self.chunk_metadata(chunk))):
+                        retag.append(chunk)
+                    else:
+                        counts['unchanged'] += 1
+                if batch:
+                    self.store_chunks(batch)
+                    counts['embedded'] += len(batch)
+
+                if retag:
+                    # Metadata updates merge keys, so replace the records (keeping their vectors)
+                    ids = [chunk['chunk_id'] for chunk in retag]
+                    stored = self.collection.get(ids=ids, include=['embeddings'])
+                    vectors = dict(zip(stored['ids'], stored['embeddings']))
+                    self.collection.delete(ids=ids)
+                    self.collection.add(
+                        ids=ids,
+                        embeddings=[vectors[chunk_id] for chunk_id in ids],
+                        documents=[chunk['text'] for chunk in retag],
+                        metadatas=[{**self._dedup_keys(existing[chunk['chunk_id']]), **self.chunk_metadata(chunk)}
+                                   for chunk in retag]
+                    )
+                    counts['retagged'] += len(retag)
+
+                stale = [chunk_id for chunk_id in existing if chunk_id not in seen]
+                if stale:
+                    self.collection.delete(ids=stale)
+                counts['deleted'] += len(stale)
+                print(f"🔄 {doc_file.name}: {len(seen)} chunks ({len(seen) - len(existing.keys() & seen)} new, "
+                      f"{len(stale)} removed)")
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+        return counts
+
+    def _discard_chunks(self, chunk_ids: set, batch: List[Dict[str, Any]], bundle_rows: Optional[Dict[str, list]]):
+        """Remove a failed document's chunks from the pending batch, the collection and the bundle rows."""
+        pending = {chunk['chunk_id'] for chunk in batch}
+        stored = [chunk_id for chunk_id in chunk_ids if chunk_id not in pending]
+        batch[:] = [chunk for chunk in batch if chunk['chunk_id'] not in chunk_ids]
+        if stored:
+            self.collection.delete(ids=stored)
+            print(f"  - Removed {len(stored)} partially stored chunks")
+        if bundle_rows is not None and stored:
+            embeddings = np.concatenate(bundle_rows['embeddings']) if bundle_rows['embeddings'] else None
+            keep = [i for i, chunk_id in enumerate(bundle_rows['ids']) if chunk_id not in chunk_ids]
+            for key in ('ids', 'texts', 'metadatas'):
+                bundle_rows[key] = [bundle_rows[key][i] for i in keep]
+            bundle_rows['embeddings'] = [embeddings[keep]] if embeddings is not None else []
+
+    def stamp_index_version(self) -> str:
+        """
+        Record a content version on the collection so servers can tell when it changed.
+
+        Chunk ids embed a hash of their text, so the id set identifies the indexed content.
+        """
+        ids = sorted(self.collection.get(include=[])['ids'])
+        digest = hashlib.sha256(self.embedding_model_name.encode('utf-8'))
+        for chunk_id in ids:
+            digest.update(chunk_id.encode('utf-8'))
+        version = digest.hexdigest()[:12]
+        self.update_collection_metadata(index_version=version)
+        return version
+
+    def write_scope_centroids(self) -> str:
+        """Store per-document centroids of the collection's embeddings for the out-of-scope gate."""
+        rows = self.collection.get(include=['embeddings', 'metadatas'])
+        path = centroids_path(self.db_path, self.collection.name)
+        if rows['ids']:
+            write_centroids(path, np.asarray(rows['embeddings'], dtype=np.float32),
+                            [metadata['doc_id'] for metadata in rows['metadatas']], self.embedding_model_name)
+        elif os.path.exists(path):
+            os.remove(path)
+        return path
+
+    def update_collection_metadata(self, **values):
+        """Add or change keys of the collection metadata."""
+        # Collection.modify rejects any metadata containing hnsw:space (even unchanged), and
+        # metadata updates replace the whole dict, so write it through the client directly
+        metadata = {**(self.collection.metadata or {}), **values}
+        self.collection._client._modify(id=self.collection.id, new_metadata=metadata)
+        self.collection.metadata = metadata
+
+    def store_chunks(self, chunks: List[Dict[str, Any]]):
+        """Embed a batch of chunks and add them to the collection."""
+        embeddings = self.embed_chunks(chunks)
+        self.collection.add(
+            ids=[chunk['chunk_id'] for chunk in chunks],
+            embeddings=embeddings.tolist(),
+            documents=[chunk['text'] for chunk in chunks],
+            metadatas=[self.chunk_metadata(chunk) for chunk in chunks]
+        )
+        return embeddings
+
+    def record_duplicates(self, detector: NearDuplicateDetector):
+        """Store copy counts on canonical chunks and the number of tagged copies on the collection."""
+        groups = {canonical: len(copies) for canonical, copies in detector.duplicates.items() if copies}
+        if groups:
+            # Record-level metadata updates merge keys
+            self.collection.update(ids=list(groups), metadatas=[{'duplicates': n} for n in groups.values()])
+        tagged = sum(groups.values()) if detector.mode == 'tag' else 0
+        self.update_collection_metadata(tagged_duplicates=tagged)
 
     def ingest_documents(self) -> Dict[str, Any]:
         """
         Main ingestion pipeline: parse all documents, chunk, embed, and store.
+
+        Documents are streamed through chunking and stored in batches of EMBED_BATCH_SIZE
+        chunks, so memory does not grow with document size (except when a bundle is written,
+        which needs every vector). Near-duplicate chunks across the corpus are tagged or
+        collapsed on the way (see dedup.py).
         """
         print(f"\nStarting document ingestion from {self.docs_path}")
 
         # Find all supported documents
-        supported_exts = ['.md', '.txt']
         doc_files = [f for f in self.docs_path.iterdir()
-                     if f.is_file() and f.suffix.lower() in supported_exts]
+                     if f.is_file() and f.suffix.lower() in SUPPORTED_EXTENSIONS]
 
         print(f"Found {len(doc_files)} documents to process")
 
-        all_chunks = []
+        tags_by_file = self.load_tags()
+
         stats = {
             'total_docs': len(doc_files),
             'total_chunks': 0,
             'documents': []
         }
 
-        for doc_file in doc_files:
-            print(f"\nProcessing: {doc_file.name}")
-
-            try:
-                # Parse document
-                doc_data = self.parse_document(doc_file)
-                print(f"  - Title: {doc_data['title']}")
-                print(f"  - Doc ID: {doc_data['doc_id']}")
-                print(f"  - Content length: {len(doc_data['content'])} chars")
-
-                # Chunk document
-                chunks = self.chunk_text(doc_data['content'], doc_data)
-                print(f"  - Created {len(chunks)} chunks")
-
-                all_chunks.extend(chunks)
-
-                stats['documents'].append({
-                    'file': doc_file.name,
-                    'title': doc_data['title'],
-                    'doc_id': doc_data['doc_id'],
-                    'chunks': len(chunks)
-                })
-                stats['total_chunks'] += len(chunks)
-
-            except Exception as e:
-                print(f"  - ERROR: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                continue
-
-        if not all_chunks:
+        batch = []
+        stored_batches = 0
+        bundle_rows = {'ids': [], 'embeddings': [], 'texts': [], 'metadatas': []} if self.bundle_path else None
+        detector = NearDuplicateDetector.from_env(self.dedup_mode)
+        embedding = {'seconds': 0.0, 'chunks': 0, 'text_bytes': 0}
+
+        def flush():
+            nonlocal batch, stored_batches
+            if not batch:
+                return
+            start = time.perf_counter()
+            embeddings = self.store_chunks(batch)
+            embedding['seconds'] += time.perf_counter() - start
+            embedding['chunks'] += len(batch)
+            embedding['text_bytes'] += sum(len(chunk['text'].encode('utf-8')) for chunk in batch)
+            if bundle_rows is not None:
+                bundle_rows['ids'].extend(chunk['chunk_id'] for chunk in batch)
+                bundle_rows['embeddings'].append(embeddings)
+                bundle_rows['texts'].extend(chunk['text'] for chunk in batch)
+                bundle_rows['metadatas'].extend(self.chunk_metadata(chunk) for chunk in batch)
+            stored_batches += 1
+            print(f"  - Stored batch {stored_batches} ({len(batch)} chunks)")
+            batch = []
+
+        try:
+            for doc_file in doc_files:
+                print(f"\nProcessing: {doc_file.name}")
+                doc_chunk_ids = []
+                doc_duplicate_ids = []
+
+                try:
+                    # Parse document (PDF pages are extracted lazily while chunking)
+                    doc_data, sections = self.open_document(doc_file)
+                    doc_data['tags'] = tags_by_file.get(doc_file.name, [])
+                    print(f"  - Title: {doc_data['title']}")
+                    print(f"  - Doc ID: {doc_data['doc_id']}")
+                    if 'pages' in doc_data:
+                        print(f"  - Pages: {doc_data['pages']}")
+                    else:
+                        print(f"  - Content length: {sum(len(text) for _, text in sections)} chars")
+
+                    # Chunk, embed and store as the document streams in
+                    for chunk in self.chunk_sections(sections, doc_data):
+                        duplicate_of = detector.check(chunk['chunk_id'], chunk['text']) if detector.enabled else None
+                        if duplicate_of is not None:
+                            doc_duplicate_ids.append(chunk['chunk_id'])
+                            if detector.mode == 'collapse':
+                                continue
+                            chunk['duplicate_of'] = duplicate_of
+                        batch.append(chunk)
+                        doc_chunk_ids.append(chunk['chunk_id'])
+                        if len(batch) >= EMBED_BATCH_SIZE:
+                            flush()
+                    print(f"  - Created {len(doc_chunk_ids)} chunks")
+                    if doc_duplicate_ids:
+                        print(f"  - Near-duplicates {'collapsed' if detector.mode == 'collapse' else 'tagged'}: "
+                              f"{len(doc_duplicate_ids)}")
+
+                    document = {
+                        'file': doc_file.name,
+                        'title': doc_data['title'],
+                        'doc_id': doc_data['doc_id'],
+                        'chunks': len(doc_chunk_ids)
+                    }
+                    if doc_duplicate_ids:
+                        document['near_duplicates'] = len(doc_duplicate_ids)
+                    if 'pages' in doc_data:
+                        document['pages'] = doc_data['pages']
+                    stats['documents'].append(document)
+                    stats['total_chunks'] += len(doc_chunk_ids)
+
+                except Exception as e:
+                    print(f"  - ERROR: {str(e)}")
+                    import traceback
+                    traceback.print_exc()
+                    self._discard_chunks(set(doc_chunk_ids), batch, bundle_rows)
+                    detector.forget(set(doc_chunk_ids) | set(doc_duplicate_ids))
+                    continue
+
+            flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+        if stats['total_chunks'] == 0:
             print("No chunks created. Exiting.")
             return stats
 
-        print(f"\n{'='*60}")
-        print(f"Total chunks to embed: {len(all_chunks)}")
-        print("Generating embeddings...")
-
-        # Generate embeddings
-        embeddings = self.embed_chunks(all_chunks)
-
-        print("Storing in vector database...")
-
-        # Prepare data for ChromaDB
-        ids = [chunk['chunk_id'] for chunk in all_chunks]
-        documents = [chunk['text'] for chunk in all_chunks]
-        metadatas = [{
-            'doc_id': chunk['doc_id'],
-            'title': chunk['title'],
-            'file_path': chunk['file_path'],
-            'chunk_index': chunk['chunk_index']
-        } for chunk in all_chunks]
-
-        # Store in ChromaDB (batch if large)
-        batch_size = 100
-        for i in range(0, len(ids), batch_size):
-            batch_end = min(i + batch_size, len(ids))
-            self.collection.add(
-                ids=ids[i:batch_end],
-                embeddings=embeddings[i:batch_end],
-                documents=documents[i:batch_end],
-                metadatas=metadatas[i:batch_end]
+        if detector.enabled:
+            self.record_duplicates(detector)
+            stats['dedup'] = detector.report(
+                embed_seconds_per_chunk=embedding['seconds'] / max(embedding['chunks'], 1),
+                dimension=self.embedding_model.get_sentence_embedding_dimension(),
+                text_bytes_per_chunk=embedding['text_bytes'] / max(embedding['chunks'], 1)
             )
-            print(f"  - Stored batch {i//batch_size + 1}/{(len(ids)-1)//batch_size + 1}")
+            print(f"🧬 Near-duplicate chunks: {stats['dedup']['near_duplicates']} of "
+                  f"{stats['dedup']['chunks']} ({detector.mode}, Jaccard >= {detector.threshold})")
+
+        stats['index_version'] = self.stamp_index_version()
+        print(f"🏷️  Index version: {stats['index_version']}")
+        print(f"🎯 Scope centroids: {self.write_scope_centroids()}")
+
+        if self.bundle_path:
+            from index_bundle import write_bundle
+
+            header = write_bundle(
+                self.bundle_path,
+                ids=bundle_rows['ids'],
+                embeddings=np.concatenate(bundle_rows['embeddings']),
+                texts=bundle_rows['texts'],
+                metadatas=bundle_rows['metadatas'],
+                embedding_model=self.embedding_model_name,
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap,
+                catalog=stats['documents'],
+                vector_dtype=self.vector_dtype,
+                space=AnnParams.from_collection_metadata(self.collection.metadata).space
+            )
+            stats['bundle'] = {'path': self.bundle_path, 'version': header['version'],
+                               'vector_dtype': self.vector_dtype}
+            print(f"📦 Wrote index bundle {header['version']} to {self.bundle_path}")
 
         print(f"\n{'='*60}")
         print("✅ Ingestion complete!")
@@ -258,6 +711,37 @@ class DocumentIngestion:
 def main():
     """Run document ingestion."""
     import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest policy documents")
+    parser.add_argument('--bundle', default=os.getenv("INDEX_BUNDLE_PATH"),
+                        help="Also write a prebuilt index bundle to this path")
+    parser.add_argument('--vector-dtype', default=os.getenv("INDEX_VECTOR_DTYPE", "float32"),
+                        choices=['float32', 'float16', 'int8'],
+                        help="Compact vector copy in the bundle, re-scored with float32")
+    parser.add_argument('--hnsw-space', choices=['l2', 'cosine', 'ip'], default=None)
+    parser.add_argument('--hnsw-m', type=int, default=None)
+    parser.add_argument('--construction-ef', type=int, default=None)
+    parser.add_argument('--search-ef', type=int, default=None)
+    parser.add_argument('--tenant', default=DEFAULT_TENANT,
+                        help="Ingest into this tenant's collection")
+    parser.add_argument('--docs', default="documents",
+                        help="Directory with the tenant's policy documents")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes extracting PDF pages in parallel (default: CPU count up to 4)")
+    parser.add_argument('--dedup', choices=DEDUP_MODES, default=None,
+                        help="Near-duplicate chunks: tag them, collapse them or keep them as is (default: tag)")
+    args = parser.parse_args()
+    tenant = validate_tenant(args.tenant)
+
+    # Tuned settings (ann_index.py) and HNSW_* env vars, overridden by flags
+    ann_params = AnnParams.load()
+    ann_params = AnnParams(
+        space=args.hnsw_space or ann_params.space,
+        M=args.hnsw_m or ann_params.M,
+        construction_ef=args.construction_ef or ann_params.construction_ef,
+        search_ef=args.search_ef or ann_params.search_ef
+    )
 
     print("="*60)
     print("Document Ingestion Pipeline")
@@ -265,20 +749,27 @@ def main():
 
     # Initialize and run ingestion
     ingestion = DocumentIngestion(
-        docs_path="documents",
+        docs_path=args.docs,
         db_path="chroma_db",
         embedding_model="all-MiniLM-L6-v2",
         chunk_size=500,  # words
-        chunk_overlap=50
+        chunk_overlap=50,
+        bundle_path=args.bundle,
+        tenant=tenant,
+        vector_dtype=args.vector_dtype,
+        ann_params=ann_params,
+        workers=args.workers,
+        dedup=args.dedup
     )
 
     stats = ingestion.ingest_documents()
 
     # Save stats
-    with open('ingestion_stats.json', 'w') as f:
+    stats_file = 'ingestion_stats.json' if tenant == DEFAULT_TENANT else f'ingestion_stats.{tenant}.json'
+    with open(stats_file, 'w') as f:
         json.dump(stats, f, indent=2)
 
-    print("\n📊 Stats saved to ingestion_stats.json")
+    print(f"\n📊 Stats saved to {stats_file}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+"""
+Deterministic on-disk cache for LLM responses.
+Stores generated answers in a local SQLite file keyed by the full generation request,
+with size-bounded LRU eviction and record/replay modes for offline evaluation.
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from typing import Optional, Dict, Any
+
+
+CACHE_MODES = ("off", "readwrite", "record", "replay")
+
+
+class CacheMiss(KeyError):
+    """Raised in replay mode when a prompt has no recorded response."""
+
+
+class LLMResponseCache:
+    def __init__(self,
+                 path: str = "llm_cache.sqlite",
+                 mode: str = "readwrite",
+                 max_bytes: int = 64 * 1024 * 1024):
+        """
+        Initialize LLM response cache.
+
+        Args:
+            path: SQLite file holding cached responses
+            mode: readwrite (serve hits, store misses), record (always call the
+                  LLM and overwrite), replay (serve hits only, never call the LLM)
+            max_bytes: Upper bound on stored (compressed) response bytes
+        """
+        if mode not in CACHE_MODES or mode == "off":
+            raise ValueError(f"Unsupported cache mode: {mode}")
+
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                   key TEXT PRIMARY KEY,
+                   provider TEXT NOT NULL,
+                   model_name TEXT NOT NULL,
+                   response BLOB NOT NULL,
+                   size INTEGER NOT NULL,
+                   created_at REAL NOT NULL,
+                   last_access REAL NOT NULL
+               )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)"
+        )
+        self._conn.commit()
+        # Running total of stored bytes, so puts don't scan the table
+        self._total_bytes = self._stored_bytes()
+
+    @classmethod
+    def from_env(cls) -> Optional["LLMResponseCache"]:
+        """Build a cache from LLM_CACHE_* environment variables (None when disabled)."""
+        mode = os.getenv("LLM_CACHE_MODE", "off").lower()
+        if mode == "off":
+            return None
+        return cls(
+            path=os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite"),
+            mode=mode,
+            max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "64")) * 1024 * 1024)
+        )
+
+    @staticmethod
+    def make_key(provider: str,
+                 model_name: str,
+                 prompt: str,
+                 max_tokens: int,
+                 temperature: float,
+                 top_p: float) -> str:
+        """Build a stable cache key for one generation request."""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        payload = json.dumps(
+            [provider, model_name, prompt_hash, int(max_tokens), float(temperature), float(top_p)],
+            separators=(',', ':')
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @property
+    def reads_enabled(self) -> bool:
+        return self.mode in ("readwrite", "replay")
+
+    @property
+    def writes_enabled(self) -> bool:
+        return self.mode in ("readwrite", "record")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response.
+
+        Returns:
+            Cached answer text, or None on a miss (replay mode raises CacheMiss)
+        """
+        if not self.reads_enabled:
+            return None
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+                self._conn.execute(
+                    "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+                )
+                self._conn.commit()
+
+        if row is None:
+            if self.mode == "replay":
+                raise CacheMiss(f"No recorded LLM response for key {key[:12]} (replay mode)")
+            return None
+
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, key: str, provider: str, model_name: str, response: str):
+        """Store a response and evict least recently used entries over the size budget."""
+        if not self.writes_enabled:
+            return
+
+        blob = zlib.compress(response.encode('utf-8'))
+        now = time.time()
+
+        with self._lock:
+            replaced = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, provider, model_name, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, provider, model_name, blob, len(blob), now, now)
+            )
+            self.stats['stores'] += 1
+            self._total_bytes += len(blob) - (replaced[0] if replaced else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _stored_bytes(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self):
+        """Drop least recently used rows until the total size fits max_bytes."""
+        # Other workers may share the file: recount before evicting
+        total = self._stored_bytes()
+        self._total_bytes = total
+        if total <= self.max_bytes:
+            return
+
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self.stats['evictions'] += 1
+        self._total_bytes = total
+
+    def info(self) -> Dict[str, Any]:
+        """Return cache size and hit statistics."""
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            'mode': self.mode,
+            'path': self.path,
+            'entries': count,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            **self.stats
+        }
+
+    def clear(self):
+        """Remove all cached responses."""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._total_bytes = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,284 @@
+"""
+HTTP-level configuration for LLM API clients.
+Builds pooled, timeout-bounded OpenAI-compatible clients and runs completions under a
+total deadline, optionally hedging slow requests with a duplicate after a p95-based delay.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+
+# Endpoint and API key variable for each supported provider
+PROVIDERS = {
+    'openrouter': ("https://openrouter.ai/api/v1", "OPENROUTER_API_KEY"),
+    'groq': ("https://api.groq.com/openai/v1", "GROQ_API_KEY"),
+    'openai': (None, "OPENAI_API_KEY"),
+    # Any OpenAI-compatible endpoint, e.g. fake_llm.py for testing
+    'local': ("http://127.0.0.1:8089/v1", "LLM_API_KEY"),
+}
+
+
+class LLMTimeoutError(TimeoutError):
+    """Raised when a completion does not finish within the total deadline."""
+
+
+def bounded_client(client: "OpenAI", timeout: float) -> "OpenAI":
+    """
+    Client for one attempt: its HTTP timeout is the attempt's remaining deadline and it does
+    not retry, so an abandoned attempt releases its worker thread by the deadline.
+    """
+    return client.with_options(timeout=timeout, max_retries=0)
+
+
+def build_llm_client(api_key: str,
+                     base_url: Optional[str] = None,
+                     connect_timeout: Optional[float] = None,
+                     read_timeout: Optional[float] = None,
+                     max_connections: Optional[int] = None,
+                     max_retries: Optional[int] = None) -> "OpenAI":
+    """
+    Build an OpenAI-compatible client with an explicit connection pool and timeouts.
+
+    Args:
+        api_key: Provider API key
+        base_url: Provider endpoint (None for api.openai.com)
+        connect_timeout: Seconds to establish a connection (LLM_CONNECT_TIMEOUT)
+        read_timeout: Seconds to wait between bytes of the response (LLM_READ_TIMEOUT)
+        max_connections: Size of the HTTP connection pool (LLM_MAX_CONNECTIONS)
+        max_retries: Client-level retries on connection errors and 429/5xx (LLM_MAX_RETRIES)
+
+    Returns:
+        Configured OpenAI client
+    """
+    # Imported here so that importing this module stays cheap at worker boot
+    import httpx
+    from openai import OpenAI
+
+    if connect_timeout is None:
+        connect_timeout = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+    if read_timeout is None:
+        read_timeout = float(os.getenv("LLM_READ_TIMEOUT", "30"))
+    if max_connections is None:
+        max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "10"))
+    if max_retries is None:
+        max_retries = int(os.getenv("LLM_MAX_RETRIES", "1"))
+
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    http_client = httpx.Client(
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=30.0
+        )
+    )
+
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=max_retries,
+        http_client=http_client
+    )
+
+
+def build_provider_client(provider: str) -> "OpenAI":
+    """Build a pooled client for a named provider using its API key from the environment."""
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unsupported LLM provider: {provider}")
+
+    base_url, key_var = PROVIDERS[provider]
+    if provider == 'local':
+        base_url = os.getenv("LLM_BASE_URL", base_url)
+        return build_llm_client(base_url=base_url, api_key=os.getenv(key_var, "local"))
+
+    return build_llm_client(base_url=base_url, api_key=os.getenv(key_var, ""))
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """
+        Rolling window of request latencies.
+
+        Args:
+            window: Number of most recent samples kept
+            min_samples: Samples required before quantiles are reported
+        """
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the q-quantile of the window, or None with too few samples."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(q * len(samples)))
+        return samples[index]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class HedgedRequester:
+    def __init__(self,
+                 total_timeout: float = 45.0,
+                 hedge: bool = False,
+                 hedge_quantile: float = 0.95,
+                 initial_hedge_delay: float = 2.0,
+                 min_hedge_delay: float = 0.05,
+                 max_concurrency: int = 2,
+                 max_workers: Optional[int] = None):
+        """
+        Run LLM calls under a total deadline with optional hedging.
+
+        Args:
+            total_timeout: Hard deadline in seconds for one completion, including hedges
+            hedge: Send a duplicate request when the first one is slower than the delay
+            hedge_quantile: Latency quantile used as the hedge delay
+            initial_hedge_delay: Delay used until enough latencies were observed
+            min_hedge_delay: Lower bound on the hedge delay
+            max_concurrency: Completions running at once (the admission limit)
+            max_workers: Threads available for in-flight attempts (default: max_concurrency
+                         times the attempts per completion)
+        """
+        self.total_timeout = total_timeout
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.latency = LatencyTracker()
+        self.max_workers = max_workers or max_concurrency * (2 if hedge else 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix="llm-request")
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'timeouts': 0, 'errors': 0,
+                      'expired_in_queue': 0, 'max_queue_wait_s': 0.0}
+
+    @classmethod
+    def from_env(cls, total_timeout: Optional[float] = None) -> "HedgedRequester":
+        """Build a requester from LLM_TOTAL_TIMEOUT / LLM_HEDGE* environment variables."""
+        return cls(
+            total_timeout=total_timeout if total_timeout is not None else float(os.getenv("LLM_TOTAL_TIMEOUT", "45")),
+            hedge=os.getenv("LLM_HEDGE", "false").lower() == "true",
+            hedge_quantile=float(os.getenv("LLM_HEDGE_QUANTILE", "0.95")),
+            initial_hedge_delay=float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "2.0")),
+            max_concurrency=int(os.getenv("CHAT_MAX_CONCURRENT", "2"))
+        )
+
+    def hedge_delay(self) -> float:
+        """Current delay before a duplicate request is sent."""
+        observed = self.latency.quantile(self.hedge_quantile)
+        if observed is None:
+            return self.initial_hedge_delay
+        return max(self.min_hedge_delay, observed)
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _submit(self, fn: Callable[[float], Any], deadline: float):
+        queued = time.monotonic()
+
+        def attempt():
+            # Time spent waiting for a worker counts against the deadline
+            start = time.monotonic()
+            with self._lock:
+                self.stats['max_queue_wait_s'] = max(self.stats['max_queue_wait_s'], round(start - queued, 3))
+            remaining = deadline - start
+            if remaining <= 0:
+                self._count('expired_in_queue')
+                raise LLMTimeoutError("LLM attempt waited for a worker past its deadline")
+            try:
+                result = fn(remaining)
+            except Exception as e:
+                if time.monotonic() >= deadline:
+                    raise LLMTimeoutError(f"LLM attempt hit its deadline: {e}") from e
+                raise
+            self.latency.record(time.monotonic() - start)
+            return result
+
+        return self._executor.submit(attempt)
+
+    def call(self, fn: Callable[[float], Any], timeout: Optional[float] = None) -> Any:
+        """
+        Run fn (one LLM request) and return the first successful result.
+
+        Args:
+            fn: Callable issuing one request, given the seconds left until the deadline to
+                use as its HTTP timeout (see bounded_client)
+            timeout: Deadline in seconds (defaults to total_timeout, never exceeds it)
+
+        A hedge is only sent while the first attempt is still running. The losing
+        attempt is cancelled if it has not started yet; otherwise its response is
+        discarded when it arrives, at the latest when its HTTP timeout (the deadline) expires.
+
+        Raises:
+            LLMTimeoutError: No attempt finished before total_timeout
+            Exception: The error of the last failed attempt
+        """
+        self._count('requests')
+        budget = self.total_timeout if timeout is None else min(timeout, self.total_timeout)
+        deadline = time.monotonic() + budget
+        attempts = [self._submit(fn, deadline)]
+
+        if self.hedge:
+            delay = min(self.hedge_delay(), budget)
+            done, _ = wait(attempts, timeout=delay, return_when=FIRST_COMPLETED)
+            if not done and time.monotonic() < deadline:
+                attempts.append(self._submit(fn, deadline))
+                self._count('hedged')
+
+        pending = list(attempts)
+        last_error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            done, not_done = wait(pending, timeout=max(0.0, remaining),
+                                  return_when=FIRST_COMPLETED)
+            if not done:
+                for future in not_done:
+                    future.cancel()
+                self._count('timeouts')
+                raise LLMTimeoutError(
+                    f"LLM request did not complete within {budget:.1f}s"
+                )
+
+            for future in done:
+                if future.exception() is None:
+                    for other in not_done:
+                        other.cancel()
+                    if future is not attempts[0]:
+                        self._count('hedge_wins')
+                    return future.result()
+                last_error = future.exception()
+
+            pending = list(not_done)
+
+        self._count('timeouts' if isinstance(last_error, LLMTimeoutError) else 'errors')
+        raise last_error
+
+    def info(self) -> Dict[str, Any]:
+        """Return hedging counters and observed latency quantiles."""
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            'hedge_enabled': self.hedge,
+            'max_workers': self.max_workers,
+            'hedge_delay_s': self.hedge_delay(),
+            'latency_p50_s': self.latency.quantile(0.5),
+            'latency_p95_s': self.latency.quantile(0.95),
+            'samples': len(self.latency)
+        }
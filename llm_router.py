@@ -0,0 +1,306 @@
+"""
+Latency-aware routing across several LLM providers.
+Tracks rolling latency and error-rate estimates per provider/model, sends each request to
+the fastest healthy route, opens a circuit breaker on repeated failures and fails over
+to the next route within the request deadline.
+"""
+
+import os
+import time
+import random
+import threading
+from typing import Any, Dict, List, Optional
+
+from llm_client import PROVIDERS, bounded_client, build_provider_client, HedgedRequester, LLMTimeoutError
+
+
+class NoHealthyRouteError(RuntimeError):
+    """Raised when every route is unavailable or failed within the deadline."""
+
+
+class Route:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self,
+                 provider: str,
+                 model_name: str,
+                 client: Any = None,
+                 requester: Optional[HedgedRequester] = None,
+                 alpha: float = 0.2,
+                 failure_threshold: int = 3,
+                 cooldown: float = 30.0):
+        """
+        One provider/model pair with its health estimates and circuit breaker.
+
+        Args:
+            provider: Provider name (openrouter, groq, openai, local)
+            model_name: Model identifier at that provider
+            client: OpenAI-compatible client (built from the provider when omitted)
+            requester: Deadline/hedging wrapper for calls on this route
+            alpha: Weight of the newest sample in the moving averages
+            failure_threshold: Consecutive failures that open the circuit
+            cooldown: Seconds the circuit stays open before a trial request
+        """
+        self.provider = provider
+        self.model_name = model_name
+        self._client = client
+        self.requester = requester if requester is not None else HedgedRequester.from_env()
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.stats = {'requests': 0, 'successes': 0, 'failures': 0, 'circuit_opens': 0, 'cut_short': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> Any:
+        """Provider client, built on first use."""
+        if self._client is None:
+            self._client = build_provider_client(self.provider)
+        return self._client
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}:{self.model_name}"
+
+    def score(self, error_penalty: float) -> float:
+        """Expected latency inflated by the recent error rate (lower is better)."""
+        return self.latency_ewma * (1.0 + error_penalty * self.error_rate)
+
+    def acquire(self, now: float) -> bool:
+        """Check whether a request may use this route, moving open circuits to half-open."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self, seconds: float):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['successes'] += 1
+            if self.latency_ewma is None:
+                self.latency_ewma = seconds
+            else:
+                self.latency_ewma = (1 - self.alpha) * self.latency_ewma + self.alpha * seconds
+            self.error_rate = (1 - self.alpha) * self.error_rate
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self.trial_in_flight = False
+
+    def record_failure(self, now: float):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['failures'] += 1
+            self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha
+            self.consecutive_failures += 1
+            reopen = self.state == self.HALF_OPEN
+            if reopen or (self.state == self.CLOSED
+                          and self.consecutive_failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = now
+                self.stats['circuit_opens'] += 1
+            self.trial_in_flight = False
+
+    def record_cut_short(self):
+        """An attempt stopped by the request's overall deadline (says nothing about the route)."""
+        with self._lock:
+            # Counted as tried so an unmeasured route is not probed first on every request
+            self.stats['requests'] += 1
+            self.stats['cut_short'] += 1
+            self.trial_in_flight = False
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'route': self.name,
+                'state': self.state,
+                'latency_ewma_s': self.latency_ewma,
+                'error_rate': self.error_rate,
+                'consecutive_failures': self.consecutive_failures,
+                **self.stats,
+                'requester': self.requester.info()
+            }
+
+
+class LLMRouter:
+    def __init__(self,
+                 routes: List[Route],
+                 deadline: float = 45.0,
+                 error_penalty: float = 4.0,
+                 explore_probability: float = 0.05):
+        """
+        Initialize router.
+
+        Args:
+            routes: Candidate provider/model routes in preference order
+            deadline: Total seconds for one completion across all failovers
+            error_penalty: How strongly the error rate inflates a route's score
+            explore_probability: Chance of trying a random healthy route first so
+                                 stale latency estimates get refreshed
+        """
+        if not routes:
+            raise ValueError("LLMRouter needs at least one route")
+
+        self.routes = routes
+        self.deadline = deadline
+        self.error_penalty = error_penalty
+        self.explore_probability = explore_probability
+        self.stats = {'requests': 0, 'failovers': 0, 'exhausted': 0}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    @classmethod
+    def from_env(cls) -> Optional["LLMRouter"]:
+        """
+        Build a router from LLM_ROUTES (None when unset).
+
+        LLM_ROUTES is a comma-separated list of provider:model entries, e.g.
+        "groq:llama-3.1-8b-instant,openrouter:meta-llama/llama-3.1-8b-instruct:free".
+
+        Each attempt is limited to LLM_ROUTE_TIMEOUT (default half of LLM_TOTAL_TIMEOUT), so a
+        hung route times out on its own budget, counts as a failure and leaves time to fail over.
+
+        Raises:
+            ValueError: An entry is malformed, names an unknown provider or a provider whose
+                        API key variable is unset, or LLM_ROUTE_TIMEOUT is not below
+                        LLM_TOTAL_TIMEOUT (caught at startup, not on every request)
+        """
+        spec = os.getenv("LLM_ROUTES", "").strip()
+        if not spec:
+            return None
+
+        deadline = float(os.getenv("LLM_TOTAL_TIMEOUT", "45"))
+        route_timeout = float(os.getenv("LLM_ROUTE_TIMEOUT") or deadline / 2)
+        if not 0 < route_timeout < deadline:
+            raise ValueError(f"LLM_ROUTE_TIMEOUT must be between 0 and LLM_TOTAL_TIMEOUT "
+                             f"({deadline}s), got {route_timeout}s")
+
+        routes = []
+        for entry in spec.split(','):
+            provider, _, model_name = entry.strip().partition(':')
+            if not model_name:
+                raise ValueError(f"Invalid LLM_ROUTES entry (expected provider:model): {entry}")
+            if provider not in PROVIDERS:
+                raise ValueError(f"Unknown LLM provider in LLM_ROUTES: {provider} "
+                                 f"(choose from {', '.join(PROVIDERS)})")
+            key_var = PROVIDERS[provider][1]
+            if provider != 'local' and not os.getenv(key_var):
+                raise ValueError(f"LLM_ROUTES uses {provider} but {key_var} is not set")
+            routes.append(Route(
+                provider,
+                model_name,
+                requester=HedgedRequester.from_env(total_timeout=route_timeout),
+                failure_threshold=int(os.getenv("LLM_ROUTE_FAILURE_THRESHOLD", "3")),
+                cooldown=float(os.getenv("LLM_ROUTE_COOLDOWN", "30"))
+            ))
+
+        return cls(routes, deadline=deadline)
+
+    @property
+    def route_spec(self) -> str:
+        return ",".join(route.name for route in self.routes)
+
+    def candidates(self) -> List[Route]:
+        """
+        Routes ordered fastest first.
+
+        Routes never tried are probed first; routes that only ever failed go last.
+        """
+        unmeasured = [r for r in self.routes if r.stats['requests'] == 0]
+        measured = sorted((r for r in self.routes if r.latency_ewma is not None),
+                          key=lambda r: r.score(self.error_penalty))
+        failing = [r for r in self.routes
+                   if r.stats['requests'] > 0 and r.latency_ewma is None]
+        ordered = unmeasured + measured + failing
+
+        if len(ordered) > 1 and self._random.random() < self.explore_probability:
+            ordered.insert(0, ordered.pop(self._random.randrange(1, len(ordered))))
+
+        return ordered
+
+    def complete(self, **request: Any) -> Any:
+        """
+        Run one chat completion on the best available route.
+
+        Args:
+            **request: chat.completions.create arguments except model
+
+        Returns:
+            Provider response
+
+        Raises:
+            NoHealthyRouteError: Every route was open, failed or ran out of time
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+
+        deadline = time.monotonic() + self.deadline
+        attempted = []
+        last_error = None
+
+        for route in self.candidates():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not route.acquire(time.monotonic()):
+                continue
+
+            if attempted:
+                with self._lock:
+                    self.stats['failovers'] += 1
+            attempted.append(route.name)
+
+            start = time.monotonic()
+            try:
+                response = route.requester.call(
+                    lambda timeout, route=route: bounded_client(route.client, timeout).chat.completions.create(
+                        model=route.model_name, **request
+                    ),
+                    timeout=remaining
+                )
+            except Exception as e:
+                last_error = e
+                if isinstance(e, LLMTimeoutError) and remaining < route.requester.total_timeout:
+                    # The attempt ran on min(route budget, remaining) and the request deadline
+                    # was the smaller one: it stopped the route before its own time limit
+                    route.record_cut_short()
+                    print(f"⚠️  LLM route {route.name} cut short by the request deadline")
+                    continue
+                route.record_failure(time.monotonic())
+                print(f"⚠️  LLM route {route.name} failed: {type(e).__name__}: {e}")
+                continue
+
+            route.record_success(time.monotonic() - start)
+            return response
+
+        with self._lock:
+            self.stats['exhausted'] += 1
+
+        if not attempted:
+            raise NoHealthyRouteError("All LLM routes have open circuits")
+        if isinstance(last_error, LLMTimeoutError) or last_error is None:
+            raise NoHealthyRouteError(f"LLM deadline exceeded after trying {attempted}") from last_error
+        raise NoHealthyRouteError(f"All LLM routes failed ({attempted}): {last_error}") from last_error
+
+    def info(self) -> Dict[str, Any]:
+        """Return router counters and per-route health."""
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            'deadline_s': self.deadline,
+            'routes': [route.info() for route in self.routes]
+        }
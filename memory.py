@@ -0,0 +1,286 @@
+"""
+Memory accounting and budget enforcement for the serving process.
+Reports resident memory (RSS), per-component estimates (embedding models, vector indexes,
+caches, sessions) and, when tracing is on, the top Python allocators. A memory budget sheds
+caches when RSS nears it and rejects new work before the kernel's OOM killer steps in.
+"""
+
+import os
+import gc
+import time
+import ctypes
+import ctypes.util
+import threading
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from admission import AdmissionRejected
+
+
+_MB = 1024 * 1024
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size of this process (None where it can't be read)."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Highest resident set size of this process so far."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def release_freed_memory():
+    """Collect garbage and hand freed heap pages back to the OS (glibc keeps them otherwise)."""
+    gc.collect()
+    libc_name = ctypes.util.find_library('c')
+    if libc_name:
+        try:
+            ctypes.CDLL(libc_name).malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+def start_tracing_from_env():
+    """Start tracemalloc when MEMORY_TRACEMALLOC is set (number of frames kept per allocation)."""
+    frames = int(os.getenv("MEMORY_TRACEMALLOC", "0"))
+    if frames > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        print(f"🔬 tracemalloc tracing Python allocations ({frames} frames)")
+
+
+def top_allocations(limit: int = 10) -> Optional[Dict[str, Any]]:
+    """Largest Python allocation sites by line, or None unless tracemalloc is tracing."""
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'tracing': True,
+        'traced_mb': round(current / _MB, 2),
+        'traced_peak_mb': round(peak / _MB, 2),
+        'top': [
+            {
+                'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                'size_kb': round(stat.size / 1024, 1),
+                'count': stat.count
+            }
+            for stat in snapshot.statistics('lineno')[:limit]
+        ]
+    }
+
+
+def model_bytes(model: Any) -> Optional[int]:
+    """Parameter and buffer bytes of a torch-backed embedding model."""
+    try:
+        tensors = list(model.parameters()) + list(model.buffers())
+    except AttributeError:
+        return None
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def index_bytes(collection: Any) -> Dict[str, Any]:
+    """Estimated size of a serving index (HNSW in memory, or a bundle mapped from disk)."""
+    from tenants import estimate_chroma_bytes
+
+    bundle = getattr(collection, 'bundle', None)
+    if bundle is not None:
+        # Pages of the mapping are file-backed: counted in RSS once touched, but reclaimable
+        return {'source': 'bundle', 'bytes': os.path.getsize(bundle.path), 'mmap': True}
+    sample = collection.get(limit=1, include=['embeddings'])['embeddings']
+    dimension = len(sample[0]) if sample else 0
+    return {'source': 'chroma', 'bytes': estimate_chroma_bytes(collection.count(), dimension), 'mmap': False}
+
+
+def component_bytes(rag: Any, session_store: Any) -> Dict[str, Any]:
+    """
+    Per-component memory estimates in bytes.
+
+    Estimates count payload data (weights, vectors, text); interpreter, library code and
+    allocator overhead show up as the difference to RSS.
+    """
+    components = {}
+    if rag is not None:
+        for name, model in list(rag.models.items()):
+            components[f"embedding_model:{name}"] = model_bytes(model)
+        components[f"index:{rag.collection.name}"] = index_bytes(rag.collection)['bytes']
+        if rag.standby_collection is not None:
+            components[f"standby_index:{rag.standby_collection.name}"] = index_bytes(rag.standby_collection)['bytes']
+        components['tenant_indexes'] = rag.tenants.memory_bytes
+        if rag.faq_cache is not None:
+            components['faq_cache'] = rag.faq_cache.memory_bytes()
+        if rag.extractive is not None:
+            components['extractive_sentence_cache'] = rag.extractive.memory_bytes()
+        if rag.scope_gate is not None:
+            components['scope_centroids'] = rag.scope_gate.memory_bytes()
+    if session_store is not None:
+        components['sessions'] = session_store.memory_bytes()
+    return components
+
+
+class MemoryBudget:
+    def __init__(self,
+                 budget_bytes: int,
+                 shed_ratio: float = 0.85,
+                 reject_ratio: float = 0.95,
+                 shed_interval: float = 10.0,
+                 retry_after: int = 5):
+        """
+        Initialize the RSS budget.
+
+        Args:
+            budget_bytes: Memory the worker may use (below the instance limit, to leave headroom)
+            shed_ratio: Share of the budget at which caches are shed
+            reject_ratio: Share of the budget at which new work is rejected
+            shed_interval: Minimum seconds between shedding rounds
+            retry_after: Retry-After hint (seconds) for rejected requests
+        """
+        if not 0 < shed_ratio <= reject_ratio:
+            raise ValueError(f"Memory budget needs 0 < shed_ratio <= reject_ratio (got {shed_ratio}, {reject_ratio})")
+        self.budget_bytes = budget_bytes
+        self.shed_ratio = shed_ratio
+        self.reject_ratio = reject_ratio
+        self.shed_interval = shed_interval
+        self.retry_after = retry_after
+
+        self._shedders = []
+        self._lock = threading.Lock()
+        self._last_shed = 0.0
+        self.last_rss = None
+        self.last_shed = None
+        self.stats = {'checks': 0, 'shed_rounds': 0, 'rejected': 0}
+        self.shed_counts = {}
+
+    @classmethod
+    def from_env(cls) -> Optional["MemoryBudget"]:
+        """Build from MEMORY_BUDGET_MB / MEMORY_* environment variables (None when unset)."""
+        budget_mb = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+        if budget_mb <= 0:
+            return None
+        if rss_bytes() is None:
+            print("⚠️  MEMORY_BUDGET_MB is set but RSS can't be read on this platform; budget disabled")
+            return None
+        return cls(
+            budget_bytes=int(budget_mb * _MB),
+            shed_ratio=float(os.getenv("MEMORY_SHED_RATIO", "0.85")),
+            reject_ratio=float(os.getenv("MEMORY_REJECT_RATIO", "0.95")),
+            shed_interval=float(os.getenv("MEMORY_SHED_INTERVAL", "10"))
+        )
+
+    @property
+    def shed_bytes(self) -> int:
+        return int(self.budget_bytes * self.shed_ratio)
+
+    @property
+    def reject_bytes(self) -> int:
+        return int(self.budget_bytes * self.reject_ratio)
+
+    def add_shedder(self, name: str, shed: Callable[[], Any]):
+        """Register a cache to drop under memory pressure (shedders run in registration order)."""
+        self._shedders.append((name, shed))
+        self.shed_counts[name] = 0
+
+    def shed(self, rss: int) -> List[Tuple[str, float]]:
+        """Run shedders until RSS is back under the shed threshold."""
+        steps = []
+        for name, shed in self._shedders:
+            try:
+                shed()
+            except Exception as e:
+                print(f"⚠️  Shedding {name} failed: {e}")
+                continue
+            release_freed_memory()
+            self.shed_counts[name] += 1
+            rss = rss_bytes() or rss
+            steps.append((name, round(rss / _MB, 1)))
+            if rss < self.shed_bytes:
+                break
+        return steps
+
+    def check(self) -> int:
+        """Read RSS and shed caches if it crossed the shed threshold."""
+        rss = rss_bytes() or 0
+        with self._lock:
+            self.stats['checks'] += 1
+            self.last_rss = rss
+            if rss < self.shed_bytes or time.monotonic() - self._last_shed < self.shed_interval:
+                return rss
+            self._last_shed = time.monotonic()
+            self.stats['shed_rounds'] += 1
+            before = rss
+            steps = self.shed(rss)
+            rss = rss_bytes() or rss
+            self.last_rss = rss
+            self.last_shed = {'at': time.time(), 'rss_before_mb': round(before / _MB, 1),
+                              'rss_after_mb': round(rss / _MB, 1), 'steps': steps}
+        print(f"🧹 Memory at {before / _MB:.0f} MB (shed threshold {self.shed_bytes / _MB:.0f} MB): "
+              f"shed {', '.join(name for name, _ in steps) or 'nothing'} -> {rss / _MB:.0f} MB")
+        return rss
+
+    def admit(self):
+        """
+        Check memory before starting new work.
+
+        Raises:
+            AdmissionRejected: RSS is above the reject threshold even after shedding
+        """
+        rss = self.check()
+        if rss >= self.reject_bytes:
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise AdmissionRejected('memory', self.retry_after)
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'budget_mb': round(self.budget_bytes / _MB, 1),
+                'shed_at_mb': round(self.shed_bytes / _MB, 1),
+                'reject_at_mb': round(self.reject_bytes / _MB, 1),
+                'last_rss_mb': round(self.last_rss / _MB, 1) if self.last_rss is not None else None,
+                **self.stats,
+                'shed_counts': dict(self.shed_counts),
+                'last_shed': self.last_shed
+            }
+
+
+def memory_report(rag: Any, session_store: Any, budget: Optional[MemoryBudget] = None,
+                  top: int = 0) -> Dict[str, Any]:
+    """RSS, per-component estimates and (with top > 0 and tracing on) the top allocators."""
+    rss = rss_bytes()
+    peak = peak_rss_bytes()
+    if peak is not None and rss is not None:
+        # The kernel updates the high-water mark lazily, so it can trail the current RSS
+        peak = max(peak, rss)
+    components = component_bytes(rag, session_store)
+    attributed = sum(size for size in components.values() if size)
+    report = {
+        'pid': os.getpid(),
+        'rss_mb': round(rss / _MB, 1) if rss is not None else None,
+        'peak_rss_mb': round(peak / _MB, 1) if peak is not None else None,
+        'components_mb': {name: round(size / _MB, 2) if size is not None else None
+                          for name, size in components.items()},
+        'attributed_mb': round(attributed / _MB, 1),
+        # Interpreter, torch/chromadb code, thread stacks and allocator fragmentation
+        'unattributed_mb': round((rss - attributed) / _MB, 1) if rss is not None else None,
+        'budget': budget.info() if budget is not None else None,
+        'tracemalloc': {'tracing': tracemalloc.is_tracing()}
+    }
+    if top > 0:
+        report['tracemalloc'] = top_allocations(top) or {
+            'tracing': False,
+            'hint': "Set MEMORY_TRACEMALLOC=<frames> and restart to trace Python allocations"
+        }
+    return report
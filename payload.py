@@ -0,0 +1,370 @@
+"""
+Response payload shaping and encoding.
+Trims /chat and /search responses to the requested fields and detail, serializes JSON with orjson
+when it is installed and compresses responses with brotli or gzip according to Accept-Encoding.
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import argparse
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the standard library encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+
+# How much of each source is returned: full chunk text, the 300-char snippet, or chunk ids only
+SOURCE_DETAILS = ('full', 'snippet', 'ids')
+
+_COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript')
+
+
+def parse_fields(fields: Any) -> Optional[List[str]]:
+    """
+    Validate a top-level field selection.
+
+    Args:
+        fields: List of response keys, or a comma-separated string
+
+    Returns:
+        Field names, or None to return every field
+
+    Raises:
+        ValueError: Not a string or list of non-empty strings
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    if not isinstance(fields, list) or not all(isinstance(f, str) and f.strip() for f in fields):
+        raise ValueError("fields must be a list of response field names")
+    return [f.strip() for f in fields]
+
+
+def parse_include(include: Optional[str], default: str = 'full') -> str:
+    """
+    Validate the source detail level.
+
+    Raises:
+        ValueError: Not one of SOURCE_DETAILS
+    """
+    include = (include or default).strip().lower()
+    if include not in SOURCE_DETAILS:
+        raise ValueError(f"include must be one of: {', '.join(SOURCE_DETAILS)}")
+    return include
+
+
+def shape_response(result: Dict[str, Any],
+                   fields: Optional[List[str]] = None,
+                   include: str = 'full') -> Dict[str, Any]:
+    """
+    Apply field selection and source detail to a query result.
+
+    The result (possibly shared with coalesced callers or the FAQ cache) is not modified.
+
+    Args:
+        result: RAGPipeline.query result
+        fields: Top-level keys to keep (None keeps all)
+        include: 'full', 'snippet' (drops full_text) or 'ids' (source_num, doc_id, chunk_id)
+    """
+    shaped = {key: value for key, value in result.items() if fields is None or key in fields}
+
+    if 'sources' in shaped and include != 'full':
+        if include == 'snippet':
+            shaped['sources'] = [{k: v for k, v in source.items() if k != 'full_text'}
+                                 for source in shaped['sources']]
+        else:
+            shaped['sources'] = [{k: source.get(k) for k in ('source_num', 'doc_id', 'chunk_id')}
+                                 for source in shaped['sources']]
+    return shaped
+
+
+def shape_hits(hits: List[Dict[str, Any]], include: str = 'snippet') -> List[Dict[str, Any]]:
+    """
+    Search hits as returned to clients.
+
+    Args:
+        hits: RAGPipeline.search hits
+        include: 'full' (chunk text and metadata), 'snippet' (300-char snippet and metadata)
+                 or 'ids' (rank, chunk_id, doc_id and score)
+    """
+    shaped = []
+    for hit in hits:
+        metadata = hit['metadata']
+        row = {'rank': hit['rank'], 'chunk_id': hit['chunk_id'], 'doc_id': metadata['doc_id'], 'score': hit['score']}
+        if include != 'ids':
+            row['title'] = metadata['title']
+            row['distance'] = hit['distance']
+            if 'rerank_score' in hit:
+                row['rerank_score'] = hit['rerank_score']
+            if include == 'full':
+                row['text'] = hit['text']
+            else:
+                row['snippet'] = hit['text'][:300] + "..." if len(hit['text']) > 300 else hit['text']
+            row['metadata'] = metadata
+        shaped.append(row)
+    return shaped
+
+
+class PayloadStats:
+    def __init__(self):
+        """Per-worker counters of response sizes, serialization time and encodings."""
+        self._lock = threading.Lock()
+        self.serialized = 0
+        self.serialize_seconds = 0.0
+        self.responses = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.encodings = Counter()
+
+    def record_serialize(self, seconds: float):
+        with self._lock:
+            self.serialized += 1
+            self.serialize_seconds += seconds
+
+    def record_response(self, raw_bytes: int, sent_bytes: int, encoding: str):
+        with self._lock:
+            self.responses += 1
+            self.raw_bytes += raw_bytes
+            self.sent_bytes += sent_bytes
+            self.encodings[encoding] += 1
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'json_encoder': 'orjson' if orjson is not None else 'json',
+                'serialized': self.serialized,
+                'avg_serialize_ms': round(self.serialize_seconds * 1000 / self.serialized, 3) if self.serialized else None,
+                'responses': self.responses,
+                'avg_raw_bytes': self.raw_bytes // self.responses if self.responses else None,
+                'avg_sent_bytes': self.sent_bytes // self.responses if self.responses else None,
+                'compression_ratio': round(self.sent_bytes / self.raw_bytes, 3) if self.raw_bytes else None,
+                'encodings': dict(self.encodings)
+            }
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    def __init__(self, app, stats: Optional[PayloadStats] = None):
+        """
+        Flask JSON provider using orjson (when installed) that records serialization time.
+
+        Args:
+            app: Flask application
+            stats: Where serialization time is recorded
+        """
+        super().__init__(app)
+        self.stats = stats or PayloadStats()
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return self._dumps_bytes(obj, **kwargs).decode('utf-8')
+
+    def _dumps_bytes(self, obj: Any, **kwargs: Any) -> bytes:
+        # Callers asking for indent/sort_keys etc. get the standard encoder
+        if orjson is not None and not kwargs:
+            try:
+                return orjson.dumps(obj, default=self.default,
+                                    option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+            except (orjson.JSONEncodeError, TypeError):
+                pass
+        return super().dumps(obj, **kwargs).encode('utf-8')
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        dump_args = {}
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            dump_args['indent'] = 2
+
+        start = time.perf_counter()
+        body = self._dumps_bytes(obj, **dump_args) if dump_args else self._dumps_bytes(obj)
+        self.stats.record_serialize(time.perf_counter() - start)
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick 'br' (if brotli is installed) or 'gzip' from an Accept-Encoding header."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+
+    for encoding in (('br', 'gzip') if brotli is not None else ('gzip',)):
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str, gzip_level: int = 6, brotli_quality: int = 4) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+
+class ResponseCompressor:
+    def __init__(self,
+                 enabled: bool = True,
+                 min_bytes: int = 1024,
+                 gzip_level: int = 6,
+                 brotli_quality: int = 4,
+                 stats: Optional[PayloadStats] = None):
+        """
+        Initialize Accept-Encoding based response compression.
+
+        Args:
+            enabled: Compress at all (disable when a proxy already compresses)
+            min_bytes: Smaller bodies are sent uncompressed
+            gzip_level: gzip compression level (1-9)
+            brotli_quality: brotli quality (0-11; low values are fast enough per request)
+            stats: Where sizes are recorded
+        """
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.stats = stats or PayloadStats()
+
+    @classmethod
+    def from_env(cls, stats: Optional[PayloadStats] = None) -> "ResponseCompressor":
+        """Build a compressor from RESPONSE_COMPRESSION / COMPRESS_* environment variables."""
+        return cls(
+            enabled=os.getenv("RESPONSE_COMPRESSION", "true").lower() == "true",
+            min_bytes=int(os.getenv("COMPRESS_MIN_BYTES", "1024")),
+            gzip_level=int(os.getenv("COMPRESS_GZIP_LEVEL", "6")),
+            brotli_quality=int(os.getenv("COMPRESS_BROTLI_QUALITY", "4")),
+            stats=stats
+        )
+
+    def __call__(self, response, accept_encoding: str):
+        """Compress a Flask response in place if the client accepts it."""
+        if (response.direct_passthrough or response.is_streamed
+                or response.mimetype not in _COMPRESSIBLE_MIMETYPES):
+            return response
+
+        body = response.get_data()
+        encoding = None
+        if (self.enabled and len(body) >= self.min_bytes
+                and 'Content-Encoding' not in response.headers and 200 <= response.status_code < 300):
+            encoding = choose_encoding(accept_encoding)
+
+        if encoding is not None:
+            compressed = compress(body, encoding, self.gzip_level, self.brotli_quality)
+            response.set_data(compressed)
+            response.headers['Content-Encoding'] = encoding
+        if self.enabled:
+            response.vary.add('Accept-Encoding')
+
+        if response.mimetype == 'application/json':
+            self.stats.record_response(len(body), response.content_length or len(body), encoding or 'identity')
+        return response
+
+
+def benchmark(results: List[Dict[str, Any]], repeats: int = 50) -> List[Dict[str, Any]]:
+    """
+    Bytes per response and serialization time for each encoder, source detail and encoding.
+
+    Returns:
+        One row per combination, averaged over results
+    """
+    encoders = {'json': lambda obj: json.dumps(obj).encode('utf-8')}
+    if orjson is not None:
+        encoders['orjson'] = lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    encodings = ['identity', 'gzip'] + (['br'] if brotli is not None else [])
+
+    rows = []
+    for include in SOURCE_DETAILS:
+        shaped = [shape_response(result, include=include) for result in results]
+        for name, encode in encoders.items():
+            start = time.perf_counter()
+            for _ in range(repeats):
+                bodies = [encode(result) for result in shaped]
+            serialize_ms = (time.perf_counter() - start) * 1000 / (repeats * len(shaped))
+
+            for encoding in encodings:
+                start = time.perf_counter()
+                sizes = [len(body) if encoding == 'identity' else len(compress(body, encoding)) for body in bodies]
+                compress_ms = (time.perf_counter() - start) * 1000 / len(bodies)
+                rows.append({
+                    'include': include,
+                    'encoder': name,
+                    'encoding': encoding,
+                    'avg_bytes': sum(sizes) // len(sizes),
+                    'serialize_ms': round(serialize_ms, 4),
+                    'compress_ms': round(compress_ms if encoding != 'identity' else 0.0, 4)
+                })
+    return rows
+
+
+def sample_results(db_path: str, collection: str, top_k: int = 5, limit: int = 20) -> List[Dict[str, Any]]:
+    """/chat-shaped results built from stored chunks (no LLM call), for payload benchmarks."""
+    import chromadb
+    from chromadb.config import Settings
+    from rag import RAGPipeline
+
+    client = chromadb.PersistentClient(
+        path=db_path,
+        settings=Settings(anonymized_telemetry=False, allow_reset=True)
+    )
+    stored = client.get_collection(name=collection).get(include=['documents', 'metadatas'])
+    chunks = [{'chunk_id': chunk_id, 'text': text, 'metadata': metadata}
+              for chunk_id, text, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])]
+
+    results = []
+    for start in range(0, min(len(chunks), top_k * limit), top_k):
+        sources = RAGPipeline.format_sources(chunks[start:start + top_k])
+        answer = " ".join(f"{source['text_snippet'][:120]} [Source {source['source_num']}]" for source in sources)
+        results.append({
+            'answer': answer,
+            'sources': sources,
+            'question': "How many PTO days do I get?",
+            'num_sources': len(sources),
+            'latency_ms': 1234
+        })
+    return results
+
+
+def main():
+    """Print response size and serialization time for the ingested corpus."""
+    from tenants import collection_name
+
+    parser = argparse.ArgumentParser(description="Measure /chat payload size and serialization time")
+    parser.add_argument('--db-path', default=os.getenv("CHROMA_DB_PATH", "chroma_db"))
+    parser.add_argument('--tenant', default=None)
+    parser.add_argument('-k', type=int, default=int(os.getenv("TOP_K", "5")))
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    results = sample_results(args.db_path, collection_name(args.tenant), top_k=args.k)
+    if not results:
+        print("❌ No chunks found; run ingest.py first")
+        return 1
+
+    print(f"{len(results)} responses with {args.k} sources each")
+    print(f"{'include':<9}{'encoder':<8}{'encoding':<10}{'bytes':>8}{'serialize ms':>14}{'compress ms':>13}")
+    for row in benchmark(results, repeats=args.repeats):
+        print(f"{row['include']:<9}{row['encoder']:<8}{row['encoding']:<10}{row['avg_bytes']:>8}"
+              f"{row['serialize_ms']:>14.4f}{row['compress_ms']:>13.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Streaming, page-parallel PDF text extraction.
+Pages are extracted in worker processes (pypdf is pure Python, so threads would serialize on the
+GIL) and handed to the caller one at a time, in order, with a bounded number of pages in flight,
+so memory stays flat regardless of the PDF's size. Kept free of heavy imports because worker
+processes import this module.
+"""
+
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Iterator, Optional, Tuple
+
+from pypdf import PdfReader
+
+
+# A reader caches every object it resolves; reopen it periodically to drop extracted pages
+_PAGES_PER_READER = 64
+
+# Smaller PDFs are extracted in-process (pool round-trips would dominate)
+PARALLEL_MIN_PAGES = 16
+
+# Each worker is a separate interpreter; past a few, extraction is no longer the bottleneck
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class PdfPages:
+    def __init__(self, path: str):
+        """
+        Lazily opened PDF.
+
+        Args:
+            path: PDF file
+        """
+        self.path = path
+        self._file = None
+        self._reader = None
+        self._served = 0
+
+    def _open(self) -> PdfReader:
+        self.close()
+        # Passing a file object (not a path) keeps pypdf from reading the whole file into memory
+        self._file = open(self.path, 'rb')
+        self._reader = PdfReader(self._file)
+        self._served = 0
+        return self._reader
+
+    @property
+    def reader(self) -> PdfReader:
+        if self._reader is None or self._served >= _PAGES_PER_READER:
+            return self._open()
+        return self._reader
+
+    def __len__(self) -> int:
+        return len(self.reader.pages)
+
+    def title(self) -> Optional[str]:
+        """Title from the PDF document info, if set."""
+        metadata = self.reader.metadata
+        title = metadata.title if metadata is not None else None
+        return title.strip() if title and title.strip() else None
+
+    def text(self, page_index: int) -> str:
+        reader = self.reader
+        self._served += 1
+        return reader.pages[page_index].extract_text() or ""
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._reader = None
+
+
+# One open PDF per worker process
+_worker_pdf: Optional[PdfPages] = None
+
+
+def _extract_page(path: str, page_index: int) -> Tuple[int, str]:
+    """Worker task: text of one page as (1-based page number, text)."""
+    global _worker_pdf
+    if _worker_pdf is None or _worker_pdf.path != path:
+        if _worker_pdf is not None:
+            _worker_pdf.close()
+        _worker_pdf = PdfPages(path)
+    return page_index + 1, _worker_pdf.text(page_index)
+
+
+def create_executor(workers: Optional[int] = None) -> Optional[Executor]:
+    """
+    Process pool for page extraction, or None to extract in-process.
+
+    Workers are spawned rather than forked so they don't inherit the embedding model and
+    its threads from the ingesting process. A spawned worker re-imports the parent's
+    __main__, which is why ingest.py imports its heavy dependencies lazily.
+    """
+    workers = workers or DEFAULT_WORKERS
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def iter_pdf_pages(path: str,
+                   executor: Optional[Executor] = None,
+                   prefetch: int = 8,
+                   page_count: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Yield (page number, text) for every page, in order.
+
+    Args:
+        path: PDF file
+        executor: Pool extracting pages in parallel (None extracts in-process)
+        prefetch: Pages extracted ahead of the consumer
+        page_count: Number of pages, if already known
+    """
+    if page_count is None:
+        pages = PdfPages(path)
+        try:
+            page_count = len(pages)
+        finally:
+            pages.close()
+
+    if executor is None or page_count < PARALLEL_MIN_PAGES:
+        pages = PdfPages(path)
+        try:
+            for page_index in range(page_count):
+                yield page_index + 1, pages.text(page_index)
+        finally:
+            pages.close()
+        return
+
+    pending = deque()
+    next_page = 0
+    try:
+        while next_page < page_count or pending:
+            while next_page < page_count and len(pending) < prefetch:
+                pending.append(executor.submit(_extract_page, path, next_page))
+                next_page += 1
+            yield pending[0].result()
+            pending.popleft()
+    finally:
+        # Consumer stopped early (e.g. a failed document): drop pages not yet started
+        for future in pending:
+            future.cancel()
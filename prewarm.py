@@ -0,0 +1,269 @@
+"""
+Pre-warming of frequently asked questions.
+Answers a configured FAQ list (and the most frequent questions from the request log) at
+startup, keeps their embeddings, retrieved sources and answers in memory, serves matching
+questions from there and recomputes everything when the index version changes.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from coalesce import normalize_question
+
+
+class FAQCache:
+    def __init__(self, match_similarity: float = 0.0):
+        """
+        Initialize FAQ answer cache.
+
+        Args:
+            match_similarity: Also serve questions whose embedding has at least this
+                              cosine similarity to a warmed question (0 = exact match only)
+        """
+        self.match_similarity = match_similarity
+        self.version = None
+        self._entries = {}
+        self._matrix = None
+        self._keys = []
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'semantic_hits': 0, 'misses': 0, 'refreshes': 0}
+
+    @property
+    def needs_embedding(self) -> bool:
+        return self.match_similarity > 0
+
+    def reset(self, version: Optional[str]):
+        """Drop all entries (e.g. the index changed)."""
+        with self._lock:
+            self.version = version
+            self._entries = {}
+            self._matrix = None
+            self._keys = []
+            self.stats['refreshes'] += 1
+
+    def store(self, question: str, embedding: List[float], result: Dict[str, Any], version: Optional[str]):
+        """Remember a warmed answer (ignored if the index changed meanwhile)."""
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        with self._lock:
+            if version != self.version:
+                return
+            key = normalize_question(question)
+            self._entries[key] = {'question': question, 'embedding': vector, 'result': result,
+                                  'warmed_at': time.time()}
+            self._keys = list(self._entries)
+            self._matrix = np.stack([self._entries[k]['embedding'] for k in self._keys])
+
+    def lookup(self, question: str, embedding: Optional[List[float]] = None) -> Optional[Dict[str, Any]]:
+        """Return the warmed result for a question, or None."""
+        with self._lock:
+            entry = self._entries.get(normalize_question(question))
+            if entry is not None:
+                self.stats['hits'] += 1
+                return entry['result']
+
+            vector = np.asarray(embedding, dtype=np.float32) if embedding is not None else None
+            # A vector from another embedding model (index swapped meanwhile) can't match
+            if (vector is not None and self.needs_embedding and self._matrix is not None
+                    and vector.shape[0] == self._matrix.shape[1]):
+                similarities = self._matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.match_similarity:
+                    self.stats['semantic_hits'] += 1
+                    return self._entries[self._keys[best]]['result']
+
+            self.stats['misses'] += 1
+            return None
+
+    def memory_bytes(self) -> int:
+        """Approximate size of the warmed answers and their embeddings."""
+        with self._lock:
+            size = self._matrix.nbytes if self._matrix is not None else 0
+            for entry in self._entries.values():
+                result = entry['result']
+                size += entry['embedding'].nbytes + len(result.get('answer', ''))
+                size += sum(len(source.get('full_text', '')) + len(source.get('text_snippet', ''))
+                            for source in result.get('sources', []))
+            return size
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'index_version': self.version,
+                'match_similarity': self.match_similarity,
+                **self.stats
+            }
+
+
+def load_faq_questions(faq_path: Optional[str] = "eval_questions.json",
+                       log_path: Optional[str] = None,
+                       top_n: int = 20) -> List[str]:
+    """
+    Questions to pre-warm: the FAQ file plus the top-N most frequent logged questions.
+
+    Args:
+        faq_path: JSON list of strings or of objects with a "question" field
+        log_path: Request log with one JSON object per line ({"question": ...})
+        top_n: Logged questions to add, most frequent first
+
+    Returns:
+        Questions, deduplicated after normalization
+    """
+    questions = []
+    if faq_path and os.path.exists(faq_path):
+        with open(faq_path, 'r', encoding='utf-8') as f:
+            questions += [q['question'] if isinstance(q, dict) else q for q in json.load(f)]
+
+    if log_path and os.path.exists(log_path) and top_n > 0:
+        counts = Counter()
+        originals = {}
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    question = json.loads(line)['question']
+                except (ValueError, KeyError, TypeError):
+                    continue
+                key = normalize_question(question)
+                counts[key] += 1
+                originals.setdefault(key, question)
+        questions += [originals[key] for key, _ in counts.most_common(top_n)]
+
+    unique = {}
+    for question in questions:
+        unique.setdefault(normalize_question(question), question)
+    return list(unique.values())
+
+
+class QuestionLog:
+    def __init__(self, path: str):
+        """Append-only log of asked questions (source for top-N pre-warming)."""
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, question: str, tenant: Optional[str] = None):
+        line = json.dumps({'timestamp': time.time(), 'question': question, 'tenant': tenant})
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + "\n")
+
+
+class FAQPrewarmer:
+    def __init__(self, rag, questions: List[str], refresh_interval: float = 300.0, admission=None):
+        """
+        Initialize pre-warmer.
+
+        Args:
+            rag: RAGPipeline whose faq_cache is filled
+            questions: Questions to warm
+            refresh_interval: Seconds between index version checks in the background
+            admission: Optional AdmissionController; warm-up queries run in its batch lane
+        """
+        self.rag = rag
+        self.questions = questions
+        self.refresh_interval = refresh_interval
+        self.admission = admission
+        self.last_run = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, rag, admission=None) -> "FAQPrewarmer":
+        """Build a pre-warmer from FAQ_* environment variables."""
+        questions = load_faq_questions(
+            faq_path=os.getenv("FAQ_FILE", "eval_questions.json"),
+            log_path=os.getenv("QUESTION_LOG_PATH") or None,
+            top_n=int(os.getenv("FAQ_TOP_N", "20"))
+        )
+        return cls(rag, questions, refresh_interval=float(os.getenv("FAQ_REFRESH_INTERVAL", "300")),
+                   admission=admission)
+
+    def warm(self) -> Dict[str, Any]:
+        """Recompute embeddings, sources and answers for every FAQ against the current index."""
+        cache = self.rag.faq_cache
+        version = self.rag.index_version()
+        cache.reset(version)
+
+        start = time.perf_counter()
+        warmed, failed = 0, 0
+        for question in self.questions:
+            if self._stop.is_set():
+                break
+            try:
+                # Warm-up yields to interactive traffic
+                with self.admission.admit('batch') if self.admission is not None else nullcontext():
+                    embedding = self.rag.embed_query(question)
+                    result = self.rag.query(question, query_embedding=embedding, use_faq_cache=False)
+            except Exception as e:
+                print(f"⚠️  Pre-warm failed for '{question[:40]}': {e}")
+                failed += 1
+                continue
+            # Never pin a failed generation as the canonical answer
+            if result['answer'].startswith("Error generating response") or not result['sources']:
+                failed += 1
+                continue
+            cache.store(question, embedding, result, version)
+            warmed += 1
+
+        self.last_run = {
+            'index_version': version,
+            'warmed': warmed,
+            'failed': failed,
+            'seconds': round(time.perf_counter() - start, 2),
+            'finished_at': time.time()
+        }
+        print(f"🔥 Pre-warmed {warmed}/{len(self.questions)} FAQs for index {version} "
+              f"in {self.last_run['seconds']}s")
+        return self.last_run
+
+    def refresh_if_stale(self) -> bool:
+        """Re-warm when the index version changed since the last run."""
+        if self.rag.index_version() == self.rag.faq_cache.version:
+            return False
+        self.warm()
+        return True
+
+    def invalidate(self):
+        """Drop warmed answers now (the index changed) and re-warm in the background."""
+        self.rag.faq_cache.reset(None)
+        self._wake.set()
+
+    def _run(self):
+        try:
+            self.warm()
+        except Exception as e:
+            # The cache keeps its old version, so the next refresh check retries
+            print(f"⚠️  FAQ pre-warm failed: {e}")
+        while True:
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.refresh_if_stale()
+            except Exception as e:
+                print(f"⚠️  FAQ refresh failed: {e}")
+
+    def start(self):
+        """Warm in a background thread, then re-check the index version periodically."""
+        self._thread = threading.Thread(target=self._run, name="faq-prewarm", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'questions': len(self.questions),
+            'refresh_interval_s': self.refresh_interval,
+            'last_run': self.last_run,
+            **self.rag.faq_cache.info()
+        }
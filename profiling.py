@@ -0,0 +1,340 @@
+"""
+Request profiling.
+Runs a single /chat request under a profiler on demand (admin only), or every Nth request in
+production, and records per-stage timings (embedding, vector search, reranking, prompt build,
+generation) with a flame-graph-compatible profile (folded stacks).
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+# The profile of the request running on this thread (stage() records into it)
+_local = threading.local()
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """Whether a request carries the ADMIN_TOKEN (admin features are off while it is unset)."""
+    expected = os.getenv("ADMIN_TOKEN", "")
+    return bool(expected) and token is not None and hmac.compare_digest(token.encode(), expected.encode())
+
+
+@contextmanager
+def stage(name: str):
+    """Time a pipeline stage of the profiled request on this thread (no-op otherwise)."""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        yield
+        return
+    profile._depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile._depth -= 1
+        profile.add_stage(name, time.perf_counter() - start, nested=profile._depth > 0)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float, root=None):
+        """
+        Sample the Python stack of one thread from a background thread.
+
+        Args:
+            thread_id: Thread to sample
+            interval: Seconds between samples
+            root: Outermost frame to keep (frames above it, e.g. the web server's, are cut)
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        labels = []
+        while frame is not None:
+            labels.append(_frame_label(frame))
+            if frame is self.root:
+                break
+            frame = frame.f_back
+        if labels:
+            self.stacks[";".join(reversed(labels))] += 1
+            self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def folded(self) -> str:
+        """Folded stacks ("outer;inner count" per line) for flamegraph.pl, speedscope or inferno."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class RequestProfile:
+    def __init__(self, mode: str = "sample", interval: float = 0.001, sampled: bool = False):
+        """
+        Profile of one request, active on the thread that enters it.
+
+        Args:
+            mode: 'sample' (stack sampling, folded stacks) or 'cprofile' (deterministic, pstats)
+            interval: Seconds between stack samples
+            sampled: Picked by 1-in-N production sampling rather than requested
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unsupported profile mode: {mode} (choose from {', '.join(PROFILE_MODES)})")
+        self.profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.mode = mode
+        self.interval = interval
+        self.sampled = sampled
+        self.stages = {}
+        self.total_seconds = None
+        self._top_level_seconds = 0.0
+        self._depth = 0
+        self._sampler = None
+        self._profiler = None
+        self._start = None
+
+    def add_stage(self, name: str, seconds: float, nested: bool = False):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if not nested:
+            self._top_level_seconds += seconds
+
+    def __enter__(self) -> "RequestProfile":
+        _local.profile = self
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._sampler = StackSampler(threading.get_ident(), self.interval, root=sys._getframe(1))
+            self._sampler.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.total_seconds = time.perf_counter() - self._start
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+        _local.profile = None
+        return False
+
+    def timings_ms(self) -> Dict[str, float]:
+        """Per-stage wall time; nested stages (embedding inside extractive) are also counted in their parent."""
+        timings = {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()}
+        timings['other'] = round((self.total_seconds - self._top_level_seconds) * 1000, 2)
+        timings['total'] = round(self.total_seconds * 1000, 2)
+        return timings
+
+    def top_functions(self, limit: int = 15) -> List[Dict[str, Any]]:
+        """Functions by cumulative time (cprofile mode)."""
+        stats = pstats.Stats(self._profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:limit]
+        return [
+            {
+                'function': f"{name} ({os.path.basename(filename)}:{line})",
+                'calls': calls,
+                'total_ms': round(total * 1000, 2),
+                'cumulative_ms': round(cumulative * 1000, 2)
+            }
+            for (filename, line, name), (_, calls, total, cumulative, _) in rows
+        ]
+
+    def report(self, limit: int = 15) -> Dict[str, Any]:
+        """Summary returned to the caller and stored with the profile."""
+        report = {
+            'profile_id': self.profile_id,
+            'mode': self.mode,
+            'sampled': self.sampled,
+            'timings_ms': self.timings_ms()
+        }
+        if self._sampler is not None:
+            report['samples'] = self._sampler.samples
+            report['interval_ms'] = self.interval * 1000
+            report['top_stacks'] = [{'stack': stack.split(";")[-3:], 'samples': count}
+                                    for stack, count in self._sampler.stacks.most_common(limit)]
+        else:
+            report['top_functions'] = self.top_functions(limit)
+        return report
+
+    def write(self, directory: str) -> Dict[str, str]:
+        """Write the report and the profile data (.folded, or .prof for cprofile)."""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.profile_id)
+        files = {'report': f"{base}.json"}
+        if self._sampler is not None:
+            files['folded'] = f"{base}.folded"
+            with open(files['folded'], 'w', encoding='utf-8') as f:
+                f.write(self._sampler.folded() + "\n")
+        else:
+            files['pstats'] = f"{base}.prof"
+            self._profiler.dump_stats(files['pstats'])
+        with open(files['report'], 'w', encoding='utf-8') as f:
+            json.dump({**self.report(), 'files': files, 'created_at': time.time()}, f, indent=2)
+        return files
+
+
+class RequestProfiler:
+    def __init__(self,
+                 profile_dir: str = "profiles",
+                 sample_rate: int = 0,
+                 sample_interval: float = 0.01,
+                 on_demand_interval: float = 0.001,
+                 max_profiles: int = 50):
+        """
+        Initialize on-demand and 1-in-N request profiling.
+
+        Args:
+            profile_dir: Where profiles are stored
+            sample_rate: Profile one in this many requests (0 disables sampling)
+            sample_interval: Seconds between stack samples of sampled requests (bounds overhead)
+            on_demand_interval: Seconds between stack samples of requested profiles
+            max_profiles: Stored profiles kept (oldest are deleted)
+        """
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.sample_interval = sample_interval
+        self.on_demand_interval = on_demand_interval
+        self.max_profiles = max_profiles
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._sampling = False
+        # cProfile hooks are per interpreter on newer Pythons: one deterministic profile at a time
+        self._cprofile_lock = threading.Lock()
+        self.stats = {'requests': 0, 'on_demand': 0, 'sampled': 0, 'skipped_busy': 0, 'stored': 0}
+
+    @classmethod
+    def from_env(cls) -> "RequestProfiler":
+        """Build from PROFILE_* environment variables."""
+        return cls(
+            profile_dir=os.getenv("PROFILE_DIR", "profiles"),
+            sample_rate=int(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+            sample_interval=float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "10")) / 1000,
+            on_demand_interval=float(os.getenv("PROFILE_INTERVAL_MS", "1")) / 1000,
+            max_profiles=int(os.getenv("PROFILE_MAX_FILES", "50"))
+        )
+
+    def should_sample(self) -> bool:
+        """Count a request and decide whether it is the 1-in-N sampled one."""
+        with self._lock:
+            self._requests += 1
+            self.stats['requests'] += 1
+            return self.sample_rate > 0 and self._requests % self.sample_rate == 0
+
+    @contextmanager
+    def profile(self, mode: str = "sample", sampled: bool = False):
+        """
+        Run the block under a profiler and store the result.
+
+        Yields:
+            The RequestProfile (its report is complete after the block), or None when a
+            sampled profile is already running (sampling profiles one request at a time)
+        """
+        if sampled:
+            with self._lock:
+                busy = self._sampling
+                self._sampling = True
+                self.stats['skipped_busy' if busy else 'sampled'] += 1
+            if busy:
+                yield None
+                return
+        locked = mode == 'cprofile' and self._cprofile_lock.acquire(blocking=False)
+        if mode == 'cprofile' and not locked:
+            # Another deterministic profile is running; fall back to sampling
+            mode = 'sample'
+        if not sampled:
+            with self._lock:
+                self.stats['on_demand'] += 1
+        profile = RequestProfile(mode, self.sample_interval if sampled else self.on_demand_interval, sampled)
+        try:
+            with profile:
+                yield profile
+        finally:
+            if locked:
+                self._cprofile_lock.release()
+            if sampled:
+                with self._lock:
+                    self._sampling = False
+        try:
+            profile.write(self.profile_dir)
+            with self._lock:
+                self.stats['stored'] += 1
+            self._prune()
+        except OSError as e:
+            print(f"⚠️  Could not store profile {profile.profile_id}: {e}")
+
+    def _reports(self) -> List[str]:
+        """Stored report files, oldest first."""
+        if not os.path.isdir(self.profile_dir):
+            return []
+        names = [name for name in os.listdir(self.profile_dir) if name.endswith('.json')]
+        return sorted(names, key=lambda name: (os.stat(os.path.join(self.profile_dir, name)).st_mtime_ns, name))
+
+    def _prune(self):
+        reports = self._reports()
+        for name in reports[:max(len(reports) - self.max_profiles, 0)]:
+            profile_id = name[:-len('.json')]
+            for extension in ('.json', '.folded', '.prof'):
+                path = os.path.join(self.profile_dir, profile_id + extension)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        """Stored profile reports, newest first."""
+        profiles = []
+        for name in reversed(self._reports()):
+            with open(os.path.join(self.profile_dir, name), 'r', encoding='utf-8') as f:
+                report = json.load(f)
+            profiles.append({**{key: report.get(key) for key in ('profile_id', 'mode', 'sampled', 'created_at')},
+                             'total_ms': report['timings_ms']['total']})
+        return profiles
+
+    def load(self, profile_id: str, kind: str = "report") -> Optional[str]:
+        """A stored profile's report JSON or folded stacks (None if unknown)."""
+        if not all(ch.isalnum() or ch == '-' for ch in profile_id):
+            return None
+        path = os.path.join(self.profile_dir, profile_id + ('.folded' if kind == 'folded' else '.json'))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'sample_interval_ms': self.sample_interval * 1000,
+                'profile_dir': self.profile_dir,
+                **self.stats
+            }
@@ -4,6 +4,7 @@ Handles query embedding, vector search, re-ranking, and LLM generation.
 """
 
 import os
+from contextlib import contextmanager
 from typing import List, Dict, Any, Optional
 
 # Disable ChromaDB telemetry to prevent production errors
@@ -13,126 +14,395 @@ os.environ["CHROMA_TELEMETRY"] = "False"
 # Force ONNX to use CPU only to prevent GPU warnings
 os.environ["ORT_DEVICE"] = "CPU"
 
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
 from dotenv import load_dotenv
-import torch
+
+# Heavy dependencies (chromadb, sentence_transformers, openai) are imported lazily
+# in the code paths that need them to keep worker boot and /health fast.
+from llm_cache import CacheMiss, LLMResponseCache
+from llm_client import PROVIDERS, LLMTimeoutError, bounded_client, build_provider_client, HedgedRequester
+from llm_router import LLMRouter, NoHealthyRouteError
+from embedding_sidecar import SidecarClient
+from ann_index import AnnParams
+from sessions import Session
+from prewarm import FAQCache
+from extractive import ExtractiveAnswerer
+from adaptive_k import AdaptiveTopK
+from scope_gate import OUT_OF_SCOPE_ANSWER, ScopeGate
+from profiling import stage
+from filters import normalize_filters, to_chroma_where
+from tenants import (DEFAULT_TENANT, TenantIndex, TenantIndexCache, UnknownTenantError,
+                     collection_name, estimate_chroma_bytes, release_chroma_collection)
+from blue_green import IndexPointer
 
 # Load environment variables
 load_dotenv()
 
 
+class GenerationError(RuntimeError):
+    """Raised when the LLM produced no answer within the deadline or no route was healthy."""
+
+    @property
+    def timed_out(self) -> bool:
+        """Whether the deadline ran out (anywhere in the chain of causes)."""
+        cause = self.__cause__
+        while cause is not None:
+            if isinstance(cause, LLMTimeoutError):
+                return True
+            cause = cause.__cause__
+        return False
+
+
+class QueryEmbedding(list):
+    """Query vector tagged with the embedding model that produced it."""
+
+    def __init__(self, values, model: str):
+        super().__init__(values)
+        self.model = model
+
+
 class RAGPipeline:
     def __init__(self,
                  db_path: str = "chroma_db",
                  embedding_model: str = "all-MiniLM-L6-v2",
                  llm_provider: str = "openrouter",
                  model_name: str = "google/gemini-flash-1.5-8b",
-                 top_k: int = 5):
+                 top_k: int = 5,
+                 response_cache: Optional[LLMResponseCache] = None,
+                 sidecar_socket: Optional[str] = None,
+                 index_bundle: Optional[str] = None,
+                 tenant_bundle_dir: Optional[str] = None,
+                 faq_cache: Optional[FAQCache] = None,
+                 extractive: Optional[ExtractiveAnswerer] = None,
+                 adaptive_k: Optional[AdaptiveTopK] = None,
+                 scope_gate: Optional[ScopeGate] = None):
         """
         Initialize RAG pipeline.
 
         Args:
             db_path: Path to ChromaDB
-            embedding_model: Sentence-transformers model name
-            llm_provider: LLM provider (openrouter, groq, openai)
+            embedding_model: Sentence-transformers model name (collections record their own;
+                             this one is used for collections that don't)
+            llm_provider: LLM provider (openrouter, groq, openai, local)
             model_name: Model identifier
             top_k: Number of chunks to retrieve
+            response_cache: Optional on-disk cache of LLM responses
+            sidecar_socket: Unix socket of a shared embedding/search sidecar; when
+                            set, this process never loads the embedding model
+            index_bundle: Path to a prebuilt index bundle served via mmap instead of ChromaDB
+            tenant_bundle_dir: Directory of per-tenant bundles (<tenant>.bundle); tenants
+                               without a bundle are served from their ChromaDB collection
+            faq_cache: Pre-warmed answers for frequent questions (see prewarm.py)
+            extractive: Answer confidently retrieved questions with policy sentences instead of the LLM
+            adaptive_k: Cut the default retrieval by distance instead of always returning top_k
+            scope_gate: Refuse clearly off-domain questions without calling the LLM
         """
         self.db_path = db_path
         self.top_k = top_k
         self.llm_provider = llm_provider
         self.model_name = model_name
+        self.default_embedding_model = embedding_model
+        # Model of the serving collection (changes when an index built with another model is swapped in)
         self.embedding_model_name = embedding_model
-        self.embedding_model = None
-
-        # Initialize ChromaDB with telemetry disabled
-        self.client = chromadb.PersistentClient(
-            path=db_path,
-            settings=Settings(
-                anonymized_telemetry=False,
-                allow_reset=True
+        self.models = {}
+        self.response_cache = response_cache
+        self.faq_cache = faq_cache
+        self.extractive = extractive
+        self.adaptive_k = adaptive_k
+        self.scope_gate = scope_gate
+        self.sidecar = SidecarClient(sidecar_socket) if sidecar_socket else None
+        self.client = None
+        self.tenant_bundle_dir = tenant_bundle_dir
+        # Serving collection per tenant (blue/green swaps, see blue_green.py)
+        self.index_pointer = IndexPointer(db_path)
+        self.standby_collection = None
+        # Query-time HNSW effort (HNSW_SEARCH_EF or the tuned setting)
+        self.search_ef = AnnParams.load().search_ef
+        # Non-default tenants are opened on demand and evicted when idle
+        self.tenants = TenantIndexCache.from_env(self._load_tenant)
+
+        if index_bundle:
+            self._open_bundle(index_bundle)
+        else:
+            self._open_collection()
+        # The sidecar searches the collection that was serving when it started
+        self._sidecar_collection = self.collection.name
+
+        # Initialize LLM client
+        self._init_llm_client()
+
+    def _chroma_client(self):
+        """Open the persistent ChromaDB client on first use."""
+        if self.client is None:
+            import chromadb
+            from chromadb.config import Settings
+
+            # Initialize ChromaDB with telemetry disabled
+            self.client = chromadb.PersistentClient(
+                path=self.db_path,
+                settings=Settings(
+                    anonymized_telemetry=False,
+                    allow_reset=True
+                )
             )
-        )
+        return self.client
 
+    def _open_collection(self):
+        """Open the persistent ChromaDB collection the index pointer names."""
+        name = self.index_pointer.active(DEFAULT_TENANT)
         try:
-            self.collection = self.client.get_collection(name="company_policies")
+            self.collection = self._chroma_client().get_collection(name=name)
+            self.embedding_model_name = self.model_for(self.collection)
             print(f"✅ Loaded existing collection with {self.collection.count()} chunks")
         except Exception as e:
             # Collection doesn't exist - DO NOT auto-ingest (causes worker timeout)
             # Instead, raise a clear error message
             raise Exception(
-                f"Collection 'company_policies' does not exist. "
+                f"Collection '{name}' does not exist. "
                 f"Please run 'python ingest.py' to create it before starting the app. Error: {e}"
             )
 
-        # Initialize LLM client
-        self._init_llm_client()
+    def model_for(self, collection) -> str:
+        """Embedding model a collection was built with."""
+        return (collection.metadata or {}).get('embedding_model', self.default_embedding_model)
 
-    def _load_embedding_model(self):
+    def reload_index(self) -> bool:
+        """
+        Switch to the collection the index pointer names, if it changed.
+
+        The new collection and its embedding model are loaded and warmed before the swap, so
+        in-flight and new queries never wait on them. The replaced collection stays loaded as
+        the standby for a fast rollback; anything older is released.
+
+        Returns:
+            True if the serving collection of any tenant changed
+        """
+        # Tenants reopen their swapped collections on next use
+        tenants = self.tenants.info()['tenants']
+        swapped = [tenant for tenant, row in tenants.items()
+                   if row['source'] == 'chroma' and row['collection'] != self.index_pointer.active(tenant)]
+        for tenant in swapped:
+            self.tenants.evict(tenant)
+
+        if 'bundle_version' in (self.collection.metadata or {}):
+            return bool(swapped)
+        name = self.index_pointer.active(DEFAULT_TENANT)
+        if name == self.collection.name:
+            return bool(swapped)
+
+        if self.standby_collection is not None and self.standby_collection.name == name:
+            collection = self.standby_collection
+        else:
+            collection = self._chroma_client().get_collection(name=name)
+        model_name = self.model_for(collection)
+        # Loads the HNSW segment and the model before any request depends on them
+        collection.query(query_embeddings=[self.embed_query("warm-up", model_name)], n_results=1)
+
+        previous, released = self.collection, self.standby_collection
+        self.collection, self.embedding_model_name = collection, model_name
+        self.standby_collection = previous
+        if released is not None and released.name not in (collection.name, previous.name):
+            release_chroma_collection(self._chroma_client(), released.id)
+        for unused in set(self.models) - {model_name, self.model_for(previous), self.default_embedding_model}:
+            self.models.pop(unused, None)
+        print(f"🔀 Serving collection {collection.name} ({collection.count()} chunks, {model_name}); "
+              f"{previous.name} kept for rollback")
+        return True
+
+    def release_standby(self) -> bool:
+        """Release the rollback standby collection (a rollback then reloads it from disk)."""
+        standby, self.standby_collection = self.standby_collection, None
+        if standby is None:
+            return False
+        release_chroma_collection(self._chroma_client(), standby.id)
+        for unused in set(self.models) - {self.embedding_model_name, self.default_embedding_model}:
+            self.models.pop(unused, None)
+        return True
+
+    def _open_bundle(self, path: str):
+        """Open a prebuilt index bundle read-only and verify its embedding model."""
+        from index_bundle import IndexBundle, BundleCollection
+
+        bundle = IndexBundle(path)
+        bundle.check_model(self.embedding_model_name)
+        self.collection = BundleCollection(bundle)
+        print(f"✅ Loaded index bundle {bundle.version} with {bundle.count()} chunks (mmap)")
+
+    def index_version(self) -> str:
+        """
+        Version of the default index: the bundle checksum, or the version stamped on the
+        collection by ingestion (re-read so re-ingestion by another process is noticed).
+        """
+        if 'bundle_version' in (self.collection.metadata or {}):
+            return self.collection.metadata['bundle_version']
+        collection = self._chroma_client().get_collection(name=self.collection.name)
+        return (collection.metadata or {}).get('index_version') or f"count-{collection.count()}"
+
+    def _load_tenant(self, tenant: str) -> TenantIndex:
+        """Open a tenant's index bundle, or its ChromaDB collection if it has no bundle."""
+        if self.tenant_bundle_dir:
+            path = os.path.join(self.tenant_bundle_dir, f"{tenant}.bundle")
+            if os.path.exists(path):
+                from index_bundle import IndexBundle, BundleCollection
+
+                bundle = IndexBundle(path)
+                bundle.check_model(self.embedding_model_name)
+                print(f"✅ Loaded tenant '{tenant}' bundle {bundle.version} ({bundle.count()} chunks)")
+                return TenantIndex(tenant, BundleCollection(bundle, name=collection_name(tenant)),
+                                   memory_bytes=os.path.getsize(path), source='bundle', close=bundle.close)
+
+        client = self._chroma_client()
+        try:
+            collection = client.get_collection(name=self.index_pointer.active(tenant))
+        except ValueError:
+            raise UnknownTenantError(tenant)
+
+        sample = collection.get(limit=1, include=['embeddings'])['embeddings']
+        dimension = len(sample[0]) if sample else 0
+        print(f"✅ Loaded tenant '{tenant}' collection ({collection.count()} chunks)")
+        return TenantIndex(tenant, collection,
+                           memory_bytes=estimate_chroma_bytes(collection.count(), dimension),
+                           source='chroma', close=lambda: release_chroma_collection(client, collection.id))
+
+    @contextmanager
+    def use_collection(self, tenant: Optional[str]):
+        """
+        Collection serving a tenant, kept open for the block even if the tenant is evicted
+        meanwhile (the default tenant's index stays open for the process).
+        """
+        if tenant is None or tenant == DEFAULT_TENANT:
+            yield self.collection
+            return
+        with self.tenants.use(tenant) as index:
+            yield index.collection
+
+    def collection_for(self, tenant: Optional[str]):
+        """Collection serving a tenant, for its name and metadata (search it inside use_collection)."""
+        with self.use_collection(tenant) as collection:
+            return collection
+
+    @property
+    def embedding_model(self):
+        """Loaded model of the serving collection (None until first use)."""
+        return self.models.get(self.embedding_model_name)
+
+    def _load_embedding_model(self, model_name: Optional[str] = None):
         """Lazy load embedding model to avoid startup timeout."""
-        if self.embedding_model is None:
-            print(f"⏳ Loading embedding model: {self.embedding_model_name}")
+        model_name = model_name or self.embedding_model_name
+        if model_name not in self.models:
+            from sentence_transformers import SentenceTransformer
+
+            print(f"⏳ Loading embedding model: {model_name}")
             # Use CPU and optimize for memory
             device = 'cpu'
-            self.embedding_model = SentenceTransformer(
-                self.embedding_model_name,
+            model = SentenceTransformer(
+                model_name,
                 device=device
             )
             # Set to eval mode to save memory
-            self.embedding_model.eval()
+            model.eval()
+            self.models[model_name] = model
             print(f"✅ Embedding model loaded on {device}")
-        return self.embedding_model
+        return self.models[model_name]
 
     def _init_llm_client(self):
-        """Initialize LLM API client based on provider."""
-        if self.llm_provider == "openrouter":
-            self.llm_client = OpenAI(
-                base_url="https://openrouter.ai/api/v1",
-                api_key=os.getenv("OPENROUTER_API_KEY", "")
-            )
-        elif self.llm_provider == "groq":
-            self.llm_client = OpenAI(
-                base_url="https://api.groq.com/openai/v1",
-                api_key=os.getenv("GROQ_API_KEY", "")
-            )
-        elif self.llm_provider == "openai":
-            self.llm_client = OpenAI(
-                api_key=os.getenv("OPENAI_API_KEY", "")
-            )
-        else:
+        """Initialize pooled, timeout-bounded LLM API client based on provider."""
+        if self.llm_provider not in PROVIDERS:
             raise ValueError(f"Unsupported LLM provider: {self.llm_provider}")
 
-    def retrieve(self, query: str, top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+        # Built on first use (see llm_client property)
+        self._llm_client = None
+
+        # Total deadline and optional hedging for every completion
+        self.llm_requester = HedgedRequester.from_env()
+
+        # Optional latency-aware routing across several providers (LLM_ROUTES)
+        self.llm_router = LLMRouter.from_env()
+
+    @property
+    def llm_client(self):
+        """LLM API client, created lazily so openai/httpx are not imported at startup."""
+        if self._llm_client is None:
+            self._llm_client = build_provider_client(self.llm_provider)
+        return self._llm_client
+
+    @llm_client.setter
+    def llm_client(self, client):
+        self._llm_client = client
+
+    def _llm_identity(self):
+        """Provider and model that identify generated answers (for caching)."""
+        if self.llm_router is not None:
+            return "router", self.llm_router.route_spec
+        return self.llm_provider, self.model_name
+
+    def retrieve(self,
+                 query: str,
+                 top_k: Optional[int] = None,
+                 filters: Optional[Dict[str, Any]] = None,
+                 tenant: Optional[str] = None,
+                 search_ef: Optional[int] = None,
+                 query_embedding: Optional[List[float]] = None) -> List[Dict[str, Any]]:
         """
         Retrieve relevant document chunks for query.
 
         Args:
             query: User question
-            top_k: Number of chunks to retrieve (overrides default)
+            top_k: Number of chunks to retrieve (overrides default and adaptive_k)
+            filters: Restrict the search by doc_id, title, format or tags,
+                     e.g. {"doc_id": "POL-003"} or {"tags": ["finance"]}
+            tenant: Tenant whose policy collection is searched (default tenant if None)
+            search_ef: HNSW candidate list size for this search (overrides default)
+            query_embedding: Precomputed embedding of query (skips encoding)
 
         Returns:
             List of retrieved chunks with metadata
         """
-        k = top_k or self.top_k
-
-        # Lazy load embedding model on first use
-        model = self._load_embedding_model()
-
-        # Embed query
-        query_embedding = model.encode([query])[0].tolist()
-
-        # Search vector database
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=k
-        )
-
-        # Format results
+        # An explicit top_k is honored as is; otherwise adaptive_k picks the count per query
+        adaptive = self.adaptive_k if top_k is None else None
+        k = adaptive.max_k if adaptive is not None else top_k or self.top_k
+        where = to_chroma_where(normalize_filters(filters))
+
+        default_tenant = tenant is None or tenant == DEFAULT_TENANT
+        with self.use_collection(tenant) as collection:
+            n_candidates = self._search_candidates(collection, k, search_ef or self.search_ef)
+            # Extra candidates to refill slots taken by copies of near-duplicate chunks (see dedup.py)
+            n_candidates += min(k, (collection.metadata or {}).get('tagged_duplicates', 0))
+            model_name = self.model_for(collection)
+            if getattr(query_embedding, 'model', model_name) != model_name:
+                # Embedded for an index that was swapped out meanwhile (or another tenant's model)
+                query_embedding = None
+
+            if (self.sidecar is not None and default_tenant
+                    and collection.name == self._sidecar_collection
+                    and model_name == self.default_embedding_model):
+                # Embed + search in the shared sidecar (micro-batched with other workers); an
+                # embedding computed earlier (scope gate, extractive answers, batch search) is reused
+                with stage('sidecar_search'):
+                    row = self.sidecar.search(query, n_candidates, where=where, embedding=query_embedding)
+                results = {key: [row[key]] for key in ('ids', 'documents', 'metadatas', 'distances')}
+            else:
+                if query_embedding is None:
+                    query_embedding = self.embed_query(query, model_name)
+
+                # Search vector database (filters are applied inside the search, not afterwards)
+                search_kwargs = {'where': where} if where else {}
+                with stage('vector_search'):
+                    results = collection.query(
+                        query_embeddings=[query_embedding],
+                        n_results=n_candidates,
+                        **search_kwargs
+                    )
+
+        # Format results, keeping one chunk per near-duplicate group
         chunks = []
+        groups = set()
         for i in range(len(results['ids'][0])):
+            if len(chunks) >= k:
+                break
+            group = results['metadatas'][0][i].get('duplicate_of') or results['ids'][0][i]
+            if group in groups:
+                continue
+            groups.add(group)
             chunks.append({
                 'chunk_id': results['ids'][0][i],
                 'text': results['documents'][0][i],
@@ -140,8 +410,52 @@ class RAGPipeline:
                 'distance': results['distances'][0][i] if 'distances' in results else None
             })
 
+        if adaptive is not None:
+            chunks = adaptive.apply(chunks)
         return chunks
 
+    def embed_query(self, query: str, model_name: Optional[str] = None) -> List[float]:
+        """
+        Embed a query with the sidecar if configured, else the local model.
+
+        Args:
+            query: Text to embed
+            model_name: Embedding model (default: the serving collection's)
+        """
+        model_name = model_name or self.embedding_model_name
+        with stage('embedding'):
+            if self.sidecar is not None and model_name == self.default_embedding_model:
+                # Tenant indexes live in this process; the sidecar still does the embedding
+                return QueryEmbedding(self.sidecar.embed([query])[0], model_name)
+
+            # Lazy load embedding model on first use
+            model = self._load_embedding_model(model_name)
+            return QueryEmbedding(model.encode([query])[0].tolist(), model_name)
+
+    def embed_texts(self, texts: List[str], model_name: Optional[str] = None):
+        """Embed several texts at once (one row per text)."""
+        model_name = model_name or self.embedding_model_name
+        with stage('embedding'):
+            if self.sidecar is not None and model_name == self.default_embedding_model:
+                return self.sidecar.embed(texts)
+            return self._load_embedding_model(model_name).encode(texts)
+
+    @staticmethod
+    def _search_candidates(collection, k: int, search_ef: Optional[int]) -> int:
+        """
+        Number of results to request so the HNSW search uses at least search_ef candidates.
+
+        ChromaDB fixes search_ef when a collection is created, but hnswlib searches with
+        max(search_ef, n_results), so asking for more results raises the effort per query.
+        """
+        metadata = collection.metadata or {}
+        if search_ef is None or metadata.get('exact_search'):
+            return k
+        built_ef = AnnParams.from_collection_metadata(metadata).search_ef
+        if search_ef <= max(k, built_ef):
+            return k
+        return min(search_ef, max(k, collection.count()))
+
     def rerank_chunks(self, query: str, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         Simple re-ranking based on keyword overlap (optional enhancement).
@@ -163,13 +477,17 @@ class RAGPipeline:
 
         return chunks
 
-    def build_prompt(self, query: str, chunks: List[Dict[str, Any]]) -> str:
+    def build_prompt(self,
+                     query: str,
+                     chunks: List[Dict[str, Any]],
+                     history: Optional[List[Dict[str, str]]] = None) -> str:
         """
         Build prompt with retrieved context and guardrails.
 
         Args:
             query: User question
             chunks: Retrieved document chunks
+            history: Earlier turns of the conversation (question/answer pairs)
 
         Returns:
             Formatted prompt string
@@ -180,13 +498,23 @@ class RAGPipeline:
             doc_id = chunk['metadata']['doc_id']
             title = chunk['metadata']['title']
             text = chunk['text']
+            pages = self.page_label(chunk['metadata'])
 
             context_parts.append(
-                f"[Source {i}: {doc_id} - {title}]\n{text}\n"
+                f"[Source {i}: {doc_id} - {title}{', ' + pages if pages else ''}]\n{text}\n"
             )
 
         context = "\n".join(context_parts)
 
+        # Earlier turns go after the sources so the prompt prefix stays stable within a session
+        conversation = ""
+        if history:
+            turns = [
+                f"Q: {turn['question']}\nA: {turn['answer'][:400]}"
+                for turn in history
+            ]
+            conversation = "\nCONVERSATION SO FAR:\n" + "\n\n".join(turns) + "\n"
+
         # Build prompt with guardrails
         prompt = f"""You are a helpful assistant that answers questions about company policies based ONLY on the provided policy documents.
 
@@ -200,14 +528,18 @@ INSTRUCTIONS:
 
 POLICY SOURCES:
 {context}
-
+{conversation}
 QUESTION: {query}
 
 ANSWER (with citations):"""
 
         return prompt
 
-    def generate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.3) -> str:
+    def generate(self,
+                 prompt: str,
+                 max_tokens: int = 500,
+                 temperature: float = 0.3,
+                 top_p: float = 0.9) -> str:
         """
         Generate answer using LLM.
 
@@ -215,32 +547,76 @@ ANSWER (with citations):"""
             prompt: Formatted prompt with context
             max_tokens: Maximum response length
             temperature: Sampling temperature (lower = more deterministic)
+            top_p: Nucleus sampling cutoff
 
         Returns:
             Generated answer text
+
+        Raises:
+            GenerationError: The deadline ran out (including hedges) or no route was healthy
+            CacheMiss: Replay mode and the prompt was never recorded
         """
+        cache_key = None
         try:
-            response = self.llm_client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that answers questions about company policies based on provided documents."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=0.9,
-            )
+            # Serve byte-identical requests from the response cache
+            if self.response_cache is not None:
+                provider, model_name = self._llm_identity()
+                cache_key = LLMResponseCache.make_key(
+                    provider, model_name, prompt, max_tokens, temperature, top_p
+                )
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+
+            messages = [
+                {"role": "system", "content": "You are a helpful assistant that answers questions about company policies based on provided documents."},
+                {"role": "user", "content": prompt}
+            ]
+
+            if self.llm_router is not None:
+                # Fastest healthy provider first, failing over within the deadline
+                response = self.llm_router.complete(
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                )
+            else:
+                response = self.llm_requester.call(
+                    lambda timeout: bounded_client(self.llm_client, timeout).chat.completions.create(
+                        model=self.model_name,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                    )
+                )
 
             answer = response.choices[0].message.content.strip()
+
+            if cache_key is not None:
+                self.response_cache.put(cache_key, provider, model_name, answer)
+
             return answer
 
+        except CacheMiss:
+            # Replay runs must fail loudly instead of recording an error as the answer
+            raise
+        except (LLMTimeoutError, NoHealthyRouteError) as e:
+            # Overload, not an answer: /chat reports it as 503/504 with Retry-After
+            raise GenerationError(f"Error generating response: {e}") from e
         except Exception as e:
             return f"Error generating response: {str(e)}"
 
     def query(self,
               question: str,
               top_k: Optional[int] = None,
-              use_rerank: bool = False) -> Dict[str, Any]:
+              use_rerank: bool = False,
+              filters: Optional[Dict[str, Any]] = None,
+              tenant: Optional[str] = None,
+              session: Optional[Session] = None,
+              query_embedding: Optional[List[float]] = None,
+              use_faq_cache: bool = True) -> Dict[str, Any]:
         """
         Complete RAG pipeline: retrieve, optionally rerank, and generate.
 
@@ -248,12 +624,36 @@ ANSWER (with citations):"""
             question: User question
             top_k: Number of chunks to retrieve
             use_rerank: Whether to apply re-ranking
+            filters: Metadata filters scoping the retrieval (see retrieve)
+            tenant: Tenant whose policies answer the question
+            session: Conversation to continue (history and retrieved context are reused)
+            query_embedding: Precomputed embedding of question
+            use_faq_cache: Serve pre-warmed answers (off while warming, which would only count misses)
 
         Returns:
             Dictionary with answer, sources, and metadata
         """
+        # Pre-warmed answer for a frequent question (plain queries against the default index)
+        plain = (use_faq_cache and session is None and not filters and not use_rerank
+                 and top_k in (None, self.top_k) and tenant in (None, DEFAULT_TENANT))
+        if plain and self.faq_cache is not None:
+            if query_embedding is None and self.faq_cache.needs_embedding:
+                query_embedding = self.embed_query(question)
+            with stage('faq_cache'):
+                cached = self.faq_cache.lookup(question, query_embedding)
+            if cached is not None:
+                return {**cached, 'question': question, 'faq_cache': True}
+
         # Retrieve relevant chunks
-        chunks = self.retrieve(question, top_k)
+        retrieval = None
+        if session is not None:
+            chunks, retrieval = self._session_retrieve(session, question, top_k, filters, tenant)
+        else:
+            if (self.extractive is not None or self.scope_gate is not None) and query_embedding is None:
+                # Kept for sentence matching on the extractive path and the scope gate's centroids
+                query_embedding = self.embed_query(question, self.model_for(self.collection_for(tenant)))
+            chunks = self.retrieve(question, top_k, filters=filters, tenant=tenant,
+                                   query_embedding=query_embedding)
 
         if not chunks:
             return {
@@ -262,33 +662,186 @@ ANSWER (with citations):"""
                 'question': question
             }
 
+        # Refuse clearly off-domain questions before reranking and generation (follow-ups may
+        # lean on the history, so they always reach the LLM)
+        if self.scope_gate is not None and session is None:
+            collection = self.collection_for(tenant)
+            with stage('scope_gate'):
+                refused = self.scope_gate.check(getattr(collection, 'name', None), query_embedding, chunks,
+                                                getattr(query_embedding, 'model', None))
+            if refused is not None:
+                return {
+                    'answer': OUT_OF_SCOPE_ANSWER,
+                    'sources': [],
+                    'question': question,
+                    'num_sources': 0,
+                    'answer_path': 'refused',
+                    'scope': refused
+                }
+
         # Optional re-ranking
         if use_rerank:
-            chunks = self.rerank_chunks(question, chunks)
+            with stage('rerank'):
+                chunks = self.rerank_chunks(question, chunks)
+
+        # Fast path: quote the policy when retrieval is confident (follow-ups need the history)
+        if self.extractive is not None and session is None:
+            model_name = getattr(query_embedding, 'model', self.embedding_model_name)
+            with stage('extractive'):
+                extracted = self.extractive.answer(query_embedding, chunks, model_name,
+                                                   lambda texts: self.embed_texts(texts, model_name))
+            if extracted is not None:
+                sources = self.format_sources(chunks)
+                return {
+                    **extracted,
+                    'sources': sources,
+                    'question': question,
+                    'num_sources': len(sources),
+                    'answer_path': 'extractive'
+                }
 
         # Build prompt
-        prompt = self.build_prompt(question, chunks)
+        with stage('prompt_build'):
+            prompt = self.build_prompt(question, chunks,
+                                       history=session.history() if session is not None else None)
 
         # Generate answer
-        answer = self.generate(prompt)
+        with stage('generation'):
+            answer = self.generate(prompt)
+        if session is not None:
+            session.add_turn(question, answer)
 
         # Format sources
+        sources = self.format_sources(chunks)
+
+        result = {
+            'answer': answer,
+            'sources': sources,
+            'question': question,
+            'num_sources': len(sources),
+            'answer_path': 'llm'
+        }
+        if session is not None:
+            result['session'] = {'session_id': session.session_id, 'turn': len(session.turns), **retrieval}
+        return result
+
+    def search(self,
+               queries: List[str],
+               top_k: Optional[int] = None,
+               offset: int = 0,
+               use_rerank: bool = False,
+               filters: Optional[Dict[str, Any]] = None,
+               tenant: Optional[str] = None,
+               rerank_window: int = 100) -> List[Dict[str, Any]]:
+        """
+        Retrieval only: ranked chunks for one or more queries, without generation.
+
+        A batch is embedded in one model call. A page is cut from the top offset + top_k
+        results. With reranking, every page is cut from the same reranked top rerank_window
+        results, so consecutive pages neither repeat nor skip hits.
+
+        Args:
+            queries: Search queries
+            top_k: Results per page (default: the pipeline's top_k)
+            offset: Results skipped (for the next page, pass the previous next_offset)
+            use_rerank: Whether to apply re-ranking
+            filters: Metadata filters scoping the search (see retrieve)
+            tenant: Tenant whose policies are searched
+            rerank_window: Results reranked per query (pages end at this depth when reranking)
+
+        Returns:
+            One result per query: its hits (chunks with rank and score) and the next page's offset
+        """
+        k = top_k or self.top_k
+        collection = self.collection_for(tenant)
+        model_name = self.model_for(collection)
+        space = AnnParams.from_collection_metadata(collection.metadata or {}).space
+
+        embeddings = [None] * len(queries)
+        if len(queries) > 1:
+            embeddings = [QueryEmbedding([float(x) for x in row], model_name)
+                          for row in self.embed_texts(queries, model_name)]
+
+        depth = max(rerank_window, offset + k) if use_rerank else offset + k
+        results = []
+        for query, embedding in zip(queries, embeddings):
+            window = self.retrieve(query, depth, filters=filters, tenant=tenant, query_embedding=embedding)
+            if use_rerank:
+                with stage('rerank'):
+                    window = self.rerank_chunks(query, window)
+                more = len(window) > offset + k
+            else:
+                # A full window may have more results behind it
+                more = len(window) == offset + k
+            hits = [{**chunk, 'rank': rank, 'score': self.similarity(chunk['distance'], space)}
+                    for rank, chunk in enumerate(window[offset:offset + k], offset + 1)]
+            results.append({
+                'query': query,
+                'hits': hits,
+                'offset': offset,
+                'next_offset': offset + k if more else None
+            })
+        return results
+
+    @staticmethod
+    def similarity(distance: Optional[float], space: str = "l2") -> Optional[float]:
+        """Search distance as a similarity score (cosine similarity for normalized embeddings)."""
+        if distance is None:
+            return None
+        # l2 distances are squared: |a - b|^2 = 2 - 2cos for unit vectors; cosine and ip are 1 - similarity
+        return round(1.0 - distance / 2.0 if space == 'l2' else 1.0 - distance, 4)
+
+    @staticmethod
+    def format_sources(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Numbered sources as returned to clients (source_num matches [Source N] citations)."""
         sources = []
         for i, chunk in enumerate(chunks, 1):
             sources.append({
                 'source_num': i,
+                'chunk_id': chunk['chunk_id'],
                 'doc_id': chunk['metadata']['doc_id'],
                 'title': chunk['metadata']['title'],
                 'text_snippet': chunk['text'][:300] + "..." if len(chunk['text']) > 300 else chunk['text'],
                 'full_text': chunk['text']
             })
+            if 'page_start' in chunk['metadata']:
+                sources[-1]['page_start'] = chunk['metadata']['page_start']
+                sources[-1]['page_end'] = chunk['metadata']['page_end']
+        return sources
+
+    @staticmethod
+    def page_label(metadata: Dict[str, Any]) -> Optional[str]:
+        """'p. 12' or 'pp. 12-13' for chunks from paged documents (PDFs), else None."""
+        if 'page_start' not in metadata:
+            return None
+        if metadata['page_start'] == metadata['page_end']:
+            return f"p. {metadata['page_start']}"
+        return f"pp. {metadata['page_start']}-{metadata['page_end']}"
+
+    def _session_retrieve(self, session: Session, question: str, top_k: Optional[int],
+                          filters: Optional[Dict[str, Any]], tenant: Optional[str]):
+        """
+        Retrieve for a session turn.
 
-        return {
-            'answer': answer,
-            'sources': sources,
-            'question': question,
-            'num_sources': len(sources)
-        }
+        A follow-up that stays close to the session topic keeps the session's chunks and only
+        retrieves session.incremental_k more to pick up new content; anything else starts over.
+
+        Returns:
+            (context chunks, retrieval summary)
+        """
+        embedding = self.embed_query(question, self.model_for(self.collection_for(tenant)))
+        # Topics embedded by another model (before an index swap) are never compared
+        scope = (tenant or DEFAULT_TENANT, repr(normalize_filters(filters)), embedding.model)
+
+        if session.is_follow_up(embedding, scope):
+            fresh = self.retrieve(question, session.incremental_k, filters=filters, tenant=tenant,
+                                  query_embedding=embedding)
+            added = session.extend_context(fresh, embedding)
+            return list(session.chunks), {'retrieval': 'reused', 'new_chunks': added}
+
+        chunks = self.retrieve(question, top_k, filters=filters, tenant=tenant, query_embedding=embedding)
+        session.reset_context(chunks, embedding, scope)
+        return chunks, {'retrieval': 'full', 'new_chunks': len(chunks)}
 
 
 def main():
@@ -325,310 +878,5 @@ def main():
         print("-"*60)
 
 
-if __name__ == "__main__":
-    main()
-"""
-Document ingestion and indexing module for RAG system.
-Parses documents, chunks them, generates embeddings, and stores in vector database.
-"""
-
-import os
-import hashlib
-from pathlib import Path
-from typing import List, Dict, Any
-import chromadb
-from sentence_transformers import SentenceTransformer
-import markdown
-from bs4 import BeautifulSoup
-from pypdf import PdfReader
-
-class DocumentIngestion:
-    def __init__(self,
-                 docs_path: str = "documents",
-                 db_path: str = "chroma_db",
-                 embedding_model: str = "all-MiniLM-L6-v2",
-                 chunk_size: int = 500,
-                 chunk_overlap: int = 50):
-        """
-        Initialize document ingestion system.
-
-        Args:
-            docs_path: Path to documents directory
-            db_path: Path to store ChromaDB
-            embedding_model: Name of sentence-transformers model
-            chunk_size: Target size for document chunks (in words)
-            chunk_overlap: Overlap between chunks (in words)
-        """
-        self.docs_path = Path(docs_path)
-        self.db_path = db_path
-        self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
-
-        # Initialize embedding model
-        print(f"Loading embedding model: {embedding_model}")
-        self.embedding_model = SentenceTransformer(embedding_model)
-
-        # Initialize ChromaDB with new API
-        self.client = chromadb.PersistentClient(path=db_path)
-
-        # Get or create collection
-        self.collection = self.client.get_or_create_collection(
-            name="company_policies",
-            metadata={"description": "Company policy documents"}
-        )
-
-    def parse_markdown(self, file_path: Path) -> Dict[str, Any]:
-        """Parse markdown file and extract content."""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # Convert markdown to HTML then extract text
-        html = markdown.markdown(content)
-        soup = BeautifulSoup(html, 'html.parser')
-        text = soup.get_text()
-
-        # Extract document ID and title from content
-        lines = content.split('\n')
-        title = lines[0].strip('# ') if lines else file_path.stem
-        doc_id = None
-
-        for line in lines[:20]:  # Check first 20 lines
-            if 'Document ID:' in line:
-                doc_id = line.split('Document ID:')[1].strip().replace('**', '')
-                break
-
-        if not doc_id:
-            doc_id = file_path.stem.upper()
-
-        return {
-            'title': title,
-            'doc_id': doc_id,
-            'content': text,
-            'file_path': str(file_path),
-            'format': 'markdown'
-        }
-
-    def parse_txt(self, file_path: Path) -> Dict[str, Any]:
-        """Parse plain text file."""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        return {
-            'title': file_path.stem.replace('_', ' ').title(),
-            'doc_id': file_path.stem.upper(),
-            'content': content,
-            'file_path': str(file_path),
-            'format': 'text'
-        }
-
-    def parse_pdf(self, file_path: Path) -> Dict[str, Any]:
-        """Parse PDF file."""
-        content = []
-        with open(file_path, 'rb') as f:
-            pdf_reader = PdfReader(f)
-            for page in pdf_reader.pages:
-                content.append(page.extract_text())
-
-        return {
-            'title': file_path.stem.replace('_', ' ').title(),
-            'doc_id': file_path.stem.upper(),
-            'content': '\n'.join(content),
-            'file_path': str(file_path),
-            'format': 'pdf'
-        }
-
-    def parse_html(self, file_path: Path) -> Dict[str, Any]:
-        """Parse HTML file."""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-
-        soup = BeautifulSoup(html_content, 'html.parser')
-        text = soup.get_text()
-        title = soup.find('title')
-        title = title.get_text() if title else file_path.stem
-
-        return {
-            'title': title,
-            'doc_id': file_path.stem.upper(),
-            'content': text,
-            'file_path': str(file_path),
-            'format': 'html'
-        }
-
-    def parse_document(self, file_path: Path) -> Dict[str, Any]:
-        """Parse document based on file extension."""
-        ext = file_path.suffix.lower()
-
-        if ext == '.md':
-            return self.parse_markdown(file_path)
-        elif ext == '.txt':
-            return self.parse_txt(file_path)
-        elif ext == '.pdf':
-            return self.parse_pdf(file_path)
-        elif ext in ['.html', '.htm']:
-            return self.parse_html(file_path)
-        else:
-            raise ValueError(f"Unsupported file format: {ext}")
-
-    def chunk_text(self, text: str, metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """
-        Chunk text into smaller pieces with overlap.
-        Uses word-based chunking with heading awareness.
-        """
-        chunks = []
-        words = text.split()
-
-        # Simple word-based chunking
-        start = 0
-        chunk_id = 0
-
-        while start < len(words):
-            end = start + self.chunk_size
-            chunk_words = words[start:end]
-            chunk_text = ' '.join(chunk_words)
-
-            # Create unique chunk ID
-            chunk_hash = hashlib.md5(chunk_text.encode()).hexdigest()[:8]
-
-            chunks.append({
-                'text': chunk_text,
-                'chunk_id': f"{metadata['doc_id']}_chunk_{chunk_id}_{chunk_hash}",
-                'chunk_index': chunk_id,
-                'doc_id': metadata['doc_id'],
-                'title': metadata['title'],
-                'file_path': metadata['file_path']
-            })
-
-            chunk_id += 1
-            start = end - self.chunk_overlap
-
-        return chunks
-
-    def embed_chunks(self, chunks: List[Dict[str, Any]]) -> List[List[float]]:
-        """Generate embeddings for text chunks."""
-        texts = [chunk['text'] for chunk in chunks]
-        embeddings = self.embedding_model.encode(texts, show_progress_bar=True)
-        return embeddings.tolist()
-
-    def ingest_documents(self) -> Dict[str, Any]:
-        """
-        Main ingestion pipeline: parse all documents, chunk, embed, and store.
-        """
-        print(f"Starting document ingestion from {self.docs_path}")
-
-        # Find all supported documents
-        supported_exts = ['.md', '.txt', '.pdf', '.html', '.htm']
-        doc_files = [f for f in self.docs_path.iterdir()
-                     if f.is_file() and f.suffix.lower() in supported_exts]
-
-        print(f"Found {len(doc_files)} documents to process")
-
-        all_chunks = []
-        stats = {
-            'total_docs': len(doc_files),
-            'total_chunks': 0,
-            'documents': []
-        }
-
-        for doc_file in doc_files:
-            print(f"\nProcessing: {doc_file.name}")
-
-            try:
-                # Parse document
-                doc_data = self.parse_document(doc_file)
-                print(f"  - Title: {doc_data['title']}")
-                print(f"  - Doc ID: {doc_data['doc_id']}")
-                print(f"  - Content length: {len(doc_data['content'])} chars")
-
-                # Chunk document
-                chunks = self.chunk_text(doc_data['content'], doc_data)
-                print(f"  - Created {len(chunks)} chunks")
-
-                all_chunks.extend(chunks)
-
-                stats['documents'].append({
-                    'file': doc_file.name,
-                    'title': doc_data['title'],
-                    'doc_id': doc_data['doc_id'],
-                    'chunks': len(chunks)
-                })
-                stats['total_chunks'] += len(chunks)
-
-            except Exception as e:
-                print(f"  - ERROR: {str(e)}")
-                continue
-
-        if not all_chunks:
-            print("No chunks created. Exiting.")
-            return stats
-
-        print(f"\n{'='*60}")
-        print(f"Total chunks to embed: {len(all_chunks)}")
-        print("Generating embeddings...")
-
-        # Generate embeddings
-        embeddings = self.embed_chunks(all_chunks)
-
-        print("Storing in vector database...")
-
-        # Prepare data for ChromaDB
-        ids = [chunk['chunk_id'] for chunk in all_chunks]
-        documents = [chunk['text'] for chunk in all_chunks]
-        metadatas = [{
-            'doc_id': chunk['doc_id'],
-            'title': chunk['title'],
-            'file_path': chunk['file_path'],
-            'chunk_index': chunk['chunk_index']
-        } for chunk in all_chunks]
-
-        # Store in ChromaDB (batch if large)
-        batch_size = 100
-        for i in range(0, len(ids), batch_size):
-            batch_end = min(i + batch_size, len(ids))
-            self.collection.add(
-                ids=ids[i:batch_end],
-                embeddings=embeddings[i:batch_end],
-                documents=documents[i:batch_end],
-                metadatas=metadatas[i:batch_end]
-            )
-            print(f"  - Stored batch {i//batch_size + 1}/{(len(ids)-1)//batch_size + 1}")
-
-        print(f"\n{'='*60}")
-        print("Ingestion complete!")
-        print(f"Total documents: {stats['total_docs']}")
-        print(f"Total chunks: {stats['total_chunks']}")
-        print(f"Vector DB location: {self.db_path}")
-
-        return stats
-
-
-def main():
-    """Run document ingestion."""
-    import json
-
-    # Set random seed for reproducibility
-    import random
-    import numpy as np
-    random.seed(42)
-    np.random.seed(42)
-
-    # Initialize and run ingestion
-    ingestion = DocumentIngestion(
-        docs_path="documents",
-        db_path="chroma_db",
-        embedding_model="all-MiniLM-L6-v2",
-        chunk_size=500,  # words
-        chunk_overlap=50
-    )
-
-    stats = ingestion.ingest_documents()
-
-    # Save stats
-    with open('ingestion_stats.json', 'w') as f:
-        json.dump(stats, f, indent=2)
-
-    print("\nStats saved to ingestion_stats.json")
-
-
 if __name__ == "__main__":
     main()
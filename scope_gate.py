@@ -0,0 +1,210 @@
+"""
+Out-of-scope gate.
+Refuses clearly off-domain questions before any LLM call. Two cheap signals are combined: the
+distance of the nearest retrieved chunk and the similarity of the question to per-document
+centroids of the corpus embeddings (computed at ingestion). Thresholds are calibrated by
+evaluate.py on in-domain evaluation questions and a set of off-domain questions.
+"""
+
+import os
+import json
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+# Same wording as the prompt guardrail, so clients see one refusal either way
+OUT_OF_SCOPE_ANSWER = ("I can only answer questions about our company policies, and I don't have "
+                       "information about that in the policy documents.")
+
+# Written by `python evaluate.py --calibrate-scope`, read by the server
+SCOPE_GATE_PATH = os.getenv("SCOPE_GATE_PATH", "scope_gate.json")
+
+
+def centroids_path(db_path: str, collection: str) -> str:
+    """Centroid file of a collection (next to the ChromaDB files)."""
+    return os.path.join(db_path, f"scope_{collection}.npz")
+
+
+def compute_centroids(embeddings: np.ndarray, doc_ids: List[str]) -> Dict[str, np.ndarray]:
+    """Normalized mean embedding per document."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    ids = sorted(set(doc_ids))
+    labels = np.array([ids.index(doc_id) for doc_id in doc_ids])
+    centroids = np.stack([embeddings[labels == i].mean(axis=0) for i in range(len(ids))])
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return {'doc_ids': np.array(ids), 'centroids': centroids}
+
+
+def write_centroids(path: str, embeddings: np.ndarray, doc_ids: List[str], embedding_model: str):
+    """Store a collection's document centroids (atomically, servers may be reading)."""
+    data = compute_centroids(embeddings, doc_ids)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, embedding_model=np.array(embedding_model), **data)
+    os.replace(tmp_path, path)
+
+
+class ScopeGate:
+    def __init__(self,
+                 db_path: str,
+                 max_distance: float = 1.8,
+                 min_similarity: float = 0.1):
+        """
+        Initialize the out-of-scope gate.
+
+        A question is refused only when both signals say off-domain.
+
+        Args:
+            db_path: ChromaDB directory holding the centroid files
+            max_distance: Nearest-chunk distances above this are off-domain (collection's HNSW space)
+            min_similarity: Best document-centroid cosine similarities below this are off-domain
+        """
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.min_similarity = min_similarity
+        self._centroids = {}
+        self._lock = threading.Lock()
+        self.stats = {'checked': 0, 'refused': 0, 'llm_calls_skipped': 0, 'no_centroids': 0}
+
+    @classmethod
+    def from_env(cls, db_path: str, path: Optional[str] = None) -> Optional["ScopeGate"]:
+        """
+        Build from the calibrated settings file, overridden by SCOPE_GATE_* environment
+        variables (None unless SCOPE_GATE=true).
+        """
+        if os.getenv("SCOPE_GATE", "false").lower() != "true":
+            return None
+        settings = {}
+        path = path or SCOPE_GATE_PATH
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                settings = json.load(f).get('recommended', {})
+        defaults = cls(db_path)
+        return cls(
+            db_path,
+            max_distance=float(os.getenv("SCOPE_GATE_MAX_DISTANCE", settings.get('max_distance', defaults.max_distance))),
+            min_similarity=float(os.getenv("SCOPE_GATE_MIN_SIMILARITY",
+                                           settings.get('min_similarity', defaults.min_similarity)))
+        )
+
+    def _load(self, collection: str) -> Optional[Dict[str, Any]]:
+        """Centroids of a collection, re-read when ingestion rewrote them."""
+        path = centroids_path(self.db_path, collection)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._centroids.get(collection)
+            if cached is None or cached['mtime'] != mtime:
+                with np.load(path) as data:
+                    cached = {'mtime': mtime, 'centroids': data['centroids'], 'doc_ids': data['doc_ids'].tolist(),
+                              'embedding_model': str(data['embedding_model'])}
+                self._centroids[collection] = cached
+            return cached
+
+    def scores(self, collection: Optional[str], query_embedding: List[float], chunks: List[Dict[str, Any]],
+               model: Optional[str] = None) -> Dict[str, Any]:
+        """Nearest-chunk distance and best centroid similarity of a question."""
+        scores = {
+            'nearest_distance': chunks[0]['distance'] if chunks else None,
+            'centroid_similarity': None,
+            'nearest_doc': None
+        }
+        centroids = self._load(collection) if collection else None
+        if centroids is not None and (model is None or centroids['embedding_model'] == model):
+            query = np.asarray(query_embedding, dtype=np.float32)
+            similarities = centroids['centroids'] @ (query / max(float(np.linalg.norm(query)), 1e-12))
+            best = int(np.argmax(similarities))
+            scores['centroid_similarity'] = round(float(similarities[best]), 4)
+            scores['nearest_doc'] = centroids['doc_ids'][best]
+        return scores
+
+    def refuse(self, scores: Dict[str, Any]) -> bool:
+        """Whether a question is clearly off-domain (both signals agree)."""
+        distance, similarity = scores['nearest_distance'], scores['centroid_similarity']
+        far = distance is None or distance > self.max_distance
+        off_topic = similarity is not None and similarity < self.min_similarity
+        return far and off_topic
+
+    def check(self, collection: Optional[str], query_embedding: List[float], chunks: List[Dict[str, Any]],
+              model: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Gate a question before generation.
+
+        Returns:
+            The scores if the question should be refused, else None
+        """
+        scores = self.scores(collection, query_embedding, chunks, model)
+        refused = self.refuse(scores)
+        with self._lock:
+            self.stats['checked'] += 1
+            if scores['centroid_similarity'] is None:
+                self.stats['no_centroids'] += 1
+            if refused:
+                self.stats['refused'] += 1
+                self.stats['llm_calls_skipped'] += 1
+        return scores if refused else None
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(cached['centroids'].nbytes for cached in self._centroids.values())
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'max_distance': self.max_distance,
+                'min_similarity': self.min_similarity,
+                'collections_loaded': len(self._centroids),
+                **self.stats
+            }
+
+
+def calibrate(in_domain: List[Dict[str, Any]], off_domain: List[Dict[str, Any]], margin: float = 0.02) -> Dict[str, Any]:
+    """
+    Thresholds that refuse as many off-domain questions as possible and no in-domain one.
+
+    Since both signals must agree, every pair of candidate thresholds is tried; an in-domain
+    question within `margin` of both thresholds counts as refused, which keeps headroom for
+    policy questions that were not in the evaluation set.
+
+    Args:
+        in_domain: ScopeGate.scores of policy questions
+        off_domain: ScopeGate.scores of questions the assistant should refuse
+
+    Returns:
+        Recommended thresholds and the refusals of each set
+    """
+    scored = [s for s in in_domain if s['nearest_distance'] is not None and s['centroid_similarity'] is not None]
+    if not scored:
+        raise ValueError("Calibration needs in-domain scores with distances and centroid similarities")
+
+    everything = scored + [s for s in off_domain if s['nearest_distance'] is not None]
+    distances = sorted({round(s['nearest_distance'] - margin, 4) for s in everything} |
+                       {round(max(s['nearest_distance'] for s in scored) + margin, 4)})
+    similarities = sorted({round(s['centroid_similarity'] + margin, 4)
+                           for s in everything if s['centroid_similarity'] is not None} |
+                          {round(min(s['centroid_similarity'] for s in scored) - margin, 4)})
+
+    best = None
+    for max_distance in distances:
+        for min_similarity in similarities:
+            strict = ScopeGate(db_path="", max_distance=max_distance - margin, min_similarity=min_similarity + margin)
+            if any(strict.refuse(s) for s in scored):
+                continue
+            gate = ScopeGate(db_path="", max_distance=max_distance, min_similarity=min_similarity)
+            refused = sum(gate.refuse(s) for s in off_domain)
+            # Most refusals first, then the most conservative thresholds
+            key = (refused, max_distance, -min_similarity)
+            if best is None or key > best[0]:
+                best = (key, gate)
+
+    gate = best[1]
+    off_refused = sum(gate.refuse(s) for s in off_domain)
+    return {
+        'recommended': {'max_distance': gate.max_distance, 'min_similarity': gate.min_similarity},
+        'in_domain': {'questions': len(in_domain), 'refused': sum(gate.refuse(s) for s in in_domain)},
+        'off_domain': {'questions': len(off_domain), 'refused': off_refused,
+                       'refusal_rate': round(off_refused / len(off_domain), 3) if off_domain else None}
+    }
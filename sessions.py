@@ -0,0 +1,237 @@
+"""
+Multi-turn conversation sessions.
+Keeps a short history and the retrieved chunk set per session id, bounded by TTL, session
+count and memory, so follow-up questions on the same topic reuse the earlier context and
+only retrieve what is new.
+"""
+
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+class Session:
+    def __init__(self,
+                 session_id: str,
+                 max_turns: int = 6,
+                 max_chunks: int = 10,
+                 reuse_similarity: float = 0.5,
+                 incremental_k: int = 2):
+        """
+        One conversation.
+
+        Args:
+            session_id: Opaque id handed to the client
+            max_turns: Question/answer pairs kept for the prompt
+            max_chunks: Chunks kept as the session context (oldest dropped first)
+            reuse_similarity: Cosine similarity to the session topic above which a
+                              question is treated as a follow-up
+            incremental_k: Chunks retrieved on a follow-up to pick up new content
+        """
+        self.session_id = session_id
+        self.max_turns = max_turns
+        self.max_chunks = max_chunks
+        self.reuse_similarity = reuse_similarity
+        self.incremental_k = incremental_k
+
+        self.lock = threading.Lock()
+        self.turns = []
+        self.chunks = []
+        self.topic = None
+        self.scope = None
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.stats = {'full_retrievals': 0, 'reused_retrievals': 0}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def is_follow_up(self, embedding: List[float], scope: Any) -> bool:
+        """Whether the question stays on the session topic (same tenant/filters, close embedding)."""
+        if self.topic is None or not self.chunks or scope != self.scope:
+            return False
+        return float(self._normalize(embedding) @ self.topic) >= self.reuse_similarity
+
+    def reset_context(self, chunks: List[Dict[str, Any]], embedding: List[float], scope: Any):
+        """Start a new topic with a fresh retrieval."""
+        self.chunks = list(chunks)[-self.max_chunks:]
+        self.topic = self._normalize(embedding)
+        self.scope = scope
+        self.stats['full_retrievals'] += 1
+
+    def extend_context(self, chunks: List[Dict[str, Any]], embedding: List[float]) -> int:
+        """
+        Add chunks not already in the context and drift the topic towards the question.
+
+        Existing chunks keep their position so source numbers stay stable across turns.
+
+        Returns:
+            Number of chunks added
+        """
+        known = {chunk['chunk_id'] for chunk in self.chunks}
+        added = [chunk for chunk in chunks if chunk['chunk_id'] not in known]
+        self.chunks = (self.chunks + added)[-self.max_chunks:]
+        self.topic = self._normalize(0.7 * self.topic + 0.3 * self._normalize(embedding))
+        self.stats['reused_retrievals'] += 1
+        return len(added)
+
+    def add_turn(self, question: str, answer: str):
+        self.turns.append({'question': question, 'answer': answer, 'timestamp': time.time()})
+        self.turns = self.turns[-self.max_turns:]
+
+    def history(self) -> List[Dict[str, str]]:
+        return [{'question': turn['question'], 'answer': turn['answer']} for turn in self.turns]
+
+    def memory_bytes(self) -> int:
+        """Approximate size of the session state."""
+        text = sum(len(chunk['text']) for chunk in self.chunks)
+        text += sum(len(turn['question']) + len(turn['answer']) for turn in self.turns)
+        return 512 + text + (self.topic.nbytes if self.topic is not None else 0)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'session_id': self.session_id,
+            'turns': self.history(),
+            'chunk_ids': [chunk['chunk_id'] for chunk in self.chunks],
+            'created_at': self.created_at,
+            'last_used': self.last_used,
+            'memory_bytes': self.memory_bytes(),
+            **self.stats
+        }
+
+
+class SessionStore:
+    def __init__(self,
+                 ttl_seconds: float = 1800.0,
+                 max_sessions: int = 1000,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 max_turns: int = 6,
+                 max_chunks: int = 10,
+                 reuse_similarity: float = 0.5,
+                 incremental_k: int = 2):
+        """
+        Initialize in-process session store (least recently used sessions are evicted first).
+
+        Args:
+            ttl_seconds: Idle time after which a session expires
+            max_sessions: Maximum number of live sessions
+            max_bytes: Memory budget for all sessions
+            max_turns, max_chunks, reuse_similarity, incremental_k: See Session
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.session_options = {
+            'max_turns': max_turns,
+            'max_chunks': max_chunks,
+            'reuse_similarity': reuse_similarity,
+            'incremental_k': incremental_k
+        }
+
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self.stats = {'created': 0, 'expired': 0, 'evicted': 0}
+
+    @classmethod
+    def from_env(cls) -> "SessionStore":
+        """Build a store from SESSION_* environment variables."""
+        return cls(
+            ttl_seconds=float(os.getenv("SESSION_TTL", "1800")),
+            max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", "1000")),
+            max_bytes=int(float(os.getenv("SESSION_MAX_MB", "64")) * 1024 * 1024),
+            max_turns=int(os.getenv("SESSION_MAX_TURNS", "6")),
+            max_chunks=int(os.getenv("SESSION_MAX_CHUNKS", "10")),
+            reuse_similarity=float(os.getenv("SESSION_REUSE_SIMILARITY", "0.5")),
+            incremental_k=int(os.getenv("SESSION_INCREMENTAL_K", "2"))
+        )
+
+    def _expire_locked(self, now: float):
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl_seconds:
+                break
+            self._sessions.popitem(last=False)
+            self.stats['expired'] += 1
+
+    def _evict_locked(self):
+        total = sum(session.memory_bytes() for session in self._sessions.values())
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or total > self.max_bytes):
+            _, session = self._sessions.popitem(last=False)
+            total -= session.memory_bytes()
+            self.stats['evicted'] += 1
+
+    def create(self) -> Session:
+        """Start a new session."""
+        session = Session(uuid.uuid4().hex, **self.session_options)
+        with self._lock:
+            self._expire_locked(session.created_at)
+            self._sessions[session.session_id] = session
+            self.stats['created'] += 1
+            self._evict_locked()
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """Return a live session (refreshing its TTL), or None if unknown or expired."""
+        now = time.time()
+        with self._lock:
+            self._expire_locked(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.last_used = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def touch(self, session: Session):
+        """Re-apply memory bounds after a session grew."""
+        with self._lock:
+            self._evict_locked()
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(session.memory_bytes() for session in self._sessions.values())
+
+    def shrink(self, fraction: float = 0.5) -> int:
+        """
+        Evict least recently used sessions until they use at most `fraction` of their current memory.
+
+        Returns:
+            Number of sessions evicted
+        """
+        with self._lock:
+            total = sum(session.memory_bytes() for session in self._sessions.values())
+            target = total * fraction
+            evicted = 0
+            while self._sessions and total > target:
+                _, session = self._sessions.popitem(last=False)
+                total -= session.memory_bytes()
+                self.stats['evicted'] += 1
+                evicted += 1
+            return evicted
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def info(self) -> Dict[str, Any]:
+        """Return live session count, memory and lifecycle counters."""
+        with self._lock:
+            self._expire_locked(time.time())
+            return {
+                'sessions': len(self._sessions),
+                'max_sessions': self.max_sessions,
+                'memory_mb': round(sum(s.memory_bytes() for s in self._sessions.values()) / (1024 * 1024), 3),
+                'max_memory_mb': round(self.max_bytes / (1024 * 1024), 2),
+                'ttl_s': self.ttl_seconds,
+                **self.stats,
+                'full_retrievals': sum(s.stats['full_retrievals'] for s in self._sessions.values()),
+                'reused_retrievals': sum(s.stats['reused_retrievals'] for s in self._sessions.values())
+            }
@@ -17,6 +17,8 @@ os.environ["ORT_DEVICE"] = "CPU"
 import chromadb
 from chromadb.config import Settings
 
+from blue_green import IndexPointer
+
 
 def check_and_initialize_db():
     """Check if ChromaDB collection exists, create if not."""
@@ -32,8 +34,10 @@ def check_and_initialize_db():
             )
         )
 
+        # The collection serving the default tenant (changes with blue/green swaps)
+        name = IndexPointer(db_path).active()
         try:
-            collection = client.get_collection(name="company_policies")
+            collection = client.get_collection(name=name)
             count = collection.count()
             if count > 0:
                 print(f"✅ Vector database ready with {count} chunks")
@@ -42,7 +46,7 @@ def check_and_initialize_db():
                 print("⚠️  Collection exists but is empty")
                 return False
         except Exception:
-            print("⚠️  Collection 'company_policies' not found")
+            print(f"⚠️  Collection '{name}' not found")
             return False
 
     except Exception as e:
@@ -50,6 +54,25 @@ def check_and_initialize_db():
         return False
 
 
+def check_index_bundle(bundle_path: str):
+    """Check that the prebuilt index bundle exists, is intact and matches EMBEDDING_MODEL."""
+    from index_bundle import IndexBundle, BundleError
+
+    if not os.path.exists(bundle_path):
+        print(f"⚠️  Index bundle {bundle_path} not found")
+        return False
+
+    try:
+        bundle = IndexBundle(bundle_path, verify_checksum=True)
+        bundle.check_model(os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+        print(f"✅ Index bundle {bundle.version} ready with {bundle.count()} chunks")
+        bundle.close()
+        return True
+    except BundleError as e:
+        print(f"⚠️  {e}")
+        return False
+
+
 def initialize_database():
     """Initialize vector database with documents."""
     print("🔄 Initializing vector database...")
@@ -61,7 +84,7 @@ def initialize_database():
         return False
 
     # Check if there are documents
-    doc_files = list(docs_path.glob("*.md")) + list(docs_path.glob("*.txt"))
+    doc_files = [f for f in docs_path.iterdir() if f.suffix.lower() in ('.md', '.txt', '.pdf', '.html', '.htm')]
     if not doc_files:
         print("❌ No documents found in documents directory!")
         return False
@@ -77,7 +100,9 @@ def initialize_database():
             db_path=os.getenv("CHROMA_DB_PATH", "chroma_db"),
             embedding_model=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"),
             chunk_size=500,
-            chunk_overlap=50
+            chunk_overlap=50,
+            bundle_path=os.getenv("INDEX_BUNDLE_PATH") or None,
+            vector_dtype=os.getenv("INDEX_VECTOR_DTYPE", "float32")
         )
 
         stats = ingestion.ingest_documents()
@@ -102,8 +127,11 @@ def main():
     print("Starting Company Policy RAG System")
     print("="*60)
 
-    # Check if database exists and is ready
-    if not check_and_initialize_db():
+    # Check if the prebuilt bundle (or database) exists and is ready
+    bundle_path = os.getenv("INDEX_BUNDLE_PATH")
+    ready = check_index_bundle(bundle_path) if bundle_path else check_and_initialize_db()
+
+    if not ready:
         print("\n🔧 Database not ready, initializing...")
         if not initialize_database():
             print("\n❌ Failed to initialize database!")
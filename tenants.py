@@ -0,0 +1,302 @@
+"""
+Tenant-scoped policy collections.
+Each subsidiary gets its own collection (and optionally its own index bundle). The server keeps
+a memory-bounded LRU of opened tenant indexes, loads cold tenants on demand and evicts idle ones.
+Requests pin the index they search, so an evicted index is closed once its last search is done.
+"""
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+
+DEFAULT_TENANT = "default"
+DEFAULT_COLLECTION = "company_policies"
+
+# Chroma collection names must be 3-63 chars; keep tenant ids short and filesystem-safe
+_TENANT_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,39}$")
+
+# HNSW graph links per vector at the base layer (M=16 -> 2*M int32 neighbours)
+_HNSW_LINK_BYTES = 2 * 16 * 4
+
+
+class UnknownTenantError(KeyError):
+    """Raised when a tenant has no ingested collection."""
+
+
+def validate_tenant(tenant: Optional[str]) -> str:
+    """
+    Normalize a tenant id, falling back to the default tenant.
+
+    Raises:
+        ValueError: Tenant id is not 1-40 chars of [a-z0-9_-]
+    """
+    tenant = (tenant or DEFAULT_TENANT).strip().lower()
+    if not _TENANT_PATTERN.match(tenant):
+        raise ValueError(f"Invalid tenant id: {tenant!r} (use 1-40 chars of a-z, 0-9, '_' or '-')")
+    return tenant
+
+
+def collection_name(tenant: Optional[str] = None) -> str:
+    """Collection holding a tenant's chunks (the default tenant keeps the historical name)."""
+    tenant = validate_tenant(tenant)
+    if tenant == DEFAULT_TENANT:
+        return DEFAULT_COLLECTION
+    return f"{DEFAULT_COLLECTION}__{tenant}"
+
+
+def release_chroma_collection(client: Any, collection_id: Any) -> bool:
+    """
+    Drop a collection's loaded vector index from a ChromaDB client.
+
+    chromadb 0.4.x keeps every queried HNSW index in memory for the lifetime of the client and
+    has no public unload call, so this reaches into the local segment manager (best effort).
+    The index is reloaded from disk transparently on the next query.
+
+    Returns:
+        True if an index was unloaded
+    """
+    try:
+        from chromadb.types import SegmentScope
+
+        manager = client._server._manager
+        with manager._lock:
+            segment = manager._segment_cache.get(collection_id, {}).pop(SegmentScope.VECTOR, None)
+            instance = manager._instances.pop(segment['id'], None) if segment else None
+        if instance is None:
+            return False
+        handles = getattr(manager, '_vector_instances_file_handle_cache', None)
+        if handles is not None:
+            handles.cache.pop(collection_id, None)
+        if hasattr(instance, 'close_persistent_index'):
+            instance.close_persistent_index()
+        instance.stop()
+        return True
+    except (AttributeError, ImportError, KeyError):
+        return False
+
+
+class TenantIndex:
+    def __init__(self,
+                 tenant: str,
+                 collection: Any,
+                 memory_bytes: int,
+                 source: str,
+                 close: Optional[Callable[[], Any]] = None):
+        """
+        One opened tenant index.
+
+        Args:
+            tenant: Tenant id
+            collection: Chroma collection or BundleCollection
+            memory_bytes: Estimated resident size of the index
+            source: 'chroma' or 'bundle'
+            close: Releases the index memory on eviction
+        """
+        self.tenant = tenant
+        self.collection = collection
+        self.memory_bytes = memory_bytes
+        self.source = source
+        self._close = close
+        self.hits = 0
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        # Requests searching the index right now, and whether the cache has let go of it
+        self.users = 0
+        self.evicted = False
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+    def shares_segment(self, other: "TenantIndex") -> bool:
+        """Whether both indexes are the same ChromaDB collection (its segment is per client, not per index)."""
+        return (self.source == other.source == 'chroma'
+                and getattr(self.collection, 'id', self.collection) == getattr(other.collection, 'id', other.collection))
+
+
+class TenantIndexCache:
+    def __init__(self,
+                 loader: Callable[[str], TenantIndex],
+                 max_tenants: int = 32,
+                 max_bytes: int = 512 * 1024 * 1024):
+        """
+        Initialize the LRU of opened tenant indexes.
+
+        Args:
+            loader: Opens a tenant index (raises UnknownTenantError if it does not exist)
+            max_tenants: Maximum number of tenants kept open
+            max_bytes: Memory budget for all open tenant indexes
+        """
+        self.loader = loader
+        self.max_tenants = max_tenants
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._open = OrderedDict()
+        # Evicted indexes still being searched; closed when their last user releases them
+        self._draining = []
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'deferred_closes': 0, 'load_seconds': 0.0}
+
+    @classmethod
+    def from_env(cls, loader: Callable[[str], TenantIndex]) -> "TenantIndexCache":
+        """Build a cache from TENANT_CACHE_* environment variables."""
+        return cls(
+            loader,
+            max_tenants=int(os.getenv("TENANT_CACHE_MAX_TENANTS", "32")),
+            max_bytes=int(float(os.getenv("TENANT_CACHE_MAX_MB", "512")) * 1024 * 1024)
+        )
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(index.memory_bytes for index in self._open.values())
+
+    def get(self, tenant: str) -> TenantIndex:
+        """
+        Return an open tenant index, loading it (and evicting idle tenants) if needed.
+
+        The index is pinned: it stays usable until the caller hands it to release(), even if
+        it is evicted meanwhile. Prefer use(), which releases it automatically.
+        """
+        while True:
+            with self._lock:
+                index = self._open.get(tenant)
+                if index is not None:
+                    self._open.move_to_end(tenant)
+                    index.hits += 1
+                    index.users += 1
+                    index.last_used = time.time()
+                    self.stats['hits'] += 1
+                    return index
+
+                loading = self._loading.get(tenant)
+                if loading is None:
+                    # This thread loads the tenant; concurrent requests wait for it
+                    loading = self._loading[tenant] = threading.Event()
+                    self.stats['misses'] += 1
+                    break
+            loading.wait()
+
+        start = time.perf_counter()
+        try:
+            index = self.loader(tenant)
+        except BaseException:
+            with self._lock:
+                self._loading.pop(tenant).set()
+            raise
+
+        with self._lock:
+            self.stats['load_seconds'] += time.perf_counter() - start
+            index.hits += 1
+            index.users += 1
+            self._open[tenant] = index
+            idle = self._evict_locked(keep=tenant)
+            self._loading.pop(tenant).set()
+
+        self._close(idle)
+        return index
+
+    def release(self, index: TenantIndex):
+        """Unpin an index returned by get(), closing it if it was evicted while in use."""
+        with self._lock:
+            index.users -= 1
+            idle = self._retire_locked([index]) if index.evicted and index.users == 0 else []
+        self._close(idle)
+
+    @contextmanager
+    def use(self, tenant: str):
+        """Pin a tenant index for the duration of the block (see get)."""
+        index = self.get(tenant)
+        try:
+            yield index
+        finally:
+            self.release(index)
+
+    def _retire_locked(self, evicted):
+        """
+        Mark indexes as evicted and pick those that can be closed now.
+
+        An index still pinned by a request is parked until release(); an index whose ChromaDB
+        segment is shared with an open index (the tenant was reloaded) is never closed.
+        """
+        idle = []
+        for index in evicted:
+            index.evicted = True
+            if index in self._draining:
+                self._draining.remove(index)
+            if index.users > 0:
+                self._draining.append(index)
+                self.stats['deferred_closes'] += 1
+            elif not any(index.shares_segment(other) for other in list(self._open.values()) + self._draining):
+                idle.append(index)
+        return idle
+
+    @staticmethod
+    def _close(indexes):
+        for index in indexes:
+            index.close()
+
+    def _evict_locked(self, keep: str):
+        evicted = []
+        while len(self._open) > 1 and (len(self._open) > self.max_tenants or self.memory_bytes > self.max_bytes):
+            tenant = next(iter(self._open))
+            if tenant == keep:
+                break
+            evicted.append(self._open.pop(tenant))
+            self.stats['evictions'] += 1
+        return self._retire_locked(evicted)
+
+    def evict_all(self) -> int:
+        """Close every open tenant index (they reopen on next use; pinned ones close when released)."""
+        with self._lock:
+            evicted = list(self._open.values())
+            self._open.clear()
+            self.stats['evictions'] += len(evicted)
+            idle = self._retire_locked(evicted)
+        self._close(idle)
+        return len(evicted)
+
+    def evict(self, tenant: str) -> bool:
+        """Close a tenant index (e.g. after re-ingestion; if pinned, once it is released)."""
+        with self._lock:
+            index = self._open.pop(tenant, None)
+            if index is None:
+                return False
+            idle = self._retire_locked([index])
+        self._close(idle)
+        return True
+
+    def info(self) -> Dict[str, Any]:
+        """Return cache totals and per-tenant memory and hit counts."""
+        now = time.time()
+        with self._lock:
+            tenants = {
+                tenant: {
+                    'source': index.source,
+                    'collection': getattr(index.collection, 'name', None),
+                    'memory_mb': round(index.memory_bytes / (1024 * 1024), 2),
+                    'hits': index.hits,
+                    'idle_s': round(now - index.last_used, 1)
+                }
+                for tenant, index in self._open.items()
+            }
+            return {
+                'open_tenants': len(self._open),
+                'draining_tenants': len(self._draining),
+                'max_tenants': self.max_tenants,
+                'memory_mb': round(self.memory_bytes / (1024 * 1024), 2),
+                'max_memory_mb': round(self.max_bytes / (1024 * 1024), 2),
+                **self.stats,
+                'load_seconds': round(self.stats['load_seconds'], 3),
+                'tenants': tenants
+            }
+
+
+def estimate_chroma_bytes(count: int, dimension: int) -> int:
+    """Approximate resident size of an HNSW index: float32 vectors plus base-layer links."""
+    return count * (dimension * 4 + _HNSW_LINK_BYTES)
@@ -210,5 +210,1773 @@ class TestPerformance:
         assert len(chunks) > 0
 
 
+
+class TestLLMResponseCache:
+    """Test on-disk LLM response cache"""
+
+    def test_readwrite_roundtrip(self, tmp_path):
+        """Test that stored responses are served on the next lookup"""
+        from llm_cache import LLMResponseCache
+        cache = LLMResponseCache(str(tmp_path / 'cache.sqlite'))
+        key = LLMResponseCache.make_key('groq', 'model', 'prompt', 500, 0.3, 0.9)
+        assert cache.get(key) is None
+        cache.put(key, 'groq', 'model', 'cached answer [Source 1]')
+        assert cache.get(key) == 'cached answer [Source 1]'
+        assert cache.info()['hits'] == 1
+
+    def test_key_depends_on_sampling_params(self):
+        """Test that different sampling parameters never share an entry"""
+        from llm_cache import LLMResponseCache
+        base = LLMResponseCache.make_key('groq', 'model', 'prompt', 500, 0.3, 0.9)
+        assert base != LLMResponseCache.make_key('groq', 'model', 'prompt', 500, 0.7, 0.9)
+        assert base != LLMResponseCache.make_key('openai', 'model', 'prompt', 500, 0.3, 0.9)
+
+    def test_replay_miss_raises(self, tmp_path):
+        """Test that replay mode never falls through to the LLM"""
+        from llm_cache import LLMResponseCache, CacheMiss
+        cache = LLMResponseCache(str(tmp_path / 'cache.sqlite'), mode='replay')
+        with pytest.raises(CacheMiss):
+            cache.get('missing')
+
+    def test_replay_miss_fails_generate(self, client, monkeypatch, tmp_path):
+        """Test that a replay miss propagates out of generate() instead of becoming an answer"""
+        import app as app_module
+        from llm_cache import LLMResponseCache, CacheMiss
+        rag = app_module.get_rag_pipeline()
+        monkeypatch.setattr(rag, 'response_cache', LLMResponseCache(str(tmp_path / 'cache.sqlite'), mode='replay'))
+        with pytest.raises(CacheMiss):
+            rag.generate('prompt')
+
+    def test_size_bounded_eviction(self, tmp_path):
+        """Test that least recently used entries are evicted over budget"""
+        from llm_cache import LLMResponseCache
+        cache = LLMResponseCache(str(tmp_path / 'cache.sqlite'), max_bytes=200)
+        for i in range(20):
+            cache.put(f'key{i}', 'groq', 'model', os.urandom(40).hex())
+        info = cache.info()
+        assert info['bytes'] <= 200
+        assert info['evictions'] > 0
+        assert cache.get('key19') is not None
+        assert cache._total_bytes == info['bytes']
+        cache.put('key19', 'groq', 'model', 'short')
+        assert cache._total_bytes == cache.info()['bytes']
+
+
+class TestRequestCoalescing:
+    """Test single-flight coalescing of identical questions"""
+
+    def test_normalize_question(self):
+        """Test that trivially different phrasings share a key"""
+        from coalesce import normalize_question
+        assert normalize_question("  How many PTO days?") == normalize_question("how many  pto days")
+
+    def test_concurrent_calls_share_execution(self):
+        """Test that concurrent callers with one key run the work once"""
+        import threading
+        import time
+        from coalesce import SingleFlight
+        group = SingleFlight()
+        calls = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'answer': 'shared'}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(group.do('q', work)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert all(result == {'answer': 'shared'} for result, _ in results)
+        assert group.info()['coalesced'] == 4
+        assert group.info()['in_flight'] == 0
+
+    def test_errors_propagate_to_followers(self):
+        """Test that a failed execution reaches its followers and is not cached for later callers"""
+        import threading
+        import time
+        from coalesce import SingleFlight
+        group = SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def fail():
+            release.wait(5)
+            raise RuntimeError("boom")
+
+        def call():
+            try:
+                group.do('q', fail)
+            except RuntimeError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        while group.info()['in_flight'] == 0:
+            time.sleep(0.001)
+        follower = threading.Thread(target=call)
+        follower.start()
+        while group.info()['coalesced'] == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+
+        assert len(errors) == 2 and errors[0] is errors[1]
+        assert group.info()['executions'] == 1 and group.info()['errors'] == 1
+        assert group.do('q', lambda: 42) == (42, False)
+
+    def test_coalesced_callers_get_independent_results(self, client, monkeypatch):
+        """Test that shaping one coalesced response never changes another caller's"""
+        import threading
+        import time
+        import app as app_module
+        from payload import shape_response
+        monkeypatch.setattr('app.preload_complete', True)
+        monkeypatch.setattr('app.coalesce_enabled', True)
+        release = threading.Event()
+        monkeypatch.setattr(app_module.get_rag_pipeline(), 'generate',
+                            lambda prompt, **kwargs: release.wait(5) and 'answer')
+
+        def shape_and_tag(result, **kwargs):
+            # A layer that edits sources in place, e.g. to annotate them
+            for source in result['sources']:
+                source['tags'] = source.get('tags', []) + ['seen']
+            return shape_response(result, **kwargs)
+        monkeypatch.setattr('app.shape_response', shape_and_tag)
+
+        bodies = []
+
+        def ask():
+            response = app_module.app.test_client().post('/chat', json={'question': 'How many PTO days do I get?'})
+            bodies.append(json.loads(response.data))
+        threads = [threading.Thread(target=ask) for _ in range(2)]
+        threads[0].start()
+        while app_module.query_coalescer.info()['in_flight'] == 0:
+            time.sleep(0.001)
+        threads[1].start()
+        while app_module.query_coalescer.info()['coalesced'] == 0:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(bodies) == 2 and all(body['coalesced'] for body in bodies)
+        assert all(source['tags'] == ['seen'] for body in bodies for source in body['sources'])
+
+    def test_unhashable_top_k_is_rejected(self, client):
+        """Test that top_k values that cannot be part of the coalescing key get a 400"""
+        for top_k in ([3], {'k': 3}, True, 0, '3'):
+            response = client.post('/chat', json={'question': 'How many PTO days do I get?', 'top_k': top_k})
+            assert response.status_code == 400, top_k
+
+    def test_metrics_endpoint(self, client):
+        """Test that coalescing counters are exported"""
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert 'coalesced' in data['coalescing']
+
+
+class TestLLMClient:
+    """Test timeout-bounded and hedged LLM requests against a fake provider"""
+
+    def _complete(self, client, timeout=None):
+        from llm_client import bounded_client
+        if timeout is not None:
+            client = bounded_client(client, timeout)
+        return client.chat.completions.create(
+            model='fake', messages=[{'role': 'user', 'content': 'hi'}]
+        )
+
+    def test_total_timeout(self):
+        """Test that a stuck provider fails fast instead of holding the worker"""
+        import time
+        from fake_llm import FakeLLMServer
+        from llm_client import build_llm_client, HedgedRequester, LLMTimeoutError
+        server = FakeLLMServer(base_latency=2.0, tail_probability=0.0).start()
+        try:
+            client = build_llm_client(api_key='test', base_url=server.base_url, max_retries=0)
+            requester = HedgedRequester(total_timeout=0.3)
+            start = time.time()
+            with pytest.raises(LLMTimeoutError):
+                requester.call(lambda timeout: self._complete(client, timeout))
+            assert time.time() - start < 1.0
+        finally:
+            server.stop()
+
+    def test_hedging_cuts_latency_tail(self):
+        """Test that a hedge masks slow requests from the injected tail"""
+        import time
+        from fake_llm import FakeLLMServer
+        from llm_client import build_llm_client, HedgedRequester
+        server = FakeLLMServer(base_latency=0.01, tail_latency=2.0,
+                               tail_probability=0.3, seed=2).start()
+        try:
+            client = build_llm_client(api_key='test', base_url=server.base_url, max_retries=0)
+            requester = HedgedRequester(hedge=True, initial_hedge_delay=0.1, total_timeout=5.0)
+            latencies = []
+            for _ in range(10):
+                start = time.time()
+                response = requester.call(lambda timeout: self._complete(client, timeout))
+                latencies.append(time.time() - start)
+                assert 'fake answer' in response.choices[0].message.content
+            assert max(latencies) < 1.0
+            assert requester.info()['hedge_wins'] >= 1
+        finally:
+            server.stop()
+
+    def test_pool_wait_counts_against_deadline(self):
+        """Test that attempts queued behind abandoned ones expire instead of starting late"""
+        import time
+        from llm_client import HedgedRequester, LLMTimeoutError
+        assert HedgedRequester(hedge=True, max_concurrency=3).max_workers == 6
+
+        requester = HedgedRequester(total_timeout=0.2, max_workers=1)
+        timeouts, started = [], []
+        with pytest.raises(LLMTimeoutError):
+            # Ignores its timeout and holds the only worker past the deadline
+            requester.call(lambda timeout: timeouts.append(timeout) or time.sleep(0.5))
+        assert 0 < timeouts[0] <= 0.2
+
+        start = time.time()
+        with pytest.raises(LLMTimeoutError):
+            requester.call(lambda timeout: started.append(timeout))
+        assert time.time() - start < 0.35
+        time.sleep(0.5)
+        # Never started: cancelled while queued, or expired when a worker came free
+        assert started == []
+        assert requester.info()['timeouts'] == 2
+
+    def test_chat_reports_llm_deadline(self, client, monkeypatch):
+        """Test that a generation deadline reaches clients as 504, not as an answer"""
+        import app as app_module
+        from llm_client import LLMTimeoutError
+        monkeypatch.setattr('app.preload_complete', True)
+        monkeypatch.setattr('app.coalesce_enabled', False)
+        rag = app_module.get_rag_pipeline()
+
+        class Expired:
+            def call(self, fn, timeout=None):
+                raise LLMTimeoutError("LLM request did not complete within 0.1s")
+        monkeypatch.setattr(rag, 'llm_requester', Expired())
+        monkeypatch.setattr(rag, 'llm_router', None)
+        monkeypatch.setattr(rag, 'response_cache', None)
+
+        response = client.post('/chat', json={'question': 'How many PTO days do I get?'})
+        assert response.status_code == 504
+        assert response.headers['Retry-After'] and json.loads(response.data)['reason'] == 'llm_timeout'
+
+
+class TestLLMRouter:
+    """Test latency-aware multi-provider routing"""
+
+    def _route(self, server, name, **kwargs):
+        from llm_client import build_llm_client, HedgedRequester
+        from llm_router import Route
+        client = build_llm_client(api_key='test', base_url=server.base_url, max_retries=0)
+        return Route('local', name, client=client,
+                     requester=HedgedRequester(total_timeout=5.0), **kwargs)
+
+    def test_routes_to_fastest_and_fails_over(self):
+        """Test failover from a broken route and preference for the faster one"""
+        from fake_llm import FakeLLMServer
+        from llm_router import LLMRouter
+        servers = [
+            FakeLLMServer(error_probability=1.0, tail_probability=0.0).start(),
+            FakeLLMServer(base_latency=0.3, tail_probability=0.0, answer='slow').start(),
+            FakeLLMServer(base_latency=0.01, tail_probability=0.0, answer='fast').start(),
+        ]
+        try:
+            router = LLMRouter([self._route(servers[0], 'broken', failure_threshold=1),
+                                self._route(servers[1], 'slow'),
+                                self._route(servers[2], 'fast')],
+                               deadline=5.0, explore_probability=0.0)
+            answers = [router.complete(messages=[{'role': 'user', 'content': 'hi'}])
+                       .choices[0].message.content for _ in range(6)]
+            assert answers[-3:] == ['fast', 'fast', 'fast']
+
+            info = router.info()
+            assert info['failovers'] >= 1
+            assert info['routes'][0]['state'] == 'open'
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_all_routes_open(self):
+        """Test that open circuits fail fast without calling providers"""
+        from fake_llm import FakeLLMServer
+        from llm_router import LLMRouter, NoHealthyRouteError
+        server = FakeLLMServer(error_probability=1.0, tail_probability=0.0).start()
+        try:
+            router = LLMRouter([self._route(server, 'broken', failure_threshold=1, cooldown=60)])
+            for _ in range(2):
+                with pytest.raises(NoHealthyRouteError):
+                    router.complete(messages=[{'role': 'user', 'content': 'hi'}])
+            assert server.requests == 1
+        finally:
+            server.stop()
+
+    def test_from_env_rejects_unknown_providers_and_missing_keys(self, monkeypatch):
+        """Test that route typos and missing API keys fail at startup"""
+        from llm_router import LLMRouter
+        monkeypatch.setenv('LLM_ROUTES', 'groqq:llama-3.1-8b-instant')
+        with pytest.raises(ValueError, match='Unknown LLM provider'):
+            LLMRouter.from_env()
+        monkeypatch.setenv('LLM_ROUTES', 'groq:llama-3.1-8b-instant,local:fake')
+        monkeypatch.delenv('GROQ_API_KEY', raising=False)
+        with pytest.raises(ValueError, match='GROQ_API_KEY'):
+            LLMRouter.from_env()
+        monkeypatch.setenv('GROQ_API_KEY', 'test')
+        assert LLMRouter.from_env().route_spec == 'groq:llama-3.1-8b-instant,local:fake'
+
+    def test_deadline_cut_attempts_do_not_trip_the_breaker(self):
+        """Test that attempts stopped by the overall deadline are not route failures"""
+        from fake_llm import FakeLLMServer
+        from llm_router import LLMRouter, NoHealthyRouteError
+        server = FakeLLMServer(base_latency=1.0, tail_probability=0.0).start()
+        try:
+            router = LLMRouter([self._route(server, 'slow', failure_threshold=1)], deadline=0.2)
+            for _ in range(2):
+                with pytest.raises(NoHealthyRouteError):
+                    router.complete(messages=[{'role': 'user', 'content': 'hi'}])
+            route = router.info()['routes'][0]
+            assert route['state'] == 'closed' and route['failures'] == 0 and route['cut_short'] == 2
+        finally:
+            server.stop()
+
+    def test_hung_route_fails_over_with_default_timeouts(self, monkeypatch):
+        """Test that a hung first route trips its breaker and the next route serves within the deadline"""
+        from fake_llm import FakeLLMServer
+        from llm_client import build_llm_client
+        from llm_router import LLMRouter
+        hung = FakeLLMServer(base_latency=2.0, tail_probability=0.0).start()
+        fast = FakeLLMServer(base_latency=0.01, tail_probability=0.0, answer='fast').start()
+        try:
+            monkeypatch.setenv('LLM_ROUTES', 'local:hang,local:fast')
+            monkeypatch.setenv('LLM_TOTAL_TIMEOUT', '0.5')
+            monkeypatch.delenv('LLM_ROUTE_TIMEOUT', raising=False)
+            monkeypatch.setenv('LLM_ROUTE_FAILURE_THRESHOLD', '1')
+            router = LLMRouter.from_env()
+            router.explore_probability = 0.0
+            for route, server in zip(router.routes, (hung, fast)):
+                route._client = build_llm_client(api_key='test', base_url=server.base_url, max_retries=0)
+
+            answers = [router.complete(messages=[{'role': 'user', 'content': 'hi'}])
+                       .choices[0].message.content for _ in range(4)]
+            assert answers == ['fast'] * 4
+            hang_info, fast_info = router.info()['routes']
+            assert hang_info['state'] == 'open' and hang_info['failures'] == 1 and hang_info['cut_short'] == 0
+            assert fast_info['successes'] == 4
+        finally:
+            hung.stop()
+            fast.stop()
+
+
+class TestAdmissionControl:
+    """Test bounded concurrency and queueing for /chat"""
+
+    def test_queue_full_rejects_with_retry_after(self):
+        """Test that overload fast-fails instead of queueing forever"""
+        from admission import AdmissionController, AdmissionRejected
+        controller = AdmissionController(max_concurrent=1, max_queue=0)
+        controller.acquire()
+        with pytest.raises(AdmissionRejected) as excinfo:
+            controller.acquire()
+        assert excinfo.value.reason == 'queue_full'
+        assert excinfo.value.retry_after >= 1
+        controller.release()
+        assert controller.info()['active'] == 0
+
+    def test_queue_timeout(self):
+        """Test that waiting longer than max_queue_time is rejected"""
+        from admission import AdmissionController, AdmissionRejected
+        controller = AdmissionController(max_concurrent=1, max_queue=4, max_queue_time=0.1)
+        controller.acquire()
+        with pytest.raises(AdmissionRejected) as excinfo:
+            controller.acquire()
+        assert excinfo.value.reason == 'queue_timeout'
+        assert controller.info()['queue_depth'] == 0
+
+    def test_interactive_preempts_batch(self):
+        """Test that interactive requests displace queued batch requests"""
+        import threading
+        import time
+        from admission import AdmissionController, AdmissionRejected
+        controller = AdmissionController(max_concurrent=1, max_queue=1, max_queue_time=5.0)
+        controller.acquire()
+        outcome = {}
+
+        def batch_request():
+            try:
+                controller.acquire('batch')
+                outcome['batch'] = 'admitted'
+            except AdmissionRejected as e:
+                outcome['batch'] = e.reason
+
+        batch = threading.Thread(target=batch_request)
+        batch.start()
+        time.sleep(0.1)
+
+        interactive = threading.Thread(target=lambda: controller.acquire('interactive'))
+        interactive.start()
+        batch.join()
+        controller.release()
+        interactive.join()
+
+        assert outcome['batch'] == 'preempted'
+        assert controller.info()['active'] == 1
+
+
+class TestEmbeddingSidecar:
+    """Test micro-batching used by the embedding sidecar"""
+
+    def test_concurrent_items_share_batches(self):
+        """Test that concurrent submissions are grouped into one handler call"""
+        import threading
+        from embedding_sidecar import MicroBatcher
+        batch_sizes = []
+
+        def handler(items):
+            batch_sizes.append(len(items))
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(handler, window_ms=50, max_batch=16)
+        results = {}
+        threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, batcher.submit(i)))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert results == {i: i * 2 for i in range(8)}
+        assert max(batch_sizes) > 1
+        assert batcher.info()['items'] == 8
+
+    def test_handler_errors_reach_callers(self):
+        """Test that a failing batch raises in every waiting caller"""
+        from embedding_sidecar import MicroBatcher
+
+        def handler(items):
+            raise RuntimeError("model failure")
+
+        batcher = MicroBatcher(handler, window_ms=1)
+        with pytest.raises(RuntimeError):
+            batcher.submit('query')
+
+    def test_bad_item_fails_alone(self):
+        """Test that a failing item does not fail the items batched with it"""
+        from embedding_sidecar import MicroBatcher
+
+        def handler(items):
+            if 'bad' in items:
+                raise ValueError("invalid filter")
+            return [item.upper() for item in items]
+
+        batcher = MicroBatcher(handler, window_ms=50)
+        futures = [batcher._enqueue(item) for item in ('a', 'bad', 'b')]
+        assert futures[0].result(timeout=5) == 'A' and futures[2].result(timeout=5) == 'B'
+        with pytest.raises(ValueError):
+            futures[1].result(timeout=5)
+        assert batcher.info()['split_batches'] == 1
+
+        short = MicroBatcher(lambda items: items[:1], window_ms=50)
+        futures = [short._enqueue(item) for item in ('a', 'b')]
+        assert futures[0].result(timeout=5) == 'a'
+        with pytest.raises(RuntimeError):
+            futures[1].result(timeout=5)
+
+    def test_search_failures_stay_in_their_filter_group(self):
+        """Test that one filter's failing search leaves other searches and embeddings intact"""
+        import numpy as np
+        from embedding_sidecar import EmbeddingSidecar
+
+        class Model:
+            def __init__(self):
+                self.encoded = []
+
+            def encode(self, texts):
+                self.encoded.extend(texts)
+                return np.ones((len(texts), 3))
+
+        class Collection:
+            def query(self, query_embeddings, n_results, where=None):
+                if where == {'bad': True}:
+                    raise ValueError("invalid where")
+                rows = len(query_embeddings)
+                return {key: [[key] * n_results] * rows for key in ('ids', 'documents', 'metadatas', 'distances')}
+
+        sidecar = EmbeddingSidecar.__new__(EmbeddingSidecar)
+        sidecar.model, sidecar.collection = Model(), Collection()
+        results = sidecar._process_batch([
+            {'op': 'search', 'text': 'pto', 'n_results': 2, 'where': None},
+            {'op': 'search', 'text': 'oops', 'n_results': 2, 'where': {'bad': True}},
+            {'op': 'search', 'text': 'given', 'embedding': [0.1, 0.2, 0.3], 'n_results': 1, 'where': None},
+            {'op': 'embed', 'text': 'leave'}
+        ])
+        assert results[0]['ids'] == ['ids', 'ids'] and results[2]['ids'] == ['ids']
+        assert isinstance(results[1], ValueError)
+        assert results[3] == [1.0, 1.0, 1.0]
+        assert sidecar.model.encoded == ['pto', 'oops', 'leave']
+
+    def test_precomputed_embeddings_search_the_sidecar(self, client, monkeypatch):
+        """Test that searches with an embedding computed beforehand still go to the sidecar"""
+        import app as app_module
+        rag = app_module.get_rag_pipeline()
+        model = rag._load_embedding_model()
+        calls = []
+
+        class Sidecar:
+            def embed(self, texts):
+                return model.encode(texts).tolist()
+
+            def search(self, query, n_results, where=None, embedding=None):
+                calls.append(embedding)
+                found = rag.collection.query(query_embeddings=[embedding or model.encode([query])[0].tolist()],
+                                             n_results=n_results)
+                return {key: found[key][0] for key in ('ids', 'documents', 'metadatas', 'distances')}
+
+        monkeypatch.setattr(rag, 'sidecar', Sidecar())
+        results = rag.search(['How many PTO days do I get?', 'remote work'], top_k=2)
+        assert len(calls) == 2 and all(embedding is not None for embedding in calls)
+        assert all(len(result['hits']) == 2 for result in results)
+
+
+class TestStartupTime:
+    """Test cold import cost of the serving modules"""
+
+    def test_rag_imports_heavy_dependencies_lazily(self):
+        """Test that importing rag does not pull in model or client libraries"""
+        from import_profile import measure_import
+        profile = measure_import('rag')
+        for heavy in ('torch', 'sentence_transformers', 'chromadb', 'openai'):
+            assert heavy not in profile['modules'], f"rag imports {heavy} at module level"
+
+    def test_app_defers_model_and_llm_imports(self):
+        """Test that booting app imports neither the embedding model stack nor the LLM client"""
+        from import_profile import measure_import
+        profile = measure_import('app')
+        for heavy in ('torch', 'sentence_transformers', 'openai'):
+            assert heavy not in profile['modules'], f"app imports {heavy} at startup"
+
+    def test_app_cold_import_budget(self):
+        """Test that a cold import of app.py (which opens the ChromaDB index) stays within the startup budget"""
+        from import_profile import measure_import, APP_IMPORT_BUDGET_SECONDS
+        profile = measure_import('app')
+        assert profile['wall_seconds'] < APP_IMPORT_BUDGET_SECONDS, (
+            f"Cold import of app took {profile['wall_seconds']:.2f}s "
+            f"(budget {APP_IMPORT_BUDGET_SECONDS:.2f}s)"
+        )
+
+
+class TestIndexBundle:
+    """Test prebuilt mmap index bundles"""
+
+    def _write(self, path):
+        import numpy as np
+        from index_bundle import write_bundle
+        vectors = np.eye(4, dtype=np.float32)
+        return write_bundle(
+            str(path),
+            ids=[f'DOC_chunk_{i}' for i in range(4)],
+            embeddings=vectors,
+            texts=[f'chunk text {i} – ünicode' for i in range(4)],
+            metadatas=[{'doc_id': 'DOC', 'title': 'Doc', 'chunk_index': i} for i in range(4)],
+            embedding_model='all-MiniLM-L6-v2',
+            chunk_size=500,
+            chunk_overlap=50
+        )
+
+    def test_roundtrip_and_exact_search(self, tmp_path):
+        """Test that a bundle reopens via mmap and returns the nearest chunk"""
+        from index_bundle import IndexBundle
+        header = self._write(tmp_path / 'index.bundle')
+        bundle = IndexBundle(str(tmp_path / 'index.bundle'), verify_checksum=True)
+        assert bundle.version == header['version']
+        assert bundle.count() == 4
+        result = bundle.search([0.0, 0.0, 1.0, 0.1], n_results=2)
+        assert result['ids'][0] == 'DOC_chunk_2'
+        assert result['documents'][0] == 'chunk text 2 – ünicode'
+        assert result['distances'] == sorted(result['distances'])
+
+    def test_model_mismatch_rejected(self, tmp_path):
+        """Test that vectors from another embedding model are never served"""
+        from index_bundle import IndexBundle, BundleError
+        self._write(tmp_path / 'index.bundle')
+        bundle = IndexBundle(str(tmp_path / 'index.bundle'))
+        with pytest.raises(BundleError):
+            bundle.check_model('some-other-model')
+
+    def test_corruption_detected(self, tmp_path):
+        """Test that the checksum catches a modified payload"""
+        from index_bundle import IndexBundle, BundleError
+        path = tmp_path / 'index.bundle'
+        self._write(path)
+        data = bytearray(path.read_bytes())
+        data[-70] ^= 0xFF
+        path.write_bytes(bytes(data))
+        with pytest.raises(BundleError):
+            IndexBundle(str(path), verify_checksum=True)
+
+
+class TestMetadataFilters:
+    """Test scoped retrieval filters"""
+
+    def test_where_clause(self):
+        """Test that filters translate into a Chroma where clause"""
+        from filters import normalize_filters, to_chroma_where
+        assert to_chroma_where(normalize_filters({'doc_id': 'POL-003'})) == {'doc_id': {'$eq': 'POL-003'}}
+        where = to_chroma_where(normalize_filters({'doc_id': ['POL-002', 'POL-001'], 'tags': 'Finance'}))
+        assert where == {'$and': [{'doc_id': {'$in': ['POL-001', 'POL-002']}}, {'tag_finance': {'$eq': True}}]}
+        assert normalize_filters({}) is None
+
+    def test_invalid_filters_rejected(self):
+        """Test that unknown fields and non-string values are rejected"""
+        from filters import normalize_filters
+        with pytest.raises(ValueError):
+            normalize_filters({'author': 'someone'})
+        with pytest.raises(ValueError):
+            normalize_filters({'doc_id': [1, 2]})
+
+    def test_bundle_filtered_search(self, tmp_path):
+        """Test that bundle search only scores chunks matching the filter"""
+        import numpy as np
+        from index_bundle import write_bundle, IndexBundle, BundleCollection
+        from filters import normalize_filters, to_chroma_where
+        write_bundle(
+            str(tmp_path / 'index.bundle'),
+            ids=[f'chunk_{i}' for i in range(4)],
+            embeddings=np.eye(4, dtype=np.float32),
+            texts=[f'chunk text {i}' for i in range(4)],
+            metadatas=[{'doc_id': f'POL-00{i // 2}', 'title': 'Doc', 'format': 'markdown',
+                        **({'tag_finance': True} if i == 3 else {})} for i in range(4)],
+            embedding_model='all-MiniLM-L6-v2',
+            chunk_size=500,
+            chunk_overlap=50
+        )
+        collection = BundleCollection(IndexBundle(str(tmp_path / 'index.bundle')))
+
+        where = to_chroma_where(normalize_filters({'doc_id': 'POL-001'}))
+        result = collection.query([[1.0, 0.0, 0.0, 0.0]], n_results=5, where=where)
+        assert result['ids'][0] == ['chunk_2', 'chunk_3']
+
+        where = to_chroma_where(normalize_filters({'doc_id': 'POL-001', 'tags': ['finance']}))
+        assert collection.query([[1.0, 0.0, 0.0, 0.0]], n_results=5, where=where)['ids'][0] == ['chunk_3']
+
+        where = to_chroma_where(normalize_filters({'doc_id': 'POL-999'}))
+        assert collection.query([[1.0, 0.0, 0.0, 0.0]], n_results=5, where=where)['ids'][0] == []
+
+    def test_chat_rejects_bad_filters(self, client, monkeypatch):
+        """Test that /chat answers 400 for malformed filters"""
+        monkeypatch.setattr('app.preload_complete', True)
+        response = client.post('/chat', json={'question': 'How many PTO days?', 'filters': {'author': 'x'}})
+        assert response.status_code == 400
+        assert 'author' in json.loads(response.data)['error']
+
+
+class TestTenants:
+    """Test tenant-scoped collections and the LRU of open tenant indexes"""
+
+    def test_collection_names(self):
+        """Test that tenant ids map to valid collection names"""
+        from tenants import collection_name, validate_tenant
+        assert collection_name(None) == 'company_policies'
+        assert collection_name('Acme') == 'company_policies__acme'
+        assert 3 <= len(collection_name('x' * 40)) <= 63
+        with pytest.raises(ValueError):
+            validate_tenant('../etc')
+
+    def test_lru_eviction_by_count_and_memory(self):
+        """Test that idle tenants are evicted and closed when limits are exceeded"""
+        from tenants import TenantIndex, TenantIndexCache
+        closed = []
+
+        def loader(tenant):
+            return TenantIndex(tenant, collection=tenant, memory_bytes=100, source='chroma',
+                               close=lambda: closed.append(tenant))
+
+        cache = TenantIndexCache(loader, max_tenants=2, max_bytes=250)
+        for tenant in ('a', 'b', 'a', 'c'):
+            with cache.use(tenant):
+                pass
+        assert closed == ['b']
+        assert list(cache.info()['tenants']) == ['a', 'c']
+
+        cache.max_bytes = 150
+        with cache.use('d'):
+            pass
+        assert closed == ['b', 'a', 'c']
+        info = cache.info()
+        assert info['open_tenants'] == 1 and info['evictions'] == 3
+        assert info['hits'] == 1 and info['misses'] == 4
+
+    def test_concurrent_cold_load_happens_once(self):
+        """Test that concurrent requests for a cold tenant share one load"""
+        import threading
+        import time as _time
+        from tenants import TenantIndex, TenantIndexCache
+        loads = []
+
+        def loader(tenant):
+            loads.append(tenant)
+            _time.sleep(0.1)
+            return TenantIndex(tenant, collection=tenant, memory_bytes=1, source='chroma')
+
+        cache = TenantIndexCache(loader)
+        threads = [threading.Thread(target=cache.get, args=('acme',)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert loads == ['acme']
+        assert cache.info()['tenants']['acme']['hits'] == 5
+
+    def test_eviction_waits_for_searches_in_flight(self, tmp_path):
+        """Test that an index evicted while being searched is closed only after the search"""
+        import threading
+        import numpy as np
+        from index_bundle import IndexBundle, BundleCollection, write_bundle
+        from tenants import TenantIndex, TenantIndexCache
+
+        vectors = np.random.default_rng(0).normal(size=(200, 16)).astype(np.float32)
+        path = str(tmp_path / 'acme.bundle')
+        write_bundle(path, [f'chunk_{i}' for i in range(200)], vectors, [''] * 200,
+                     [{'doc_id': f'DOC-{i % 4}'} for i in range(200)], 'all-MiniLM-L6-v2', 500, 50)
+
+        def loader(tenant):
+            bundle = IndexBundle(path)
+            return TenantIndex(tenant, BundleCollection(bundle), memory_bytes=1, source='bundle',
+                               close=bundle.close)
+
+        cache = TenantIndexCache(loader)
+        searching, evicted, errors = threading.Event(), threading.Event(), []
+
+        def search():
+            try:
+                with cache.use('acme') as index:
+                    searching.set()
+                    evicted.wait(5)
+                    for _ in range(20):
+                        index.collection.query(query_embeddings=[vectors[0].tolist()], n_results=3)
+            except Exception as e:
+                errors.append(e)
+
+        searcher = threading.Thread(target=search)
+        searcher.start()
+        searching.wait(5)
+        index = cache.get('acme')
+        cache.release(index)
+        assert cache.evict_all() == 1
+        # Pinned by the searcher: parked instead of closed
+        assert index.collection.bundle.vectors is not None
+        assert cache.info()['draining_tenants'] == 1
+        evicted.set()
+        searcher.join()
+        assert errors == []
+        assert index.collection.bundle.vectors is None
+        info = cache.info()
+        assert info['draining_tenants'] == 0 and info['deferred_closes'] == 1
+
+    def test_chat_rejects_invalid_tenant(self, client, monkeypatch):
+        """Test that /chat answers 400 for malformed tenant ids"""
+        monkeypatch.setattr('app.preload_complete', True)
+        response = client.post('/chat', json={'question': 'How many PTO days?'},
+                               headers={'X-Tenant': 'not a tenant!'})
+        assert response.status_code == 400
+
+
+class TestQuantizedVectors:
+    """Test compact float16/int8 bundles with full-precision rescoring"""
+
+    def _write(self, path, vector_dtype):
+        import numpy as np
+        from index_bundle import write_bundle
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(500, 32)).astype(np.float32)
+        write_bundle(str(path), [f'chunk_{i}' for i in range(500)], vectors, [''] * 500,
+                     [{'doc_id': f'DOC-{i % 5}'} for i in range(500)], 'all-MiniLM-L6-v2', 500, 50,
+                     vector_dtype=vector_dtype)
+        return vectors
+
+    @pytest.mark.parametrize('vector_dtype,itemsize', [('float16', 2), ('int8', 1)])
+    def test_compact_search_matches_exact(self, tmp_path, vector_dtype, itemsize):
+        """Test that rescored compact search returns the exact top-k with exact distances"""
+        import numpy as np
+        from index_bundle import IndexBundle
+        vectors = self._write(tmp_path / 'exact.bundle', 'float32')
+        self._write(tmp_path / 'compact.bundle', vector_dtype)
+        exact = IndexBundle(str(tmp_path / 'exact.bundle'))
+        compact = IndexBundle(str(tmp_path / 'compact.bundle'), verify_checksum=True)
+        assert compact.compact.dtype.itemsize == itemsize
+
+        rng = np.random.default_rng(1)
+        for query in vectors[:20] + rng.normal(scale=0.3, size=(20, 32)).astype(np.float32):
+            expected = exact.search(query, 5)
+            found = compact.search(query, 5)
+            assert found['ids'] == expected['ids']
+            assert np.allclose(found['distances'], expected['distances'], rtol=1e-4)
+
+        found = compact.search(vectors[7], 3, candidates=exact.match({'doc_id': 'DOC-2'}))
+        assert found['ids'][0] == 'chunk_7'
+        assert all(int(i.split('_')[1]) % 5 == 2 for i in found['ids'])
+
+    def test_benchmark_reports_recall_and_memory(self, tmp_path):
+        """Test that the benchmark compares all dtypes against exact search"""
+        from index_bundle import benchmark
+        self._write(tmp_path / 'index.bundle', 'float32')
+        report = benchmark(str(tmp_path / 'index.bundle'), queries=20)
+        results = report['results']
+        assert results['float32']['recall_at_k'] == 1.0
+        assert results['int8']['vector_mb'] * 4 == pytest.approx(results['float32']['vector_mb'])
+        assert results['int8']['recall_at_k'] >= 0.9
+
+    @pytest.mark.parametrize('space,vector_dtype', [('cosine', 'float32'), ('ip', 'float32'), ('ip', 'int8')])
+    def test_bundle_distances_match_chroma_space(self, tmp_path, space, vector_dtype):
+        """Test that a bundle built from a cosine/ip collection scores on ChromaDB's scale"""
+        import chromadb
+        import numpy as np
+        from index_bundle import IndexBundle, BundleCollection, write_bundle
+        vectors = np.random.default_rng(0).normal(size=(50, 16)).astype(np.float32)
+        ids = [f'chunk_{i}' for i in range(50)]
+        collection = chromadb.PersistentClient(path=str(tmp_path / 'db')).create_collection(
+            'spaces', metadata={'hnsw:space': space})
+        collection.add(ids=ids, embeddings=vectors.tolist())
+        write_bundle(str(tmp_path / 'index.bundle'), ids, vectors, [''] * 50, [{} for _ in ids],
+                     'all-MiniLM-L6-v2', 500, 50, vector_dtype=vector_dtype, space=space)
+        bundle = BundleCollection(IndexBundle(str(tmp_path / 'index.bundle')))
+        assert bundle.metadata['hnsw:space'] == space
+
+        query = vectors[3] + 0.1
+        expected = collection.query(query_embeddings=[query.tolist()], n_results=5)
+        found = bundle.query(query_embeddings=[query.tolist()], n_results=5)
+        assert found['ids'] == expected['ids']
+        assert np.allclose(found['distances'], expected['distances'], atol=1e-4)
+        if space == 'ip':
+            assert found['distances'][0][0] < 0
+
+
+class TestAnnTuning:
+    """Test configurable HNSW parameters and the tuning grid"""
+
+    def test_params_from_settings_file_and_env(self, tmp_path, monkeypatch):
+        """Test that tuned settings are loaded and env vars override them"""
+        from ann_index import AnnParams
+        path = tmp_path / 'hnsw_settings.json'
+        path.write_text(json.dumps({'recommended': {'space': 'cosine', 'M': 32, 'construction_ef': 200,
+                                                    'search_ef': 50}}))
+        monkeypatch.setenv('HNSW_SEARCH_EF', '80')
+        params = AnnParams.load(str(path))
+        assert params.to_dict() == {'space': 'cosine', 'M': 32, 'construction_ef': 200, 'search_ef': 80}
+        assert params.collection_metadata()['hnsw:M'] == 32
+        with pytest.raises(ValueError):
+            AnnParams(space='manhattan')
+
+    def test_tune_recommends_setting_meeting_target(self):
+        """Test that the grid measures recall against brute force and picks a passing setting"""
+        import numpy as np
+        from ann_index import tune, exact_neighbours
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(300, 16)).astype(np.float32)
+        queries = vectors[:30] + rng.normal(scale=0.1, size=(30, 16)).astype(np.float32)
+        assert exact_neighbours(vectors, queries, 1)[:, 0].tolist() == list(range(30))
+
+        report = tune(vectors, queries, k=5, M_values=[4, 16], construction_efs=[32],
+                      search_efs=[5, 100], target_recall=0.95)
+        assert len(report['grid']) == 4
+        assert report['recommended_stats']['recall_at_k'] >= 0.95
+        assert set(report['recommended']) == {'space', 'M', 'construction_ef', 'search_ef'}
+
+    def test_search_ef_raises_requested_candidates(self):
+        """Test that a query-time search_ef above the built one oversamples results"""
+        from rag import RAGPipeline
+
+        class Collection:
+            metadata = {'hnsw:search_ef': 10}
+
+            def count(self):
+                return 1000
+
+        assert RAGPipeline._search_candidates(Collection(), 5, None) == 5
+        assert RAGPipeline._search_candidates(Collection(), 5, 10) == 5
+        assert RAGPipeline._search_candidates(Collection(), 5, 64) == 64
+        Collection.metadata = {'exact_search': True}
+        assert RAGPipeline._search_candidates(Collection(), 5, 64) == 5
+
+
+class TestSessions:
+    """Test multi-turn sessions with retrieval reuse"""
+
+    def _chunk(self, chunk_id):
+        return {'chunk_id': chunk_id, 'text': f'text of {chunk_id}', 'metadata': {}}
+
+    def test_follow_up_keeps_context_and_bounds(self):
+        """Test follow-up detection, stable chunk order and history/chunk limits"""
+        from sessions import Session
+        session = Session('s1', max_turns=2, max_chunks=3, reuse_similarity=0.8)
+        scope = ('default', 'None')
+        assert not session.is_follow_up([1.0, 0.0], scope)
+
+        session.reset_context([self._chunk('a'), self._chunk('b')], [1.0, 0.0], scope)
+        assert session.is_follow_up([0.9, 0.1], scope)
+        assert not session.is_follow_up([0.0, 1.0], scope)
+        assert not session.is_follow_up([1.0, 0.0], ('acme', 'None'))
+
+        assert session.extend_context([self._chunk('b'), self._chunk('c')], [0.9, 0.1]) == 1
+        assert [c['chunk_id'] for c in session.chunks] == ['a', 'b', 'c']
+        session.extend_context([self._chunk('d')], [0.9, 0.1])
+        assert [c['chunk_id'] for c in session.chunks] == ['b', 'c', 'd']
+
+        for i in range(3):
+            session.add_turn(f'q{i}', f'a{i}')
+        assert [turn['question'] for turn in session.history()] == ['q1', 'q2']
+
+    def test_store_ttl_and_eviction(self):
+        """Test that idle sessions expire and the oldest are evicted over the limit"""
+        import time as _time
+        from sessions import SessionStore
+        store = SessionStore(ttl_seconds=0.05, max_sessions=2)
+        first = store.create()
+        _time.sleep(0.1)
+        assert store.get(first.session_id) is None
+        assert store.info()['expired'] == 1
+
+        store.ttl_seconds = 60
+        a, b, c = store.create(), store.create(), store.create()
+        assert store.get(a.session_id) is None
+        assert store.get(c.session_id) is c
+        assert store.info()['evicted'] == 1
+
+    def test_follow_up_reuses_retrieval(self, rag_pipeline, monkeypatch):
+        """Test that a follow-up reuses the session's chunks and adds history to the prompt"""
+        from sessions import Session
+        prompts = []
+        monkeypatch.setattr(rag_pipeline, 'generate', lambda prompt, **kwargs: prompts.append(prompt) or 'answer')
+        session = Session('s1', reuse_similarity=0.3, incremental_k=2)
+
+        first = rag_pipeline.query('How many PTO days do employees get per year?', session=session)
+        assert first['session']['retrieval'] == 'full'
+        initial_ids = [c['chunk_id'] for c in session.chunks]
+
+        second = rag_pipeline.query('How many PTO days do part-time employees get per year?', session=session)
+        assert second['session']['retrieval'] == 'reused'
+        assert second['session']['turn'] == 2
+        assert [c['chunk_id'] for c in session.chunks][:len(initial_ids)] == initial_ids
+        assert 'CONVERSATION SO FAR' in prompts[1]
+        assert 'CONVERSATION SO FAR' not in prompts[0]
+
+    def test_session_endpoints(self, client, monkeypatch):
+        """Test creating, using and deleting a session over HTTP"""
+        import app as app_module
+        monkeypatch.setattr('app.preload_complete', True)
+        monkeypatch.setattr(app_module.get_rag_pipeline(), 'generate', lambda prompt, **kwargs: 'answer')
+
+        session_id = json.loads(client.post('/sessions').data)['session_id']
+        response = client.post('/chat', json={'question': 'How many PTO days do I get?', 'session_id': session_id})
+        assert response.status_code == 200
+        assert json.loads(response.data)['session']['session_id'] == session_id
+        assert len(json.loads(client.get(f'/sessions/{session_id}').data)['turns']) == 1
+
+        assert client.delete(f'/sessions/{session_id}').status_code == 204
+        response = client.post('/chat', json={'question': 'And sick days?', 'session_id': session_id})
+        assert response.status_code == 404
+
+
+class TestFAQPrewarm:
+    """Test pre-warmed answers for frequent questions"""
+
+    def test_cache_matching_and_version(self):
+        """Test exact/semantic matching and that entries from an old index version are dropped"""
+        from prewarm import FAQCache
+        cache = FAQCache(match_similarity=0.9)
+        cache.reset('v1')
+        cache.store('How many PTO days do I get?', [1.0, 0.0], {'answer': 'a'}, 'v1')
+        cache.store('Stale question', [0.0, 1.0], {'answer': 'b'}, 'v0')
+        assert cache.lookup('how many pto days do i get') == {'answer': 'a'}
+        assert cache.lookup('PTO allowance?', [0.99, 0.05]) == {'answer': 'a'}
+        assert cache.lookup('Stale question') is None
+        cache.reset('v2')
+        assert cache.lookup('How many PTO days do I get?') is None
+        assert cache.info()['hits'] == 1 and cache.info()['semantic_hits'] == 1
+
+    def test_questions_from_faq_file_and_log(self, tmp_path):
+        """Test that the FAQ list is topped up with the most frequent logged questions"""
+        from prewarm import QuestionLog, load_faq_questions
+        faq = tmp_path / 'faq.json'
+        faq.write_text(json.dumps([{'question': 'What holidays are observed?'}]))
+        log = QuestionLog(str(tmp_path / 'questions.log'))
+        for question in ['Can I work remotely?'] * 3 + ['what holidays are observed'] * 2 + ['Meal limit?']:
+            log.record(question)
+        questions = load_faq_questions(str(faq), log.path, top_n=2)
+        assert questions == ['What holidays are observed?', 'Can I work remotely?']
+
+    def test_prewarm_serves_and_refreshes(self, rag_pipeline, monkeypatch):
+        """Test that warmed questions skip retrieval+LLM and re-warm on index change"""
+        from prewarm import FAQCache, FAQPrewarmer
+        calls = []
+        monkeypatch.setattr(rag_pipeline, 'generate', lambda prompt, **kwargs: calls.append(prompt) or 'answer')
+        monkeypatch.setattr(rag_pipeline, 'faq_cache', FAQCache())
+        version = ['v1']
+        monkeypatch.setattr(rag_pipeline, 'index_version', lambda: version[0])
+
+        prewarmer = FAQPrewarmer(rag_pipeline, ['How many PTO days do I get?'])
+        assert prewarmer.warm()['warmed'] == 1
+        # Warm-up queries bypass the lookup instead of counting as misses
+        assert rag_pipeline.faq_cache.stats['misses'] == 0
+        result = rag_pipeline.query('how many PTO days do I get')
+        assert result['faq_cache'] is True and len(calls) == 1
+        assert rag_pipeline.query('How many PTO days do I get?', use_rerank=True).get('faq_cache') is None
+
+        assert prewarmer.refresh_if_stale() is False
+        version[0] = 'v2'
+        assert prewarmer.refresh_if_stale() is True
+        assert rag_pipeline.faq_cache.info()['index_version'] == 'v2'
+
+    def test_startup_warm_failure_is_retried(self, rag_pipeline, monkeypatch):
+        """Test that a failing first warm-up leaves the background thread alive to retry"""
+        import time
+        from prewarm import FAQCache, FAQPrewarmer
+        monkeypatch.setattr(rag_pipeline, 'generate', lambda prompt, **kwargs: 'answer')
+        monkeypatch.setattr(rag_pipeline, 'faq_cache', FAQCache())
+        attempts = []
+
+        def index_version():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("index not ready")
+            return 'v1'
+
+        monkeypatch.setattr(rag_pipeline, 'index_version', index_version)
+        prewarmer = FAQPrewarmer(rag_pipeline, ['How many PTO days do I get?'], refresh_interval=0.05)
+        prewarmer.start()
+        try:
+            deadline = time.monotonic() + 10
+            while prewarmer.last_run is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert prewarmer.last_run is not None and prewarmer.last_run['warmed'] == 1
+            assert prewarmer._thread.is_alive()
+        finally:
+            prewarmer.stop()
+
+
+class TestResponsePayloads:
+    """Test /chat field selection, source detail and compression"""
+
+    def test_shape_response(self):
+        """Test that snippet/ids detail and field selection leave the shared result untouched"""
+        from payload import shape_response
+        result = {'answer': 'a', 'question': 'q', 'num_sources': 1,
+                  'sources': [{'source_num': 1, 'chunk_id': 'POL-001_chunk_0', 'doc_id': 'POL-001',
+                               'title': 'PTO', 'text_snippet': 'short', 'full_text': 'long text'}]}
+        snippet = shape_response(result, include='snippet')
+        assert 'full_text' not in snippet['sources'][0] and snippet['sources'][0]['text_snippet'] == 'short'
+        ids = shape_response(result, fields=['answer', 'sources'], include='ids')
+        assert ids == {'answer': 'a', 'sources': [{'source_num': 1, 'doc_id': 'POL-001', 'chunk_id': 'POL-001_chunk_0'}]}
+        assert result['sources'][0]['full_text'] == 'long text'
+
+    def test_choose_encoding(self):
+        """Test Accept-Encoding negotiation"""
+        from payload import choose_encoding
+        assert choose_encoding('gzip, deflate') == 'gzip'
+        assert choose_encoding('gzip;q=0') is None
+        assert choose_encoding('') is None
+
+    def test_chat_payload_options(self, client, monkeypatch):
+        """Test that include/fields shrink the response and gzip is applied when accepted"""
+        import gzip
+        import app as app_module
+        monkeypatch.setattr('app.preload_complete', True)
+        monkeypatch.setattr('app.coalesce_enabled', False)
+        monkeypatch.setattr(app_module.get_rag_pipeline(), 'generate', lambda prompt, **kwargs: 'answer')
+
+        question = {'question': 'How many PTO days do I get?'}
+        full = client.post('/chat', json=question)
+        slim = client.post('/chat', json={**question, 'include': 'snippet', 'fields': ['answer', 'sources']},
+                           headers={'Accept-Encoding': 'gzip'})
+        assert full.headers.get('Content-Encoding') is None
+        assert slim.headers['Content-Encoding'] == 'gzip'
+
+        body = json.loads(gzip.decompress(slim.data))
+        assert set(body) == {'answer', 'sources'}
+        assert body['sources'] and all('full_text' not in source for source in body['sources'])
+        assert len(slim.data) < len(full.data)
+        assert client.post('/chat', json={**question, 'include': 'everything'}).status_code == 400
+        assert json.loads(client.get('/metrics').data)['payloads']['responses'] > 0
+
+
+def _write_pdf(path, pages):
+    """Write a PDF with one line of text per page"""
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+    writer = PdfWriter()
+    font = DictionaryObject({NameObject('/Type'): NameObject('/Font'), NameObject('/Subtype'): NameObject('/Type1'),
+                             NameObject('/BaseFont'): NameObject('/Helvetica')})
+    for text in pages:
+        page = writer.add_blank_page(width=612, height=792)
+        stream = DecodedStreamObject()
+        stream.set_data(f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode())
+        page[NameObject('/Contents')] = writer._add_object(stream)
+        page[NameObject('/Resources')] = DictionaryObject({NameObject('/Font'): DictionaryObject({NameObject('/F1'): font})})
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+class TestPagedIngestion:
+    """Test streaming, page-parallel PDF and HTML ingestion"""
+
+    def test_pdf_pages_stream_in_order(self, tmp_path):
+        """Test that parallel extraction yields every page in order"""
+        from pdf_pages import create_executor, iter_pdf_pages
+        path = str(tmp_path / 'handbook.pdf')
+        _write_pdf(path, [f"page {i} text" for i in range(1, 21)])
+
+        serial = list(iter_pdf_pages(path))
+        executor = create_executor(2)
+        try:
+            parallel = list(iter_pdf_pages(path, executor, prefetch=4))
+        finally:
+            executor.shutdown()
+        assert serial == parallel
+        assert [number for number, _ in parallel] == list(range(1, 21))
+        assert parallel[4][1] == "page 5 text"
+
+    def test_spawned_workers_do_not_load_the_embedding_stack(self):
+        """Test that importing ingest (what spawned workers re-run as __mp_main__) stays light"""
+        from import_profile import measure_import
+        from pdf_pages import DEFAULT_WORKERS
+        modules = measure_import('ingest')['modules']
+        for heavy in ('chromadb', 'sentence_transformers', 'torch', 'markdown', 'bs4'):
+            assert heavy not in modules, f"ingest imports {heavy} at module level"
+        assert 1 <= DEFAULT_WORKERS <= 4
+
+    def test_ingest_pdf_and_html(self, tmp_path):
+        """Test that PDF chunks carry page ranges and HTML is ingested"""
+        from ingest import DocumentIngestion
+        docs = tmp_path / 'docs'
+        docs.mkdir()
+        _write_pdf(str(docs / 'employee_handbook.pdf'),
+                   [" ".join(f"p{page}w{i}" for i in range(30)) for page in range(1, 21)])
+        (docs / 'travel_policy.html').write_text(
+            "<html><head><title>Travel Policy</title><style>p {}</style></head>"
+            "<body><p>Book flights through the travel portal.</p><p>Economy class only.</p></body></html>")
+
+        ingestion = DocumentIngestion(docs_path=str(docs), db_path=str(tmp_path / 'db'),
+                                      chunk_size=100, chunk_overlap=10, workers=2)
+        stats = ingestion.ingest_documents()
+        documents = {d['file']: d for d in stats['documents']}
+        assert documents['employee_handbook.pdf']['pages'] == 20
+        assert documents['travel_policy.html']['chunks'] == 1
+        assert stats['index_version']
+
+        stored = ingestion.collection.get(where={'doc_id': 'EMPLOYEE_HANDBOOK'})
+        first = min(stored['metadatas'], key=lambda m: m['chunk_index'])
+        assert (first['page_start'], first['page_end']) == (1, 4)
+        assert max(m['page_end'] for m in stored['metadatas']) == 20
+        html = ingestion.collection.get(where={'doc_id': 'TRAVEL_POLICY'})
+        assert html['metadatas'][0]['title'] == 'Travel Policy'
+        assert 'page_start' not in html['metadatas'][0]
+        assert 'Economy class only.' in html['documents'][0] and 'p {}' not in html['documents'][0]
+
+    def test_streamed_chunks_match_chunk_text(self, tmp_path):
+        """Test that chunking page by page gives the same chunks as chunking the joined text"""
+        from ingest import DocumentIngestion
+        ingestion = DocumentIngestion(docs_path=str(tmp_path), db_path=str(tmp_path / 'db'),
+                                      chunk_size=50, chunk_overlap=5)
+        metadata = {'doc_id': 'DOC', 'title': 'Doc', 'file_path': 'doc.pdf'}
+        pages = [(page, " ".join(f"w{page}_{i}" for i in range(37))) for page in range(1, 6)]
+        streamed = list(ingestion.chunk_sections(pages, metadata))
+        joined = ingestion.chunk_text(" ".join(text for _, text in pages), metadata)
+        assert [c['chunk_id'] for c in streamed] == [c['chunk_id'] for c in joined]
+        assert (streamed[1]['page_start'], streamed[1]['page_end']) == (2, 3)
+
+
+class TestDocumentWatcher:
+    """Test incremental hot re-indexing of edited documents"""
+
+    @staticmethod
+    def _ingestion(tmp_path):
+        from ingest import DocumentIngestion
+        docs = tmp_path / 'docs'
+        docs.mkdir(exist_ok=True)
+        (docs / 'travel.md').write_text("# Travel Policy\n\n" + " ".join(f"travel{i}" for i in range(100)))
+        (docs / 'meals.md').write_text("# Meals Policy\n\n" + " ".join(f"meal{i}" for i in range(60)))
+        ingestion = DocumentIngestion(docs_path=str(docs), db_path=str(tmp_path / 'db'),
+                                      chunk_size=20, chunk_overlap=2)
+        ingestion.ingest_documents()
+        return ingestion, docs
+
+    def test_sync_reembeds_only_changed_chunks(self, tmp_path):
+        """Test that an edit re-embeds only new chunks and deletions remove a document"""
+        ingestion, docs = self._ingestion(tmp_path)
+        embedded = []
+        original = ingestion.embed_chunks
+        ingestion.embed_chunks = lambda chunks: embedded.extend(chunks) or original(chunks)
+
+        before = ingestion.collection.count()
+        travel = docs / 'travel.md'
+        travel.write_text(travel.read_text() + " extra words about mileage")
+        counts = ingestion.sync_files([travel], [])
+        assert 0 < counts['embedded'] <= 2 and counts['unchanged'] >= 4
+        assert len(embedded) == counts['embedded']
+        assert ingestion.collection.count() == before + counts['embedded'] - counts['deleted']
+        assert 'mileage' in " ".join(ingestion.collection.get(where={'doc_id': 'TRAVEL'})['documents'])
+
+        (docs / 'meals.md').unlink()
+        counts = ingestion.sync_files([], [docs / 'meals.md'])
+        assert counts['deleted'] > 0
+        assert ingestion.collection.get(where={'doc_id': 'MEALS'})['ids'] == []
+
+    def test_watcher_debounces_and_bumps_version(self, tmp_path):
+        """Test that edits are applied after the quiet period and the index version changes"""
+        from doc_watcher import DocumentWatcher
+        ingestion, docs = self._ingestion(tmp_path)
+        old_version = ingestion.stamp_index_version()
+        versions = []
+        watcher = DocumentWatcher(str(docs), lambda: ingestion, debounce=60, on_change=versions.append)
+
+        (docs / 'meals.md').write_text("# Meals Policy\n\nDinner is reimbursed up to 60 dollars.")
+        assert watcher.poll() is False
+        assert watcher.pending() == {'changed': ['meals.md'], 'removed': []}
+
+        watcher.debounce = 0
+        assert watcher.poll() is True
+        assert versions and versions[0] != old_version
+        assert watcher.pending() == {'changed': [], 'removed': []}
+        assert 'Dinner' in ingestion.collection.get(where={'doc_id': 'MEALS'})['documents'][0]
+        assert watcher.info()['last_sync']['changed'] == ['meals.md']
+
+    def test_retarget_during_sync_is_not_lost(self, tmp_path):
+        """Test that an index swap arriving mid-sync still re-syncs every document afterwards"""
+        from doc_watcher import DocumentWatcher
+        ingestion, docs = self._ingestion(tmp_path)
+        built = []
+
+        def factory():
+            built.append(ingestion)
+            return ingestion
+
+        watcher = DocumentWatcher(str(docs), factory, debounce=0)
+        original = ingestion.sync_files
+
+        def sync_files(changed, removed):
+            # The swap lands while the old collection is still being written
+            watcher.retarget()
+            return original(changed, removed)
+
+        ingestion.sync_files = sync_files
+        (docs / 'meals.md').write_text("# Meals Policy\n\nDinner is reimbursed up to 60 dollars.")
+        assert watcher.poll() is True
+        assert watcher.info()['retarget_pending'] is True
+
+        ingestion.sync_files = original
+        assert watcher.poll() is True
+        assert len(built) == 2
+        assert watcher.info()['last_sync']['changed'] == ['meals.md', 'travel.md']
+        assert watcher.pending() == {'changed': [], 'removed': []}
+
+
+class TestBlueGreen:
+    """Test blue/green index rebuilds, swaps and rollbacks"""
+
+    @staticmethod
+    def _ingest(tmp_path, **kwargs):
+        from ingest import DocumentIngestion
+        docs = tmp_path / 'docs'
+        docs.mkdir(exist_ok=True)
+        (docs / 'travel.md').write_text("# Travel Policy\n\nMileage is reimbursed at the federal rate. "
+                                        + " ".join(f"travel{i}" for i in range(80)))
+        (docs / 'meals.md').write_text("# Meals Policy\n\nDinner is reimbursed up to 60 dollars. "
+                                       + " ".join(f"meal{i}" for i in range(60)))
+        ingestion = DocumentIngestion(docs_path=str(docs), db_path=str(tmp_path / 'db'), **kwargs)
+        ingestion.ingest_documents()
+        return ingestion
+
+    def test_pointer_activate_and_rollback(self, tmp_path):
+        """Test that swaps are visible to other readers and can be rolled back"""
+        from blue_green import IndexPointer, build_collection_name, is_build_of
+        pointer = IndexPointer(str(tmp_path))
+        assert pointer.active() == 'company_policies'
+        with pytest.raises(ValueError):
+            pointer.rollback()
+
+        name = build_collection_name()
+        assert is_build_of(name) and not is_build_of(name, 'acme') and len(name) <= 63
+        pointer.activate(name)
+        reader = IndexPointer(str(tmp_path))
+        assert reader.active() == name and reader.previous() == 'company_policies'
+        assert reader.active('acme') == 'company_policies__acme'
+
+        assert pointer.rollback() == 'company_policies'
+        assert reader.active() == 'company_policies' and reader.previous() == name
+        assert [p.name for p in tmp_path.iterdir()] == ['index_pointer.json']
+
+    def test_rebuild_validate_and_swap(self, tmp_path):
+        """Test that a shadow rebuild validates and a running pipeline switches to it and back"""
+        from blue_green import IndexPointer, build_collection_name, validate
+        from rag import QueryEmbedding
+        live = self._ingest(tmp_path, chunk_size=20, chunk_overlap=2)
+        rag = RAGPipeline(db_path=str(tmp_path / 'db'))
+        original = rag.collection.name
+
+        shadow = build_collection_name()
+        build = self._ingest(tmp_path, chunk_size=40, chunk_overlap=5, collection=shadow,
+                             model=live.embedding_model, client=rag._chroma_client())
+        assert build.collection.metadata['chunk_size'] == 40
+        questions = [{'question': "How is mileage reimbursed?", 'expected_contains': ["federal rate"]},
+                     {'question': "What is the dinner limit?", 'expected_contains': ["60 dollars"]}]
+        report = validate(rag._chroma_client(), shadow, original, questions, k=4)
+        assert report['passed'], report['reasons']
+        assert report['candidate']['chunks'] < report['baseline']['chunks']
+
+        assert rag.reload_index() is False
+        IndexPointer(str(tmp_path / 'db')).activate(shadow)
+        assert rag.reload_index() is True
+        assert rag.collection.name == shadow and rag.standby_collection.name == original
+        # A query vector from a swapped-out model is re-embedded, not searched as is
+        stale = QueryEmbedding([1.0, 0.0], 'retired-model')
+        assert rag.retrieve("What is the dinner limit?", top_k=1, query_embedding=stale)
+
+        IndexPointer(str(tmp_path / 'db')).rollback()
+        assert rag.reload_index() is True
+        assert rag.collection.name == original and rag.standby_collection.name == shadow
+
+    def test_embedding_model_mismatch_rejected(self, tmp_path):
+        """Test that incremental ingestion never mixes embedding models in one collection"""
+        from ingest import DocumentIngestion
+        live = self._ingest(tmp_path)
+        assert live.collection.metadata['embedding_model'] == 'all-MiniLM-L6-v2'
+        with pytest.raises(ValueError, match="blue_green.py rebuild"):
+            DocumentIngestion(docs_path=str(tmp_path / 'docs'), db_path=str(tmp_path / 'db'),
+                              embedding_model='all-mpnet-base-v2', model=live.embedding_model,
+                              client=live.client)
+
+
+class TestNearDuplicates:
+    """Test MinHash/LSH near-duplicate chunk detection at ingestion"""
+
+    CONTACT = ("Questions about this policy go to the People Operations team at people at example dot com "
+               "or extension 4400. Approved by the Chief People Officer and reviewed every year by the "
+               "policy committee before the start of the fiscal year.")
+
+    @classmethod
+    def _ingest(cls, tmp_path, mode):
+        from ingest import DocumentIngestion
+        docs = tmp_path / 'docs'
+        docs.mkdir(exist_ok=True)
+        for name, topic in (('travel', 'mileage'), ('meals', 'dinner'), ('housing', 'lodging')):
+            # Title plus body fill the first chunk, the 40-word contact block the second
+            body = " ".join(f"{topic}{i}" for i in range(38))
+            # The same contact block, with one word changed per document
+            contact = cls.CONTACT.replace("fiscal year", f"fiscal {name}")
+            (docs / f'{name}.md').write_text(f"# {name.title()} Policy\n\n{body} {contact}")
+        ingestion = DocumentIngestion(docs_path=str(docs), db_path=str(tmp_path / mode),
+                                      chunk_size=40, chunk_overlap=0, dedup=mode)
+        return ingestion, ingestion.ingest_documents()
+
+    def test_minhash_estimates_jaccard(self):
+        """Test that signatures estimate similarity and LSH parameters fit the threshold"""
+        from dedup import MinHasher, lsh_params
+        hasher = MinHasher(num_perm=256)
+        text = " ".join(f"word{i}" for i in range(100))
+        edited = text.replace("word50", "changed")
+        assert hasher.similarity(hasher.signature(text), hasher.signature(text)) == 1.0
+        assert 0.8 < hasher.similarity(hasher.signature(text), hasher.signature(edited)) < 1.0
+        assert hasher.similarity(hasher.signature(text), hasher.signature("unrelated words only here")) < 0.1
+        bands, rows = lsh_params(128, 0.8)
+        assert bands * rows == 128 and (1 / bands) ** (1 / rows) <= 0.8
+
+    def test_tag_marks_copies_and_retrieval_collapses_them(self, tmp_path):
+        """Test that tagged copies point at the first chunk and fill only one retrieval slot"""
+        ingestion, stats = self._ingest(tmp_path, 'tag')
+        assert stats['dedup']['near_duplicates'] == 2 and stats['dedup']['duplicate_groups'] == 1
+        assert stats['dedup']['candidate_pairs'] < stats['dedup']['all_pairs']
+        assert stats['dedup']['collapsible']['embeddings'] == 2
+        assert stats['total_chunks'] == 6 and ingestion.collection.count() == 6
+
+        tagged = ingestion.collection.get(where={'duplicate_of': {'$ne': ''}})
+        canonical = tagged['metadatas'][0]['duplicate_of']
+        assert len(tagged['ids']) == 2 and {m['duplicate_of'] for m in tagged['metadatas']} == {canonical}
+        assert ingestion.collection.get(ids=[canonical])['metadatas'][0]['duplicates'] == 2
+
+        rag = RAGPipeline(db_path=str(tmp_path / 'tag'))
+        chunks = rag.retrieve("Who approves the policy and how do I contact People Operations?", top_k=3)
+        groups = [c['metadata'].get('duplicate_of') or c['chunk_id'] for c in chunks]
+        assert len(chunks) == 3 and len(set(groups)) == 3
+
+    def test_sync_keeps_duplicate_tags(self, tmp_path):
+        """Test that re-syncing a tagged corpus re-stores nothing and retags keep the dedup keys"""
+        import json
+        ingestion, _ = self._ingest(tmp_path, 'tag')
+        docs = sorted((tmp_path / 'docs').glob('*.md'))
+        before = ingestion.collection.get(include=['metadatas'])
+        before = dict(zip(before['ids'], before['metadatas']))
+
+        counts = ingestion.sync_files(docs, [])
+        assert counts['retagged'] == 0 and counts['embedded'] == 0 and counts['unchanged'] == 6
+
+        (tmp_path / 'docs' / 'tags.json').write_text(json.dumps({name.name: ['hr'] for name in docs}))
+        assert ingestion.sync_files(docs, [])['retagged'] == 6
+        after = ingestion.collection.get(include=['metadatas'])
+        for chunk_id, metadata in zip(after['ids'], after['metadatas']):
+            assert metadata['tags'] == 'hr'
+            for key in ('duplicate_of', 'duplicates'):
+                assert metadata.get(key) == before[chunk_id].get(key)
+
+    def test_collapse_skips_embedding_copies(self, tmp_path):
+        """Test that collapsed copies are neither embedded nor stored and savings are reported"""
+        ingestion, stats = self._ingest(tmp_path, 'collapse')
+        assert ingestion.collection.count() == 4 and stats['total_chunks'] == 4
+        assert stats['dedup']['saved']['embeddings'] == 2
+        assert stats['dedup']['saved']['index_bytes'] > 2 * 384 * 4
+        assert sum(d.get('near_duplicates', 0) for d in stats['documents']) == 2
+
+
+class TestExtractiveAnswers:
+    """Test the extractive fast path that skips the LLM"""
+
+    def test_split_sentences_keeps_answer_sized_facts(self):
+        """Test that list items with numbers survive and list introductions keep their items"""
+        from extractive import split_sentences
+        text = ("6.1 Meal Expenses Daily Limits (when traveling): - Breakfast: $20 - Dinner: $40 "
+                "PTO Usage Employees must request PTO two weeks in advance. Approval is required.")
+        assert split_sentences(text) == [
+            "6.1 Meal Expenses Daily Limits (when traveling): Breakfast: $20",
+            "Dinner: $40 PTO Usage Employees must request PTO two weeks in advance."
+        ]
+
+    def test_query_takes_path_by_confidence(self, tmp_path):
+        """Test that confident retrieval is answered from the policy and the rest goes to the LLM"""
+        from ingest import DocumentIngestion
+        from extractive import ExtractiveAnswerer
+        docs = tmp_path / 'docs'
+        docs.mkdir()
+        (docs / 'pto.md').write_text("# PTO Policy\n\nFull-time employees receive 15 days of paid time off per year. "
+                                     "Unused days expire at the end of the year.")
+        DocumentIngestion(docs_path=str(docs), db_path=str(tmp_path / 'db')).ingest_documents()
+
+        rag = RAGPipeline(db_path=str(tmp_path / 'db'), extractive=ExtractiveAnswerer(max_distance=2.0, min_similarity=0.3))
+        rag.generate = lambda prompt: pytest.fail("LLM called on the extractive path")
+        result = rag.query("How many days of paid time off do full-time employees get?")
+        assert result['answer_path'] == 'extractive'
+        assert "15 days" in result['answer'] and "[Source 1]" in result['answer']
+        assert result['extractive']['sentence_similarity'] >= 0.3 and result['sources']
+
+        rag.extractive = ExtractiveAnswerer(max_distance=0.0)
+        rag.generate = lambda prompt: "Generated answer [Source 1]"
+        result = rag.query("How many days of paid time off do full-time employees get?")
+        assert result['answer_path'] == 'llm' and result['answer'] == "Generated answer [Source 1]"
+        assert rag.extractive.info()['low_retrieval_confidence'] == 1
+
+    def test_evaluation_reports_quality_per_path(self):
+        """Test that evaluation splits quality and latency by answer path"""
+        from evaluate import RAGEvaluator
+        evaluator = RAGEvaluator(rag_pipeline=None)
+        sources = [{'full_text': "Employees receive 15 days of paid time off."}]
+        rows = [evaluator.evaluate_answer("q", {'answer': "Employees receive 15 days of paid time off. [Source 1]", 'sources': sources,
+                                                'answer_path': 'extractive', 'latency_ms': 20}),
+                evaluator.evaluate_answer("q", {'answer': "No idea", 'sources': sources, 'latency_ms': 900})]
+        by_path = evaluator.summarize_by_path(rows)
+        assert by_path['extractive']['groundedness'] == 100 and by_path['extractive']['latency_p50'] == 20
+        assert by_path['llm']['count'] == 1 and by_path['llm']['citation_accuracy'] == 0
+
+
+class TestAdaptiveTopK:
+    """Test distance-based adaptive retrieval cutoffs"""
+
+    def test_rules_cut_by_distance_within_bounds(self):
+        """Test the gap, threshold and cumulative rules and the min/max bounds"""
+        from adaptive_k import AdaptiveTopK
+        easy = [1.0, 1.3, 1.5, 1.6, 1.6, 1.7]
+        broad = [1.80, 1.81, 1.82, 1.83, 1.84, 1.85]
+        gap = AdaptiveTopK(rule='gap', gap=0.05, min_k=1, max_k=5)
+        assert gap.cutoff(easy) == 1 and gap.cutoff(broad) == 5
+        assert AdaptiveTopK(rule='gap', min_k=2, max_k=5).cutoff(easy) == 2
+        assert AdaptiveTopK(rule='threshold', max_distance=1.55, min_k=1).cutoff(easy) == 3
+        cumulative = AdaptiveTopK(rule='cumulative', mass=0.7, temperature=0.1, min_k=1, max_k=6)
+        assert cumulative.cutoff(easy) == 1 and cumulative.cutoff(broad) >= 4
+        assert gap.cutoff([None, None]) == 2
+        with pytest.raises(ValueError):
+            AdaptiveTopK(rule='median')
+
+    def test_cumulative_rule_validates_and_stays_in_bounds(self):
+        """Test that out-of-range parameters are rejected and mass=1 keeps every candidate"""
+        from adaptive_k import AdaptiveTopK
+        for kwargs in ({'mass': 0}, {'mass': 1.2}, {'temperature': 0}, {'temperature': -0.1}, {'gap': -0.5}):
+            with pytest.raises(ValueError):
+                AdaptiveTopK(rule='cumulative', **kwargs)
+        everything = AdaptiveTopK(rule='cumulative', mass=1.0, min_k=1, max_k=8)
+        distances = [0.3, 0.7, 0.9, 1.1, 1.3, 1.7, 1.9]
+        assert everything.cutoff(distances) == len(distances)
+        assert everything.cutoff([0.5]) == 1
+
+    def test_gap_rule_with_negative_inner_product_distances(self):
+        """Test that the gap widens past the best hit when ip distances are negative"""
+        from adaptive_k import AdaptiveTopK
+        gap = AdaptiveTopK(rule='gap', gap=0.1, min_k=1, max_k=5)
+        # best = -4.0: keep distances up to -3.6
+        assert gap.cutoff([-4.0, -3.9, -3.7, -3.5, -2.0]) == 3
+        assert gap.cutoff([1.0, 1.05, 1.2]) == 2
+
+    def test_retrieve_applies_cutoff_only_without_explicit_top_k(self, tmp_path):
+        """Test that default retrieval is cut adaptively while an explicit top_k is honored"""
+        from ingest import DocumentIngestion
+        from adaptive_k import AdaptiveTopK
+        docs = tmp_path / 'docs'
+        docs.mkdir()
+        (docs / 'pto.md').write_text("# PTO Policy\n\nEmployees receive 15 days of paid time off per year.")
+        for topic in ('parking', 'badges', 'printers', 'plants'):
+            (docs / f'{topic}.md').write_text(f"# {topic.title()} Policy\n\nRules about office {topic} and their upkeep.")
+        DocumentIngestion(docs_path=str(docs), db_path=str(tmp_path / 'db')).ingest_documents()
+
+        rag = RAGPipeline(db_path=str(tmp_path / 'db'),
+                          adaptive_k=AdaptiveTopK(rule='gap', gap=0.05, min_k=1, max_k=4))
+        chunks = rag.retrieve("How many days of paid time off do employees receive?")
+        assert [c['metadata']['doc_id'] for c in chunks] == ['PTO']
+        assert len(rag.retrieve("How many days of paid time off do employees receive?", top_k=3)) == 3
+        info = rag.adaptive_k.info()
+        assert info['queries'] == 1 and info['chunks_cut'] == 3 and info['kept_histogram'] == {'1': 1}
+
+
+class TestScopeGate:
+    """Test the out-of-scope gate in front of the LLM"""
+
+    def test_refuses_only_when_both_signals_agree_and_calibrates(self):
+        """Test the two-signal rule and that calibration keeps every in-domain question"""
+        from scope_gate import ScopeGate, calibrate
+        gate = ScopeGate(db_path="", max_distance=1.6, min_similarity=0.2)
+        assert gate.refuse({'nearest_distance': 1.9, 'centroid_similarity': 0.05})
+        assert not gate.refuse({'nearest_distance': 1.9, 'centroid_similarity': 0.3})
+        assert not gate.refuse({'nearest_distance': 1.2, 'centroid_similarity': 0.05})
+        # Without centroids the gate cannot tell and lets the question through
+        assert not gate.refuse({'nearest_distance': 1.9, 'centroid_similarity': None})
+
+        in_domain = [{'nearest_distance': d, 'centroid_similarity': s}
+                     for d, s in [(0.8, 0.6), (1.1, 0.45), (1.5, 0.3), (1.7, 0.5)]]
+        off_domain = [{'nearest_distance': d, 'centroid_similarity': s}
+                      for d, s in [(1.9, 0.05), (1.8, 0.1), (1.95, 0.02), (1.4, 0.35)]]
+        result = calibrate(in_domain, off_domain)
+        assert result['in_domain']['refused'] == 0
+        assert result['off_domain']['refused'] == 3
+        with pytest.raises(ValueError):
+            calibrate([{'nearest_distance': 1.0, 'centroid_similarity': None}], off_domain)
+
+    def test_off_domain_question_skips_llm(self, tmp_path, monkeypatch):
+        """Test that ingestion writes centroids and an off-domain question is refused without generation"""
+        from ingest import DocumentIngestion
+        from scope_gate import OUT_OF_SCOPE_ANSWER, ScopeGate, centroids_path
+        docs = tmp_path / 'docs'
+        docs.mkdir()
+        (docs / 'pto.md').write_text("# PTO Policy\n\nEmployees receive 15 days of paid time off per year.")
+        (docs / 'remote.md').write_text("# Remote Work\n\nEmployees may work remotely two days per week.")
+        ingestion = DocumentIngestion(docs_path=str(docs), db_path=str(tmp_path / 'db'))
+        ingestion.ingest_documents()
+        assert os.path.exists(centroids_path(str(tmp_path / 'db'), ingestion.collection.name))
+
+        rag = RAGPipeline(db_path=str(tmp_path / 'db'), scope_gate=ScopeGate(str(tmp_path / 'db')))
+        calls = []
+        monkeypatch.setattr(rag, 'generate', lambda prompt: calls.append(prompt) or "Employees get 15 days [Source 1]")
+
+        refused = rag.query("Explain quantum entanglement")
+        assert refused['answer'] == OUT_OF_SCOPE_ANSWER and refused['answer_path'] == 'refused'
+        assert refused['sources'] == [] and not calls
+
+        answered = rag.query("How many days of paid time off do employees receive?")
+        assert answered['answer_path'] == 'llm' and len(calls) == 1
+        info = rag.scope_gate.info()
+        assert info['checked'] == 2 and info['llm_calls_skipped'] == 1 and info['no_centroids'] == 0
+
+
+class TestMemoryBudget:
+    """Test memory accounting and RSS budget enforcement"""
+
+    def test_sheds_in_order_then_rejects(self, monkeypatch):
+        """Test that shedding stops once RSS is under the shed threshold and new work is rejected above the limit"""
+        import memory
+        from memory import MemoryBudget
+        from admission import AdmissionRejected
+        rss = {'mb': 90}
+        monkeypatch.setattr(memory, 'rss_bytes', lambda: rss['mb'] * 1024 * 1024)
+        monkeypatch.setattr(memory, 'release_freed_memory', lambda: None)
+
+        shed = []
+        budget = MemoryBudget(budget_bytes=100 * 1024 * 1024, shed_ratio=0.8, reject_ratio=0.95, shed_interval=0)
+        budget.add_shedder('cache', lambda: shed.append('cache') or rss.update(mb=85))
+        budget.add_shedder('standby', lambda: shed.append('standby') or rss.update(mb=70))
+        budget.add_shedder('sessions', lambda: shed.append('sessions'))
+        budget.admit()
+        assert shed == ['cache', 'standby']
+        assert budget.info()['last_shed']['rss_after_mb'] == 70
+
+        # Shedding that doesn't help: the request is turned away
+        rss['mb'] = 99
+        stuck = MemoryBudget(budget_bytes=100 * 1024 * 1024, shed_ratio=0.8, reject_ratio=0.95, shed_interval=60)
+        stuck.add_shedder('sessions', lambda: shed.append('sessions'))
+        for _ in range(2):
+            with pytest.raises(AdmissionRejected) as rejected:
+                stuck.admit()
+        assert rejected.value.reason == 'memory' and shed.count('sessions') == 1
+        info = stuck.info()
+        assert info['rejected'] == 2 and info['shed_rounds'] == 1 and info['shed_counts'] == {'sessions': 1}
+
+    def test_memory_endpoint_and_session_shrink(self, client, monkeypatch):
+        """Test the /memory report and evicting least recently used sessions"""
+        from sessions import SessionStore
+        monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+        assert client.get('/memory?top=5').status_code == 403
+        assert client.get('/memory?top=5', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+        assert 'top' not in json.loads(client.get('/memory').data)['tracemalloc']
+        report = json.loads(client.get('/memory?top=5', headers={'X-Admin-Token': 'secret'}).data)
+        assert report['rss_mb'] > 0 and report['peak_rss_mb'] >= report['rss_mb']
+        assert any(name.startswith('index:') for name in report['components_mb'])
+        assert 'sessions' in report['components_mb']
+        assert report['unattributed_mb'] is not None
+        assert 'top' in report['tracemalloc'] or 'hint' in report['tracemalloc']
+        assert client.get('/memory?top=many').status_code == 400
+
+        store = SessionStore()
+        sessions = [store.create() for _ in range(4)]
+        for session in sessions:
+            session.add_turn('question', 'x' * 1000)
+        assert store.shrink(0.5) == 2
+        assert store.get(sessions[0].session_id) is None and store.get(sessions[3].session_id) is not None
+
+
+class TestRequestProfiling:
+    """Test on-demand and sampled request profiling"""
+
+    def test_stage_timings_folded_stacks_and_sampling(self, tmp_path):
+        """Test stage accounting, stored folded stacks, 1-in-N sampling and retention"""
+        import time
+        from profiling import RequestProfiler, stage
+
+        def slow_generation():
+            time.sleep(0.03)
+
+        profiler = RequestProfiler(profile_dir=str(tmp_path), sample_rate=2, max_profiles=2)
+        assert [profiler.should_sample() for _ in range(4)] == [False, True, False, True]
+
+        with profiler.profile('sample') as profile:
+            with stage('extractive'):
+                with stage('embedding'):
+                    time.sleep(0.01)
+            with stage('generation'):
+                slow_generation()
+        timings = profile.report()['timings_ms']
+        assert timings['generation'] >= 30 and timings['embedding'] >= 10
+        # Nested stages count toward their parent only
+        assert timings['other'] < timings['total'] - timings['generation'] - timings['extractive'] + 5
+        folded = profiler.load(profile.profile_id, 'folded')
+        assert 'slow_generation' in folded and folded.strip().split('\n')[0].rsplit(' ', 1)[1].isdigit()
+
+        with profiler.profile('cprofile') as deterministic:
+            slow_generation()
+        assert any('slow_generation' in row['function'] for row in deterministic.report()['top_functions'])
+        with profiler.profile('sample', sampled=True):
+            pass
+        assert len(profiler.list_profiles()) == 2
+        assert profiler.load(profile.profile_id) is None and profiler.load('../etc') is None
+        assert profiler.info()['sampled'] == 1 and profiler.info()['on_demand'] == 2
+
+    def test_chat_profile_is_admin_only(self, client, monkeypatch, tmp_path):
+        """Test that /chat profiles only with the admin token and the profile can be fetched"""
+        import time
+        import app as app_module
+        from profiling import RequestProfiler
+        monkeypatch.setattr('app.preload_complete', True)
+        monkeypatch.setattr('app.request_profiler', RequestProfiler(profile_dir=str(tmp_path)))
+        monkeypatch.setattr(app_module.get_rag_pipeline(), 'generate',
+                            lambda prompt, **kwargs: time.sleep(0.02) or 'answer')
+        question = {'question': 'How many PTO days do I get?', 'profile': True}
+
+        monkeypatch.delenv('ADMIN_TOKEN', raising=False)
+        assert client.post('/chat', json=question, headers={'X-Admin-Token': ''}).status_code == 403
+        monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+        assert client.post('/chat', json=question, headers={'X-Admin-Token': 'wrong'}).status_code == 403
+        assert client.post('/chat', json={**question, 'profile': 'perf'},
+                           headers={'X-Admin-Token': 'secret'}).status_code == 400
+
+        response = client.post('/chat', json=question, headers={'X-Admin-Token': 'secret'})
+        assert response.status_code == 200
+        profile = json.loads(response.data)['profile']
+        assert {'embedding', 'vector_search', 'prompt_build', 'generation', 'total'} <= set(profile['timings_ms'])
+        assert profile['timings_ms']['generation'] >= 20
+
+        folded = client.get(f"/profiles/{profile['profile_id']}?format=folded", headers={'X-Admin-Token': 'secret'})
+        assert folded.status_code == 200 and 'query' in folded.data.decode()
+        assert client.get('/profiles').status_code == 403
+        listed = json.loads(client.get('/profiles', headers={'X-Admin-Token': 'secret'}).data)
+        assert [p['profile_id'] for p in listed['profiles']] == [profile['profile_id']]
+
+
+class TestSearchEndpoint:
+    """Test the retrieval-only /search endpoint"""
+
+    def test_search_batch_and_pagination(self, client, monkeypatch):
+        """Test batched queries, ranked hits and offset pagination without an LLM call"""
+        import app as app_module
+        monkeypatch.setattr('app.preload_complete', True)
+
+        def no_llm(prompt, **kwargs):
+            raise AssertionError("/search must not call the LLM")
+        monkeypatch.setattr(app_module.get_rag_pipeline(), 'generate', no_llm)
+
+        response = client.post('/search', json={'queries': ['How many PTO days do I get?', 'remote work'],
+                                                 'top_k': 3})
+        assert response.status_code == 200
+        results = json.loads(response.data)['results']
+        assert [r['query'] for r in results] == ['How many PTO days do I get?', 'remote work']
+        first = results[0]
+        assert [hit['rank'] for hit in first['hits']] == [1, 2, 3]
+        assert all({'chunk_id', 'doc_id', 'score', 'snippet'} <= set(hit) for hit in first['hits'])
+        assert first['next_offset'] == 3
+
+        page = json.loads(client.post('/search', json={'query': 'How many PTO days do I get?', 'top_k': 3,
+                                                       'offset': first['next_offset'],
+                                                       'include': 'ids'}).data)['results'][0]
+        assert [hit['rank'] for hit in page['hits']] == [4, 5, 6]
+        assert set(page['hits'][0]) == {'rank', 'chunk_id', 'doc_id', 'score'}
+        assert not {hit['chunk_id'] for hit in page['hits']} & {hit['chunk_id'] for hit in first['hits']}
+
+        metrics = json.loads(client.get('/metrics').data)['search']
+        assert metrics['requests'] == 2 and metrics['queries'] == 3
+
+    def test_reranked_pages_match_one_large_page(self, client, monkeypatch):
+        """Test that reranked pages 1 and 2 together equal a single reranked page of both"""
+        monkeypatch.setattr('app.preload_complete', True)
+        query = {'query': 'How many PTO days do I get?', 'use_rerank': True, 'include': 'ids'}
+
+        def page(**kwargs):
+            return json.loads(client.post('/search', json={**query, **kwargs}).data)['results'][0]
+
+        first = page(top_k=3)
+        second = page(top_k=3, offset=first['next_offset'])
+        whole = page(top_k=6)
+        assert [hit['chunk_id'] for hit in first['hits'] + second['hits']] == \
+            [hit['chunk_id'] for hit in whole['hits']]
+        assert [hit['rank'] for hit in second['hits']] == [4, 5, 6]
+
+    def test_search_validation(self, client, monkeypatch):
+        """Test that malformed /search requests are rejected"""
+        monkeypatch.setattr('app.preload_complete', True)
+        monkeypatch.setattr('app.search_max_queries', 2)
+
+        def no_pipeline():
+            raise AssertionError("Validation must not build the pipeline")
+        monkeypatch.setattr('app.get_rag_pipeline', no_pipeline)
+        assert client.post('/search', json={}).status_code == 400
+        assert client.post('/search', json={'query': '   '}).status_code == 400
+        assert client.post('/search', json={'queries': ['a', 'b', 'c']}).status_code == 400
+        assert client.post('/search', json={'query': 'PTO', 'offset': -1}).status_code == 400
+        assert client.post('/search', json={'query': 'PTO', 'offset': 1000}).status_code == 400
+        assert client.post('/search', json={'query': 'PTO', 'top_k': True}).status_code == 400
+        assert client.post('/search', json={'query': 'PTO', 'include': 'everything'}).status_code == 400
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v', '--tb=short'])